@@ -0,0 +1,22 @@
+# Multi-worker entry point: cd backend && gunicorn -c gunicorn.conf.py server:app
+#
+# Each worker is a separate process with its own event loop, Mongo pool and bcrypt pool, so anything
+# that must agree across workers (principals, rate limits, chat fan-out) goes through the shared
+# state backend. With more than one worker it defaults to shared memory on this host; set
+# STATE_BACKEND=redis and REDIS_URL when the workers span several hosts.
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+# Every worker connects to Mongo and starts its background loops in the lifespan, after the fork
+preload_app = False
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+
+if workers > 1:
+    os.environ.setdefault("STATE_BACKEND", "shm")
+# Split the cores between the workers' password hashing pools instead of oversubscribing them
+os.environ.setdefault("BCRYPT_WORKERS", str(max(1, multiprocessing.cpu_count() // workers)))
@@ -0,0 +1,28 @@
+"""Moves stored file bytes into one blob store.
+
+    cd backend && python migrate_blobs.py --to s3 --batch-size 50
+
+Base64 payloads still inline in documents (file_data) or products (image_data) are written out as
+deduplicated blobs, then every blob held by another store is copied to the target and its old copy
+deleted. Set BLOB_STORE to the same target on the web and job workers first so new uploads land there
+too. The migration can be stopped and rerun at any time; it picks up whatever has not moved yet.
+"""
+import argparse
+import asyncio
+import os
+
+import server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--to", default=os.environ.get("BLOB_STORE", "gridfs"), choices=sorted(server.BLOB_STORES))
+    parser.add_argument("--batch-size", type=int, default=50, help="blobs copied concurrently")
+    args = parser.parse_args()
+    moved = asyncio.run(server.run_blob_migration(args.to, args.batch_size))
+    print(f"Moved {moved['inline']} inline payloads and {moved['blobs']} blobs to {args.to}; "
+          f"{moved['skipped']} skipped, see the log")
+
+
+if __name__ == "__main__":
+    main()
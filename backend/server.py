@@ -1,34 +1,250 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Header, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import ORJSONResponse, RedirectResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
-from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict, Any
-from datetime import datetime, timedelta
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, TEXT, DeleteOne, IndexModel, ReadPreference, ReturnDocument, UpdateMany, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
+from pydantic import BaseModel, Field, EmailStr, ValidationError
+from typing import List, Optional, Dict, Any, AsyncIterable, AsyncIterator, Awaitable, Callable
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from passlib.context import CryptContext
 from dotenv import load_dotenv
-import uuid, os, jwt, base64, logging
+import uuid, os, jwt, base64, logging, time, asyncio, hashlib, hmac, json, weakref, re, bisect, heapq, threading, struct, tempfile, math, random, csv, io, ipaddress, unicodedata
+import numpy as np
+import orjson
+import pandas as pd
+import snowballstemmer
 
 # Load environment
 ROOT_DIR = Path(__file__).resolve().parent
 load_dotenv(ROOT_DIR / ".env")
 
 # Database
+# The client is created in the app lifespan (start_services) with these pool settings
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+MONGO_DB_NAME = os.environ['DB_NAME']
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 100))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', 10))
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', 300000))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 5000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', 30000))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000))
+# Order placement runs its transactions on the primary whatever this is set to
+MONGO_READ_PREFERENCE = os.environ.get('MONGO_READ_PREFERENCE', 'primary')
+READY_PING_TIMEOUT_SECONDS = 2.0
+client: Optional[AsyncIOMotorClient] = None
+db = None
+services_ready = False
+
+INDEX_SELF_CHECK = os.environ.get('INDEX_SELF_CHECK', 'true').lower() == 'true'
 
 # Auth
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-this-in-production')
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRATION_HOURS = 24
+# Signing keys by kid, e.g. JWT_KEYS="2025-06:secret-a,2025-09:secret-b". New tokens are signed with
+# JWT_ACTIVE_KID; every listed key still verifies, so secrets rotate without logging everyone out.
+# JWT_SECRET stays valid as kid "default" for tokens issued before kids existed.
+JWT_KEYS = {"default": JWT_SECRET}
+for _entry in filter(None, os.environ.get('JWT_KEYS', '').split(',')):
+    _kid, _secret = _entry.split(':', 1)
+    JWT_KEYS[_kid.strip()] = _secret.strip()
+JWT_ACTIVE_KID = os.environ.get('JWT_ACTIVE_KID', 'default')
+if JWT_ACTIVE_KID not in JWT_KEYS:
+    raise RuntimeError(f"JWT_ACTIVE_KID {JWT_ACTIVE_KID!r} is not in JWT_KEYS")
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 50000))
+TOKEN_CACHE_TTL_SECONDS = float(os.environ.get('TOKEN_CACHE_TTL_SECONDS', 300))
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
 
+# Documents
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 100 * 1024 * 1024))
+UPLOAD_READ_SIZE = 1024 * 1024
+BLOB_GC_INTERVAL_SECONDS = float(os.environ.get('BLOB_GC_INTERVAL_SECONDS', 300))
+BLOB_GC_GRACE_SECONDS = float(os.environ.get('BLOB_GC_GRACE_SECONDS', 3600))
+STORAGE_STATS_TTL_SECONDS = float(os.environ.get('STORAGE_STATS_TTL_SECONDS', 30))
+# Where new blob bytes go: gridfs (inside MongoDB), local (a directory) or s3 (any S3-compatible store)
+BLOB_STORE = os.environ.get('BLOB_STORE', 'gridfs')
+BLOB_LOCAL_ROOT = os.environ.get('BLOB_LOCAL_ROOT', str(ROOT_DIR / 'blobs'))
+# With nginx in front, set to an internal location aliased to BLOB_LOCAL_ROOT so it sendfile()s downloads
+BLOB_LOCAL_ACCEL_PREFIX = os.environ.get('BLOB_LOCAL_ACCEL_PREFIX', '')
+S3_BUCKET = os.environ.get('S3_BUCKET', '')
+S3_PREFIX = os.environ.get('S3_PREFIX', 'blobs/')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL') or None
+S3_REGION = os.environ.get('S3_REGION') or None
+S3_MULTIPART_BYTES = int(os.environ.get('S3_MULTIPART_BYTES', 8 * 1024 * 1024))
+S3_PRESIGN_SECONDS = int(os.environ.get('S3_PRESIGN_SECONDS', 300))
+# Text extraction for search: larger files are not indexed, and extracted text is cut at MAX_CHARS
+DOCUMENT_TEXT_MAX_BYTES = int(os.environ.get('DOCUMENT_TEXT_MAX_BYTES', 25 * 1024 * 1024))
+DOCUMENT_TEXT_MAX_CHARS = int(os.environ.get('DOCUMENT_TEXT_MAX_CHARS', 200000))
+SEARCH_SNIPPET_CHARS = 240
+SEARCH_SNIPPET_LEAD = 80
+SEARCH_MAX_RESULTS = 100
+SEARCH_MAX_OFFSET = 1000
+
+# Catalog
+# The type-ahead index keeps the CATALOG_INDEX_SIZE most recently written products in memory and
+# picks up writes from other workers every CATALOG_INDEX_REFRESH_SECONDS
+CATALOG_INDEX_ENABLED = os.environ.get('CATALOG_INDEX_ENABLED', 'true').lower() == 'true'
+CATALOG_INDEX_SIZE = int(os.environ.get('CATALOG_INDEX_SIZE', 100000))
+CATALOG_INDEX_REFRESH_SECONDS = float(os.environ.get('CATALOG_INDEX_REFRESH_SECONDS', 30))
+CATALOG_SUGGEST_LIMIT = 10
+CATALOG_FACET_CATEGORIES = 50
+PRICE_FACET_BOUNDARIES = [0, 10, 25, 50, 100, 250, 500, 1000]
+
+# Orders
+MAX_ORDER_ITEMS = 100
+
+# Chat
+CHAT_HISTORY_LIMIT = int(os.environ.get('CHAT_HISTORY_LIMIT', 200))
+CHAT_SUBSCRIBER_QUEUE_SIZE = int(os.environ.get('CHAT_SUBSCRIBER_QUEUE_SIZE', 256))
+CHAT_LONG_POLL_MAX_SECONDS = 30
+CHAT_BUFFER_SIZE = int(os.environ.get('CHAT_BUFFER_SIZE', 200))
+CHAT_BUFFER_ROOMS = int(os.environ.get('CHAT_BUFFER_ROOMS', 1000))
+ROOM_MEMBER_CACHE_SIZE = 50000
+ROOM_MEMBER_CACHE_TTL_SECONDS = 60
+
+# Analytics
+ANALYTICS_RECENT_ACTIVITY = 10
+ANALYTICS_RECONCILE_INTERVAL_SECONDS = float(os.environ.get('ANALYTICS_RECONCILE_INTERVAL_SECONDS', 3600))
+
+# Metrics
+# METRICS_STORAGE: "auto" uses a time-series collection when the server supports one, "buckets"
+# forces the hourly bucket schema
+METRICS_STORAGE = os.environ.get('METRICS_STORAGE', 'auto')
+METRICS_FLUSH_SIZE = int(os.environ.get('METRICS_FLUSH_SIZE', 1000))
+METRICS_FLUSH_INTERVAL_SECONDS = float(os.environ.get('METRICS_FLUSH_INTERVAL_SECONDS', 1.0))
+METRICS_MAX_BUFFERED = int(os.environ.get('METRICS_MAX_BUFFERED', 100000))
+METRICS_MAX_BULK = 10000
+METRICS_RECENT_LIMIT = 50
+METRICS_MAX_POINTS = 10000
+WIDGET_CACHE_SIZE = int(os.environ.get('WIDGET_CACHE_SIZE', 10000))
+WIDGET_CACHE_TTL_SECONDS = float(os.environ.get('WIDGET_CACHE_TTL_SECONDS', 30))
+
+# Password hashing pool
+BCRYPT_POOL = os.environ.get('BCRYPT_POOL', 'thread')
+BCRYPT_WORKERS = int(os.environ.get('BCRYPT_WORKERS', os.cpu_count() or 2))
+BCRYPT_MAX_PENDING = int(os.environ.get('BCRYPT_MAX_PENDING', 64))
+
+# Login/register rate limits: token buckets per client IP and per email, refilled at *_PER_MINUTE
+# and holding up to *_BURST requests. Checked before any password hashing.
+AUTH_RATE_LIMIT_ENABLED = os.environ.get('AUTH_RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+AUTH_IP_RATE_PER_MINUTE = float(os.environ.get('AUTH_IP_RATE_PER_MINUTE', 30))
+AUTH_IP_BURST = float(os.environ.get('AUTH_IP_BURST', 10))
+AUTH_EMAIL_RATE_PER_MINUTE = float(os.environ.get('AUTH_EMAIL_RATE_PER_MINUTE', 5))
+AUTH_EMAIL_BURST = float(os.environ.get('AUTH_EMAIL_BURST', 5))
+# Proxies in front of the app, so the per-IP bucket keys on the client rather than the proxy: the number
+# of hops that always append to X-Forwarded-For (1 behind a single load balancer such as Railway's edge)
+# and/or the proxy networks to trust, as comma-separated addresses or CIDRs
+AUTH_TRUSTED_PROXY_HOPS = int(os.environ.get('AUTH_TRUSTED_PROXY_HOPS', 0))
+AUTH_TRUSTED_PROXIES = [
+    ipaddress.ip_network(item.strip(), strict=False)
+    for item in os.environ.get('AUTH_TRUSTED_PROXIES', '').split(',') if item.strip()
+]
+
+# Workflow runtime: a claimed workflow is leased for WORKFLOW_LEASE_SECONDS; due workflows are also
+# rescanned every WORKFLOW_SCAN_INTERVAL_SECONDS in case a wake-up message was missed
+WORKFLOW_LEASE_SECONDS = float(os.environ.get('WORKFLOW_LEASE_SECONDS', 30))
+WORKFLOW_SCAN_INTERVAL_SECONDS = float(os.environ.get('WORKFLOW_SCAN_INTERVAL_SECONDS', 5))
+WORKFLOW_CONCURRENCY = int(os.environ.get('WORKFLOW_CONCURRENCY', 200))
+WORKFLOW_MAX_APPROVALS = 50
+
+# Background jobs: a claimed job stays invisible to other consumers for JOB_VISIBILITY_TIMEOUT_SECONDS
+# (renewed while it runs); failures retry with exponential backoff and move to dead_jobs after max_attempts. Each web worker
+# runs JOB_APP_CONSUMERS consumers; set it to 0 when worker.py runs the queue instead.
+JOB_VISIBILITY_TIMEOUT_SECONDS = float(os.environ.get('JOB_VISIBILITY_TIMEOUT_SECONDS', 300))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+JOB_BACKOFF_BASE_SECONDS = float(os.environ.get('JOB_BACKOFF_BASE_SECONDS', 5))
+JOB_BACKOFF_MAX_SECONDS = float(os.environ.get('JOB_BACKOFF_MAX_SECONDS', 3600))
+JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', 1))
+JOB_APP_CONSUMERS = int(os.environ.get('JOB_APP_CONSUMERS', 1))
+JOB_PROCESSES = int(os.environ.get('JOB_PROCESSES', 1))
+
+# Principal cache
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.environ.get('PRINCIPAL_CACHE_TTL_SECONDS', 60))
+
+# Shared state
+# STATE_BACKEND selects where principals, rate-limit buckets and chat fan-out live: "local" (this
+# process only; fine for a single worker), "shm" (a shared-memory segment for workers on one host)
+# or "redis" (REDIS_URL, for workers spread over several hosts)
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'local')
+STATE_LOCAL_MAX_KEYS = int(os.environ.get('STATE_LOCAL_MAX_KEYS', 100000))
+STATE_SHM_NAME = os.environ.get('STATE_SHM_NAME', 'neokatalyst-state')
+STATE_SHM_SLOTS = int(os.environ.get('STATE_SHM_SLOTS', 16384))
+STATE_SHM_SLOT_BYTES = int(os.environ.get('STATE_SHM_SLOT_BYTES', 1024))
+STATE_SHM_RING_SLOTS = int(os.environ.get('STATE_SHM_RING_SLOTS', 2048))
+STATE_SHM_MESSAGE_BYTES = int(os.environ.get('STATE_SHM_MESSAGE_BYTES', 4096))
+STATE_SHM_POLL_SECONDS = float(os.environ.get('STATE_SHM_POLL_SECONDS', 0.01))
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+STATE_KEY_PREFIX = os.environ.get('STATE_KEY_PREFIX', 'neokatalyst:')
+
+# Responses
+# Every route renders with orjson. Handlers that already hold exactly the fields of their response
+# model return json_response() (or json_array_response() for unbounded lists) directly, which skips
+# FastAPI's re-validation and jsonable_encoder pass; response_model stays on the route for the schema.
+JSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+JSON_ARRAY_BATCH = 100
+
+def orjson_default(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+class FastJSONResponse(ORJSONResponse):
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=orjson_default, option=JSON_OPTIONS)
+
+def json_text(value: Any) -> str:
+    return orjson.dumps(value, default=orjson_default, option=JSON_OPTIONS).decode()
+
+def json_response(content: Any, headers: Optional[Dict[str, str]] = None, status_code: int = 200) -> FastJSONResponse:
+    return FastJSONResponse(content, status_code=status_code, headers=headers)
+
+async def iter_json_array(items: AsyncIterable) -> AsyncIterator[bytes]:
+    yield b"["
+    batch: List[bytes] = []
+    separator = b""
+    async for item in items:
+        batch.append(orjson.dumps(item, default=orjson_default, option=JSON_OPTIONS))
+        if len(batch) >= JSON_ARRAY_BATCH:
+            yield separator + b",".join(batch)
+            batch, separator = [], b","
+    if batch:
+        yield separator + b",".join(batch)
+    yield b"]"
+
+def json_array_response(items: AsyncIterable, headers: Optional[Dict[str, str]] = None) -> StreamingResponse:
+    # Streams a cursor as a JSON array without holding the whole result in memory
+    return StreamingResponse(iter_json_array(items), media_type="application/json", headers=headers)
+
 # App setup
-app = FastAPI(title="neokatalyst API", description="Digital Transformation Platform API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await start_services()
+    try:
+        yield
+    finally:
+        await stop_services()
+
+app = FastAPI(
+    title="neokatalyst API",
+    description="Digital Transformation Platform API",
+    default_response_class=FastJSONResponse,
+    lifespan=lifespan,
+)
 api_router = APIRouter(prefix="/api")
+background_tasks: List[asyncio.Task] = []
 
 # CORS config
 origins = [
@@ -43,8 +259,122 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Content-Range", "Content-Disposition", "Idempotent-Replayed", "Retry-After"],
 )
 
+# Instrumentation
+# Histograms are exported in Prometheus text format at /metrics. observe() takes no lock: every
+# thread (the event loop, the Motor executor threads reporting command timings) counts into its own
+# shard, and a scrape sums the shards.
+# /metrics needs a bearer token: METRICS_TOKEN (for the scraper's bearer_token setting) or an admin's
+# access token
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def prometheus_labels(names: tuple, values: tuple) -> str:
+    pairs = [
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(names, values)
+    ]
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+class Histogram:
+    """Fixed-bucket histogram per label set."""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._local = threading.local()
+        self._shards: List[Dict[tuple, list]] = []
+
+    def observe(self, labels: tuple, seconds: float) -> None:
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            self._shards.append(shard)
+        counts = shard.get(labels)
+        if counts is None:
+            # One count per bucket, then +Inf, then the running sum
+            counts = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        counts[-1] += seconds
+
+    def collect(self) -> Dict[tuple, list]:
+        merged: Dict[tuple, list] = {}
+        for shard in list(self._shards):
+            for labels, counts in list(shard.items()):
+                total = merged.setdefault(labels, [0] * len(counts))
+                for i, value in enumerate(counts):
+                    total[i] += value
+        return merged
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, counts in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket_labels = prometheus_labels(self.labelnames + ("le",), labels + (bound,))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = prometheus_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {counts[-1]}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+http_request_seconds = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template", ("method", "route")
+)
+# Only touched from the event loop, so plain dict counters are safe
+http_responses: Dict[tuple, int] = {}
+http_requests_in_flight = 0
+route_templates: Dict[Any, str] = {}
+
+def route_label(scope) -> str:
+    # Label by route template (/api/products/{product_id}), never by raw path, to bound cardinality
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    template = route_templates.get(endpoint)
+    if template is None:
+        route_templates.update({route.endpoint: route.path for route in app.routes if hasattr(route, "endpoint")})
+        template = route_templates.get(endpoint, "unmatched")
+    return template
+
+class MetricsMiddleware:
+    """Pure ASGI middleware; BaseHTTPMiddleware would add a task and a body copy per request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        global http_requests_in_flight
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        http_requests_in_flight += 1
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            http_requests_in_flight -= 1
+            route = route_label(scope)
+            http_request_seconds.observe((scope["method"], route), elapsed)
+            key = (scope["method"], route, status_code)
+            http_responses[key] = http_responses.get(key, 0) + 1
+
+app.add_middleware(MetricsMiddleware)
+
 # Models
 class UserRole(BaseModel):
     admin: bool = False
@@ -94,6 +424,1028 @@ class UserUpdate(BaseModel):
     company: Optional[str] = None
     phone: Optional[str] = None
 
+class WorkflowStepCreate(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    name: str
+    description: Optional[str] = None
+    assignee_id: Optional[str] = None
+    required_approvals: int = Field(1, ge=0, le=WORKFLOW_MAX_APPROVALS)
+    order: int = 1
+
+STEP_STATUSES = ("waiting", "active", "completed", "rejected")
+
+class WorkflowStep(WorkflowStepCreate):
+    # Advanced by the workflow scheduler; approvals and rejections count the step's completed and
+    # rejected tasks, one task per required approval
+    status: str = "waiting"
+    approvals: int = 0
+    rejections: int = 0
+    task_ids: List[str] = []
+
+class Workflow(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    name: str
+    description: Optional[str] = None
+    steps: List[WorkflowStep] = []
+    step_count: int = 0
+    status: str = "active"
+    current_order: Optional[int] = None
+    created_by: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+class WorkflowCreate(BaseModel):
+    name: str
+    description: Optional[str] = None
+    steps: List[WorkflowStepCreate] = []
+
+class WorkflowSummary(BaseModel):
+    id: str
+    name: str
+    description: Optional[str] = None
+    step_count: int
+    status: str
+    created_by: str
+    created_at: datetime
+
+TASK_STATUSES = ("pending", "in_progress", "completed", "rejected")
+
+class Task(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    workflow_id: Optional[str] = None
+    step_id: Optional[str] = None
+    title: str
+    description: Optional[str] = None
+    assignee_id: str
+    status: str = "pending"
+    due_date: Optional[datetime] = None
+    created_by: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+class TaskCreate(BaseModel):
+    workflow_id: Optional[str] = None
+    step_id: Optional[str] = None
+    title: str
+    description: Optional[str] = None
+    assignee_id: Optional[str] = None
+    due_date: Optional[datetime] = None
+
+class TaskUpdate(BaseModel):
+    title: Optional[str] = None
+    description: Optional[str] = None
+    status: Optional[str] = None
+    due_date: Optional[datetime] = None
+
+class Document(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    filename: str
+    content_type: str = "application/octet-stream"
+    size: int
+    tags: List[str] = []
+    folder_id: Optional[str] = None
+    # Storage key at upload time; reads resolve the bytes through db.blobs by sha256, which follows migrations
+    blob_id: str
+    sha256: str
+    # pending until the extract_document_text job runs, then indexed, unsupported or failed
+    text_status: str = "pending"
+    created_by: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+class DocumentResponse(BaseModel):
+    id: str
+    filename: str
+    content_type: str
+    size: int
+    tags: List[str]
+    folder_id: Optional[str]
+    text_status: Optional[str] = None
+    created_by: str
+    created_at: datetime
+
+class DocumentSearchResult(DocumentResponse):
+    score: float
+    snippet: str
+    # [start, end) character offsets of query terms within snippet
+    highlights: List[List[int]]
+
+class Folder(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    name: str
+    parent_id: Optional[str] = None
+    # Folder ids from the root down to parent_id, so a subtree is every folder whose ancestors contain its id
+    ancestors: List[str] = []
+    created_by: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+class FolderCreate(BaseModel):
+    name: str
+    parent_id: Optional[str] = None
+
+class FolderUpdate(BaseModel):
+    name: Optional[str] = None
+    # Only applied when present in the request; an explicit null moves the folder to the root
+    parent_id: Optional[str] = None
+
+class FolderNode(Folder):
+    child_count: int
+    document_count: int
+
+class FolderCrumb(BaseModel):
+    id: str
+    name: str
+
+class FolderDetail(Folder):
+    # Breadcrumbs from the root down to and including this folder
+    path: List[FolderCrumb]
+
+class Product(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    name: str
+    description: str = ""
+    price: float = Field(ge=0)
+    category: str = ""
+    stock_quantity: int = Field(0, ge=0)
+    image_blob_id: Optional[str] = None
+    image_sha256: Optional[str] = None
+    image_content_type: Optional[str] = None
+    created_by: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+class ProductResponse(BaseModel):
+    id: str
+    name: str
+    description: str
+    price: float
+    category: str
+    stock_quantity: int
+    image_url: Optional[str] = None
+    created_by: str
+    created_at: datetime
+
+class ProductUpdate(BaseModel):
+    name: Optional[str] = None
+    description: Optional[str] = None
+    price: Optional[float] = Field(None, ge=0)
+    category: Optional[str] = None
+    stock_quantity: Optional[int] = Field(None, ge=0)
+
+class OrderItem(BaseModel):
+    product_id: str
+    quantity: int = Field(gt=0)
+    price: float = Field(ge=0)
+    product_name: Optional[str] = None
+
+class OrderCreate(BaseModel):
+    items: List[OrderItem] = Field(min_length=1, max_length=MAX_ORDER_ITEMS)
+    shipping_address: Dict[str, Any] = {}
+
+class Order(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    items: List[OrderItem]
+    total_amount: float
+    status: str = "pending"
+    shipping_address: Dict[str, Any] = {}
+    created_by: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+class ChatRoom(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    name: str
+    description: Optional[str] = None
+    participants: List[str] = []
+    last_seq: int = 0
+    created_by: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+class ChatRoomCreate(BaseModel):
+    name: str
+    description: Optional[str] = None
+    participants: List[str] = []
+
+class ChatMessage(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    room_id: str
+    seq: int
+    sender_id: str
+    sender_name: str
+    content: str
+    message_type: str = "text"
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+class ChatMessageCreate(BaseModel):
+    room_id: str
+    content: str
+    message_type: str = "text"
+
+class MetricCreate(BaseModel):
+    name: str
+    value: float
+    unit: Optional[str] = None
+    category: Optional[str] = None
+    metadata: Dict[str, Any] = {}
+    timestamp: Optional[datetime] = None
+
+class Metric(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    name: str
+    value: float
+    unit: Optional[str] = None
+    category: Optional[str] = None
+    metadata: Dict[str, Any] = {}
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+class WidgetQuery(BaseModel):
+    metric: str
+    aggregation: str = Field("avg", pattern="^(avg|sum|min|max|count)$")
+    window: int = Field(86400, gt=0, description="Lookback in seconds")
+    step: int = Field(3600, ge=60, description="Bucket width in seconds")
+
+class Widget(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    title: str
+    type: str
+    config: Dict[str, Any] = {}
+    position: Dict[str, Any] = {}
+    query: Optional[WidgetQuery] = None
+    data: Optional[Dict[str, Any]] = None
+    created_by: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+class WidgetCreate(BaseModel):
+    title: str
+    type: str
+    config: Dict[str, Any] = {}
+    position: Dict[str, Any] = {}
+    query: Optional[WidgetQuery] = None
+
+# Caches
+class TTLCache:
+    """Bounded LRU cache whose entries expire ``ttl`` seconds after being set."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value, ttl: Optional[float] = None) -> None:
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+token_cache = TTLCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL_SECONDS)
+# sha256 digest -> exp (unix seconds) of tokens revoked by logout
+revoked_tokens: Dict[str, float] = {}
+revoked_tokens_prune_at = 1024
+
+# Shared state
+# Everything that must agree across workers goes through a StateBackend: TTL'd key/values
+# (principals), token buckets (rate limits) and pub/sub (chat fan-out, token revocation). Values and
+# messages must be JSON-compatible, because every backend except "local" stores them with orjson.
+# publish() hands a message to this worker's handler at once and to the other workers through the
+# backend, so handlers must tolerate seeing a message they already applied.
+
+def refill_bucket(tokens: float, updated: float, now: float, rate: float, capacity: float, cost: float) -> tuple:
+    # Returns (tokens left, seconds to wait); the wait is 0 when the cost was taken
+    tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+    if tokens >= cost:
+        return tokens - cost, 0.0
+    return tokens, (cost - tokens) / rate
+
+class StateBackend(ABC):
+    """Key/value, token bucket and pub/sub state shared by every worker using the same backend.
+
+    get() counts hits and misses for every backend; subclasses implement load().
+    """
+
+    name = "base"
+
+    def __init__(self):
+        self.on_message: Optional[Callable[[str, Any], None]] = None
+        # Tags published messages so a worker skips its own when they come back
+        self.origin = uuid.uuid4().hex
+        self.published = 0
+        self.received = 0
+        self.hits = 0
+        self.misses = 0
+        # Live entries this worker pushed out to make room
+        self.evictions = 0
+
+    async def start(self, on_message: Callable[[str, Any], None]) -> None:
+        self.on_message = on_message
+
+    async def close(self) -> None:
+        pass
+
+    async def get(self, key: str) -> Any:
+        value = await self.load(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    @abstractmethod
+    async def load(self, key: str) -> Any:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    async def take_tokens(self, key: str, rate: float, capacity: float, cost: float = 1.0) -> float:
+        """Takes ``cost`` tokens from a bucket refilled at ``rate``/s up to ``capacity``.
+
+        Returns 0 when they were taken, otherwise the seconds until enough tokens are available.
+        """
+
+    async def publish(self, channel: str, message: Any) -> None:
+        self.published += 1
+        self.deliver(channel, message)
+        await self.broadcast(channel, message)
+
+    async def broadcast(self, channel: str, message: Any) -> None:
+        # Sends a message to the other workers; the local backend has none
+        pass
+
+    def deliver(self, channel: str, message: Any) -> None:
+        if self.on_message is None:
+            return
+        try:
+            self.on_message(channel, message)
+        except Exception:
+            logger.exception(f"State message handler failed for {channel}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name, "origin": self.origin, "published": self.published, "received": self.received,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+class LocalStateBackend(StateBackend):
+    name = "local"
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.cache = TTLCache(maxsize, PRINCIPAL_CACHE_TTL_SECONDS)
+
+    async def load(self, key: str) -> Any:
+        return self.cache.get(key)
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        self.cache.set(key, value, ttl)
+
+    async def delete(self, key: str) -> None:
+        self.cache.invalidate(key)
+
+    async def take_tokens(self, key: str, rate: float, capacity: float, cost: float = 1.0) -> float:
+        now = time.monotonic()
+        tokens, updated = self.cache.get(key) or (capacity, now)
+        tokens, wait = refill_bucket(tokens, updated, now, rate, capacity, cost)
+        # Once expired the bucket would have refilled anyway
+        self.cache.set(key, (tokens, now), capacity / rate)
+        return wait
+
+    def stats(self) -> Dict[str, Any]:
+        # The cache's own hit counts include token bucket reads
+        return {**self.cache.stats(), **super().stats(), "evictions": self.cache.evictions}
+
+class SharedMemoryStateBackend(StateBackend):
+    """State in a named shared-memory segment, for workers on one host.
+
+    The segment holds an open-addressed table of fixed-size key/value slots and a ring of published
+    messages that every worker polls. An flock on a file next to it serializes all access. The segment
+    outlives the workers; remove it with SharedMemory(STATE_SHM_NAME).unlink() after changing its size.
+    """
+
+    name = "shm"
+    MAGIC = b"nkstate1"
+    HEADER = struct.Struct("<8sQIIII")  # magic, last published seq, slots, slot bytes, ring slots, message bytes
+    SLOT = struct.Struct("<QdI")  # key hash (0 = empty), expires at (unix time), payload length
+    RING = struct.Struct("<QI")  # seq, payload length
+    PROBES = 8
+
+    def __init__(self, segment_name: str, slots: int, slot_bytes: int, ring_slots: int, message_bytes: int):
+        import fcntl
+        from multiprocessing import resource_tracker, shared_memory
+        super().__init__()
+        self._fcntl = fcntl
+        self.slots, self.slot_bytes = slots, slot_bytes
+        self.ring_slots, self.message_bytes = ring_slots, message_bytes
+        self.slot_size = self.SLOT.size + slot_bytes
+        self.ring_size = self.RING.size + message_bytes
+        self.ring_offset = self.HEADER.size + slots * self.slot_size
+        size = self.ring_offset + ring_slots * self.ring_size
+        self.lock_file = open(os.path.join(tempfile.gettempdir(), f"{segment_name}.lock"), "a+b")
+        with self.locked():
+            try:
+                self.shm = shared_memory.SharedMemory(segment_name, create=True, size=size)
+            except FileExistsError:
+                self.shm = shared_memory.SharedMemory(segment_name)
+            # Otherwise the segment is unlinked when the worker that created it exits
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+            self.buf = self.shm.buf
+            magic, last_seq, *layout = self.HEADER.unpack_from(self.buf, 0)
+            if magic != self.MAGIC:
+                self.HEADER.pack_into(self.buf, 0, self.MAGIC, 0, slots, slot_bytes, ring_slots, message_bytes)
+                last_seq = 0
+            elif layout != [slots, slot_bytes, ring_slots, message_bytes]:
+                raise RuntimeError(f"Shared memory segment {segment_name!r} has layout {layout}; unlink it to resize")
+        self.last_seq = last_seq
+        self.dropped = 0
+        self.oversized = 0
+        self.poller: Optional[asyncio.Task] = None
+
+    @contextmanager
+    def locked(self):
+        self._fcntl.flock(self.lock_file, self._fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            self._fcntl.flock(self.lock_file, self._fcntl.LOCK_UN)
+
+    async def start(self, on_message: Callable[[str, Any], None]) -> None:
+        await super().start(on_message)
+        self.poller = asyncio.create_task(self.poll())
+
+    async def close(self) -> None:
+        if self.poller is not None:
+            self.poller.cancel()
+            await asyncio.gather(self.poller, return_exceptions=True)
+        self.buf.release()
+        self.shm.close()
+        self.lock_file.close()
+
+    @staticmethod
+    def key_hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+
+    def find(self, key: str, now: float, for_write: bool) -> Optional[int]:
+        # Returns the offset of the slot holding key or, for writes, of the slot to overwrite: a free or
+        # expired one in the probe window, else the one expiring soonest
+        key_hash = self.key_hash(key)
+        victim, victim_expires = None, float("inf")
+        for probe in range(self.PROBES):
+            offset = self.HEADER.size + ((key_hash + probe) % self.slots) * self.slot_size
+            slot_hash, expires_at, length = self.SLOT.unpack_from(self.buf, offset)
+            if slot_hash == key_hash and expires_at > now:
+                start = offset + self.SLOT.size
+                if orjson.loads(self.buf[start:start + length])[0] == key:
+                    return offset
+            if for_write and (slot_hash == 0 or expires_at <= now):
+                expires_at = 0.0
+            if for_write and expires_at < victim_expires:
+                victim, victim_expires = offset, expires_at
+        return victim
+
+    def read(self, key: str, now: float) -> Any:
+        offset = self.find(key, now, for_write=False)
+        if offset is None:
+            return None
+        _, _, length = self.SLOT.unpack_from(self.buf, offset)
+        start = offset + self.SLOT.size
+        return orjson.loads(self.buf[start:start + length])[1]
+
+    def write(self, key: str, value: Any, expires_at: float, now: float) -> None:
+        payload = orjson.dumps([key, value], default=orjson_default, option=JSON_OPTIONS)
+        if len(payload) > self.slot_bytes:
+            # Values are caches and buckets, so an oversized one is just not shared
+            self.oversized += 1
+            return
+        offset = self.find(key, now, for_write=True)
+        key_hash = self.key_hash(key)
+        slot_hash, slot_expires_at, _ = self.SLOT.unpack_from(self.buf, offset)
+        if slot_hash not in (0, key_hash) and slot_expires_at > now:
+            self.evictions += 1
+        self.SLOT.pack_into(self.buf, offset, key_hash, expires_at, len(payload))
+        self.buf[offset + self.SLOT.size:offset + self.SLOT.size + len(payload)] = payload
+
+    async def load(self, key: str) -> Any:
+        with self.locked():
+            return self.read(key, time.time())
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        now = time.time()
+        with self.locked():
+            self.write(key, value, now + ttl, now)
+
+    async def delete(self, key: str) -> None:
+        with self.locked():
+            offset = self.find(key, time.time(), for_write=False)
+            if offset is not None:
+                self.SLOT.pack_into(self.buf, offset, 0, 0.0, 0)
+
+    async def take_tokens(self, key: str, rate: float, capacity: float, cost: float = 1.0) -> float:
+        now = time.time()
+        with self.locked():
+            tokens, updated = self.read(key, now) or (capacity, now)
+            tokens, wait = refill_bucket(tokens, updated, now, rate, capacity, cost)
+            self.write(key, [tokens, now], now + capacity / rate, now)
+        return wait
+
+    async def broadcast(self, channel: str, message: Any) -> None:
+        payload = orjson.dumps([self.origin, channel, message], default=orjson_default, option=JSON_OPTIONS)
+        if len(payload) > self.message_bytes:
+            self.oversized += 1
+            logger.warning(f"Message on {channel} exceeds STATE_SHM_MESSAGE_BYTES; delivered to this worker only")
+            return
+        with self.locked():
+            seq = self.HEADER.unpack_from(self.buf, 0)[1] + 1
+            offset = self.ring_offset + (seq % self.ring_slots) * self.ring_size
+            self.RING.pack_into(self.buf, offset, seq, len(payload))
+            self.buf[offset + self.RING.size:offset + self.RING.size + len(payload)] = payload
+            struct.pack_into("<Q", self.buf, 8, seq)
+
+    async def poll(self) -> None:
+        while True:
+            await asyncio.sleep(STATE_SHM_POLL_SECONDS)
+            if struct.unpack_from("<Q", self.buf, 8)[0] == self.last_seq:
+                continue
+            payloads = []
+            with self.locked():
+                head = struct.unpack_from("<Q", self.buf, 8)[0]
+                if head - self.last_seq > self.ring_slots:
+                    self.dropped += head - self.last_seq - self.ring_slots
+                    self.last_seq = head - self.ring_slots
+                for seq in range(self.last_seq + 1, head + 1):
+                    offset = self.ring_offset + (seq % self.ring_slots) * self.ring_size
+                    _, length = self.RING.unpack_from(self.buf, offset)
+                    payloads.append(bytes(self.buf[offset + self.RING.size:offset + self.RING.size + length]))
+                self.last_seq = head
+            for payload in payloads:
+                origin, channel, message = orjson.loads(payload)
+                if origin != self.origin:
+                    self.received += 1
+                    self.deliver(channel, message)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), "segment": self.shm.name, "last_seq": self.last_seq,
+                "dropped": self.dropped, "oversized": self.oversized}
+
+class RedisStateBackend(StateBackend):
+    """State in Redis (or anything speaking its protocol) for workers on several hosts.
+
+    Pass ``client`` to use a different redis.asyncio-compatible client, e.g. fakeredis in tests.
+    Redis evicts keys itself under maxmemory, so evictions here stay 0; see INFO stats evicted_keys.
+    """
+
+    name = "redis"
+    # Bucket refill runs server-side on Redis' clock so workers on skewed hosts agree
+    TOKEN_BUCKET_SCRIPT = """
+    local rate, capacity, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local clock = redis.call('TIME')
+    local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    local wait = 0
+    if tokens >= cost then tokens = tokens - cost else wait = (cost - tokens) / rate end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000))
+    return tostring(wait)
+    """
+
+    def __init__(self, client=None):
+        super().__init__()
+        if client is None:
+            # Optional dependency, only needed with STATE_BACKEND=redis
+            import redis.asyncio
+            client = redis.asyncio.Redis.from_url(REDIS_URL)
+        self.client = client
+        self.channel = f"{STATE_KEY_PREFIX}events"
+        self.take_script = client.register_script(self.TOKEN_BUCKET_SCRIPT)
+        self.listener: Optional[asyncio.Task] = None
+
+    async def start(self, on_message: Callable[[str, Any], None]) -> None:
+        await super().start(on_message)
+        await self.client.ping()
+        self.listener = asyncio.create_task(self.listen())
+
+    async def close(self) -> None:
+        if self.listener is not None:
+            # A cancel that lands as a pub/sub read completes can be swallowed (asyncio.wait_for before
+            # Python 3.12), leaving the listener running; cancel again until it has stopped
+            while not self.listener.done():
+                self.listener.cancel()
+                await asyncio.wait({self.listener}, timeout=0.1)
+        await self.client.aclose()
+
+    async def listen(self) -> None:
+        while True:
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(self.channel)
+                async for item in pubsub.listen():
+                    origin, channel, message = orjson.loads(item["data"])
+                    if origin != self.origin:
+                        self.received += 1
+                        self.deliver(channel, message)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Redis subscription failed; resubscribing")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def load(self, key: str) -> Any:
+        raw = await self.client.get(STATE_KEY_PREFIX + key)
+        return None if raw is None else orjson.loads(raw)
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        raw = orjson.dumps(value, default=orjson_default, option=JSON_OPTIONS)
+        await self.client.set(STATE_KEY_PREFIX + key, raw, px=max(1, int(ttl * 1000)))
+
+    async def delete(self, key: str) -> None:
+        await self.client.delete(STATE_KEY_PREFIX + key)
+
+    async def take_tokens(self, key: str, rate: float, capacity: float, cost: float = 1.0) -> float:
+        return float(await self.take_script(keys=[STATE_KEY_PREFIX + key], args=[rate, capacity, cost]))
+
+    async def broadcast(self, channel: str, message: Any) -> None:
+        await self.client.publish(
+            self.channel, orjson.dumps([self.origin, channel, message], default=orjson_default, option=JSON_OPTIONS)
+        )
+
+def make_state_backend() -> StateBackend:
+    if STATE_BACKEND == "local":
+        return LocalStateBackend(STATE_LOCAL_MAX_KEYS)
+    if STATE_BACKEND == "shm":
+        return SharedMemoryStateBackend(
+            STATE_SHM_NAME, STATE_SHM_SLOTS, STATE_SHM_SLOT_BYTES, STATE_SHM_RING_SLOTS, STATE_SHM_MESSAGE_BYTES
+        )
+    if STATE_BACKEND == "redis":
+        return RedisStateBackend()
+    raise ValueError(f"Unknown STATE_BACKEND {STATE_BACKEND!r}, expected local, shm or redis")
+
+# Replaced by the configured backend in start_services()
+state: StateBackend = LocalStateBackend(STATE_LOCAL_MAX_KEYS)
+
+def principal_key(user_id: str) -> str:
+    return f"principal:{user_id}"
+
+async def invalidate_principal(user_id: str) -> None:
+    # Call after any write that changes a user's profile, password or is_active flag
+    await state.delete(principal_key(user_id))
+
+# Mongo client
+# PoolMonitor follows pymongo's connection pool events so /health/ready can report how close each
+# server's pool is to MONGO_MAX_POOL_SIZE. Its callbacks run on pymongo's threads, hence the lock.
+# Servers are reported by the order they were first seen, not by host:port, so the public readiness
+# probe and /metrics do not reveal database hostnames.
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.servers: Dict[Any, str] = {}
+        self.open: Dict[str, int] = {}
+        self.checked_out: Dict[str, int] = {}
+        self.peak_checked_out = 0
+        self.checkout_failures = 0
+        self.pool_clears = 0
+
+    def _add(self, counts: Dict[str, int], event, delta: int) -> int:
+        with self._lock:
+            server = self.servers.setdefault(event.address, str(len(self.servers)))
+            counts[server] = counts.get(server, 0) + delta
+            return counts[server]
+
+    def connection_created(self, event):
+        self._add(self.open, event, 1)
+
+    def connection_closed(self, event):
+        self._add(self.open, event, -1)
+
+    def connection_checked_out(self, event):
+        self.peak_checked_out = max(self.peak_checked_out, self._add(self.checked_out, event, 1))
+
+    def connection_checked_in(self, event):
+        self._add(self.checked_out, event, -1)
+
+    def connection_check_out_failed(self, event):
+        self.checkout_failures += 1
+
+    def pool_cleared(self, event):
+        self.pool_clears += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            checked_out = dict(self.checked_out)
+            open_connections = dict(self.open)
+        return {
+            "max_pool_size": MONGO_MAX_POOL_SIZE,
+            "min_pool_size": MONGO_MIN_POOL_SIZE,
+            "open": open_connections,
+            "checked_out": checked_out,
+            "saturation": max(checked_out.values(), default=0) / MONGO_MAX_POOL_SIZE,
+            "peak_checked_out": self.peak_checked_out,
+            "checkout_failures": self.checkout_failures,
+            "pool_clears": self.pool_clears,
+        }
+
+pool_monitor = PoolMonitor()
+
+# Times every command Motor sends (find for find_one, update for update_one, ...) by collection, from
+# pymongo's own round-trip measurement
+mongo_command_seconds = Histogram(
+    "mongo_command_duration_seconds", "MongoDB command latency", ("collection", "command", "outcome")
+)
+
+class CommandTimer(monitoring.CommandListener):
+    def __init__(self):
+        self.pending: Dict[tuple, tuple] = {}
+
+    def started(self, event):
+        target = event.command.get("collection") if event.command_name == "getMore" else event.command.get(event.command_name)
+        self.pending[(event.connection_id, event.request_id)] = (target if isinstance(target, str) else "", event.command_name)
+
+    def finished(self, event, outcome: str) -> None:
+        labels = self.pending.pop((event.connection_id, event.request_id), None)
+        if labels is not None:
+            mongo_command_seconds.observe(labels + (outcome,), event.duration_micros / 1e6)
+
+    def succeeded(self, event):
+        self.finished(event, "ok")
+
+    def failed(self, event):
+        self.finished(event, "error")
+
+command_timer = CommandTimer()
+
+def make_mongo_client() -> AsyncIOMotorClient:
+    return AsyncIOMotorClient(
+        mongo_url,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+        connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+        waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        readPreference=MONGO_READ_PREFERENCE,
+        event_listeners=[pool_monitor, command_timer],
+    )
+
+async def warm_mongo_pool() -> None:
+    # Concurrent pings each hold their own connection, so minPoolSize connections are open before the
+    # first request instead of being dialled by it
+    await asyncio.gather(*[db.command("ping") for _ in range(max(MONGO_MIN_POOL_SIZE, 1))])
+
+# Indexes
+# Every collection declares its indexes here; ensure_indexes() reconciles them at startup.
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "workflows": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("created_by", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="owner_created_at"),
+        IndexModel([("wake_at", ASCENDING)], name="wake_at"),
+    ],
+    "jobs": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("visible_at", ASCENDING)], name="visible_at"),
+        IndexModel([("key", ASCENDING)], name="key_unique",
+                   unique=True, partialFilterExpression={"key": {"$type": "string"}}),
+    ],
+    "dead_jobs": [
+        IndexModel([("dead_at", DESCENDING)], name="dead_at"),
+    ],
+    "tasks": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("assignee_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="assignee_created_at"),
+        IndexModel([("workflow_id", ASCENDING), ("step_id", ASCENDING)], name="workflow_step"),
+    ],
+    "documents": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel(
+            [("created_by", ASCENDING), ("folder_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+            name="owner_folder_created_at",
+        ),
+        # Searches always filter on the owner, so the text index is partitioned by created_by
+        IndexModel([("created_by", ASCENDING), ("filename", TEXT), ("tags", TEXT), ("content", TEXT)],
+                   name="owner_text", weights={"filename": 10, "tags": 5, "content": 1}),
+        IndexModel([("sha256", ASCENDING)], name="sha256"),
+    ],
+    "document_folders": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("created_by", ASCENDING), ("parent_id", ASCENDING), ("name", ASCENDING)], name="owner_parent"),
+        IndexModel([("created_by", ASCENDING), ("ancestors", ASCENDING)], name="owner_ancestors"),
+    ],
+    "products": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("name", TEXT), ("description", TEXT)], name="name_description_text",
+                   weights={"name": 3, "description": 1}),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_at"),
+        IndexModel([("category", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="category_created_at"),
+        IndexModel([("updated_at", ASCENDING)], name="updated_at"),
+    ],
+    "orders": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("created_by", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="owner_created_at"),
+        IndexModel([("created_by", ASCENDING), ("idempotency_key", ASCENDING)], name="owner_idempotency_key_unique",
+                   unique=True, partialFilterExpression={"idempotency_key": {"$type": "string"}}),
+    ],
+    "chat_rooms": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("participants", ASCENDING), ("created_at", DESCENDING)], name="participants_created_at"),
+    ],
+    "chat_messages": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("room_id", ASCENDING), ("seq", ASCENDING)], name="room_seq_unique", unique=True),
+    ],
+    "blobs": [
+        IndexModel([("sha256", ASCENDING)], name="sha256_unique", unique=True),
+        IndexModel([("refcount", ASCENDING), ("released_at", ASCENDING)], name="refcount_released_at"),
+    ],
+    "metrics": [
+        IndexModel([("meta.owner", ASCENDING), ("meta.name", ASCENDING), ("timestamp", DESCENDING)], name="owner_name_timestamp"),
+        IndexModel([("meta.owner", ASCENDING), ("timestamp", DESCENDING)], name="owner_timestamp"),
+    ],
+    "metric_buckets": [
+        IndexModel([("owner", ASCENDING), ("name", ASCENDING), ("start", DESCENDING)], name="owner_name_start"),
+        IndexModel([("owner", ASCENDING), ("start", DESCENDING)], name="owner_start"),
+    ],
+    "analytics_widgets": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("created_by", ASCENDING), ("created_at", ASCENDING)], name="owner_created_at"),
+    ],
+    "metric_rollups": [
+        IndexModel([("owner", ASCENDING), ("name", ASCENDING), ("resolution", ASCENDING), ("start", ASCENDING)],
+                   name="series_resolution_start", unique=True),
+    ],
+    "revoked_tokens": [
+        IndexModel([("digest", ASCENDING)], name="digest_unique", unique=True),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+}
+
+# Hot queries that must be index-backed; checked with explain() after the indexes are built.
+HOT_QUERIES: List[tuple] = [
+    ("users", {"email": "probe@example.com"}, None),
+    ("users", {"id": "probe"}, None),
+    ("workflows", {"created_by": "probe"}, [("created_at", DESCENDING), ("id", DESCENDING)]),
+    ("workflows", {"status": "active", "wake_at": {"$lte": datetime(2000, 1, 1)}}, [("wake_at", ASCENDING)]),
+    ("jobs", {"visible_at": {"$lte": datetime(2000, 1, 1)}}, [("visible_at", ASCENDING)]),
+    ("tasks", {"assignee_id": "probe"}, [("created_at", DESCENDING), ("id", DESCENDING)]),
+    ("documents", {"created_by": "probe", "$text": {"$search": "probe"}}, None),
+    ("documents", {"created_by": "probe", "folder_id": None}, [("created_at", DESCENDING), ("id", DESCENDING)]),
+    ("document_folders", {"created_by": "probe"}, None),
+    ("document_folders", {"created_by": "probe", "parent_id": None}, [("name", ASCENDING)]),
+    ("document_folders", {"created_by": "probe", "ancestors": "probe"}, None),
+    ("products", {"category": "probe"}, [("created_at", DESCENDING), ("id", DESCENDING)]),
+    ("products", {"updated_at": {"$gte": datetime(2000, 1, 1)}}, [("updated_at", ASCENDING)]),
+    ("orders", {"created_by": "probe"}, [("created_at", DESCENDING), ("id", DESCENDING)]),
+    ("chat_rooms", {"participants": "probe"}, [("created_at", DESCENDING)]),
+    ("chat_messages", {"room_id": "probe", "seq": {"$gt": 0}}, [("seq", ASCENDING)]),
+    ("blobs", {"sha256": "probe"}, None),
+    ("metric_rollups", {"owner": "probe", "name": "probe", "resolution": "1m"}, [("start", ASCENDING)]),
+]
+
+# Indexes dropped from INDEXES, by collection. ensure_indexes() only drops indexes it manages (those
+# declared above and those listed here), so indexes added by hand and the ones MongoDB creates for
+# time-series collections are left alone.
+RETIRED_INDEXES: Dict[str, List[str]] = {
+    "chat_messages": ["room_timestamp"],
+}
+
+# The server fills in every collation option; those left at their ICU defaults are dropped so a
+# declared collation compares equal to what the server reports for it
+COLLATION_DEFAULTS = {"caseLevel": False, "caseFirst": "off", "strength": 3, "numericOrdering": False,
+                      "alternate": "non-ignorable", "maxVariable": "punct", "normalization": False,
+                      "backwards": False}
+
+def _index_spec(info: Dict[str, Any]) -> tuple:
+    key = info["key"]
+    pairs = key.items() if hasattr(key, "items") else key
+    # The server reports text indexes as _fts/_ftsx keys plus a weights document, so text fields are
+    # compared by their weights instead
+    weights = info.get("weights")
+    collation = {option: value for option, value in (info.get("collation") or {}).items()
+                 if option != "version" and COLLATION_DEFAULTS.get(option, object()) != value}
+    return (
+        [(field, int(direction)) for field, direction in pairs if direction != TEXT and field not in ("_fts", "_ftsx")],
+        sorted(weights.items()) if weights else None,
+        bool(info.get("unique", False)),
+        info.get("expireAfterSeconds"),
+        info.get("partialFilterExpression"),
+        None if collation.get("locale", "simple") == "simple" else sorted(collation.items()),
+    )
+
+# Every gunicorn worker runs ensure_indexes() at boot, so another worker may drop or create the same
+# index between our index_information() and our own drop/create. Those races surface as these codes.
+INDEX_RACE_CODES = {27: "IndexNotFound", 85: "IndexOptionsConflict", 86: "IndexKeySpecsConflict"}
+INDEX_SYNC_ATTEMPTS = 3
+
+async def sync_collection_indexes(collection, models: List[IndexModel]) -> None:
+    existing = await collection.index_information()
+    declared = {m.document["name"]: m for m in models}
+    retired = set(RETIRED_INDEXES.get(collection.name, ()))
+    for name, info in existing.items():
+        if name not in declared and name not in retired:
+            continue
+        model = declared.get(name)
+        if model is None or _index_spec(info) != _index_spec(model.document):
+            logger.info(f"Dropping index {collection.name}.{name}")
+            await collection.drop_index(name)
+    current = await collection.index_information()
+    missing = [m for name, m in declared.items() if name not in current]
+    if missing:
+        logger.info(f"Creating indexes on {collection.name}: {[m.document['name'] for m in missing]}")
+        await collection.create_indexes(missing)
+
+async def ensure_indexes(database) -> None:
+    for collection_name, models in INDEXES.items():
+        for attempt in range(1, INDEX_SYNC_ATTEMPTS + 1):
+            try:
+                await sync_collection_indexes(database[collection_name], models)
+                break
+            except OperationFailure as exc:
+                if exc.code not in INDEX_RACE_CODES or attempt == INDEX_SYNC_ATTEMPTS:
+                    raise
+                # Another worker got there first; re-read the indexes and reconcile against its result
+                logger.info(f"Index sync on {collection_name} raced another worker ({INDEX_RACE_CODES[exc.code]}), retrying")
+
+def _plan_stages(plan: Any) -> List[str]:
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(_plan_stages(value))
+    return stages
+
+async def check_hot_queries(database) -> None:
+    failures = []
+    for collection_name, query, sort in HOT_QUERIES:
+        cursor = database[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = (await cursor.explain()).get("queryPlanner", {}).get("winningPlan", {})
+        if "COLLSCAN" in _plan_stages(plan):
+            failures.append(f"{collection_name} {query}")
+    if failures:
+        raise RuntimeError(f"Hot queries fall back to COLLSCAN: {failures}")
+
 # Auth helpers
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
@@ -101,79 +1453,2843 @@ def hash_password(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
+# bcrypt releases the GIL, so a thread pool runs hashes in parallel without blocking the event loop
+def make_password_executor():
+    if BCRYPT_POOL == 'process':
+        return ProcessPoolExecutor(max_workers=BCRYPT_WORKERS)
+    return ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+
+password_executor = None
+password_jobs_pending = 0
+# Includes time queued for a pool worker, which is what a login actually waits on
+password_seconds = Histogram("bcrypt_duration_seconds", "Password hashing and verification time", ("op",))
+
+async def run_password_job(fn, *args):
+    global password_jobs_pending
+    if password_jobs_pending >= BCRYPT_MAX_PENDING:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Authentication service is busy, please retry",
+            headers={"Retry-After": "1"},
+        )
+    password_jobs_pending += 1
+    start = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, fn, *args)
+    finally:
+        password_jobs_pending -= 1
+        password_seconds.observe((fn.__name__.removesuffix("_password"),), time.perf_counter() - start)
+
+async def hash_password_async(password: str) -> str:
+    return await run_password_job(hash_password, password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await run_password_job(verify_password, plain_password, hashed_password)
+
+# Auth rate limiting
+# Token buckets live in the state backend, so the limits hold across workers and each key costs one
+# bounded entry (evicted LRU locally, by TTL in shm and Redis). A failing backend lets requests through
+# rather than locking everyone out; password_jobs still caps the hashing load.
+auth_rate_stats = {"allowed": 0, "rejected_ip": 0, "rejected_email": 0, "errors": 0}
+
+def is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in AUTH_TRUSTED_PROXIES)
+
+def client_ip(request: Request) -> str:
+    # Walks X-Forwarded-For from the right past trusted proxies. Entries further left were supplied by
+    # the client and could be rotated to dodge the limit, so they are never used.
+    address = request.client.host if request.client else "unknown"
+    forwarded = [item.strip() for item in request.headers.get("x-forwarded-for", "").split(",") if item.strip()]
+    hops = 0
+    while forwarded and (hops < AUTH_TRUSTED_PROXY_HOPS or is_trusted_proxy(address)):
+        address = forwarded.pop()
+        hops += 1
+    return address
+
+async def enforce_auth_rate_limit(scope: str, request: Request, email: str) -> None:
+    if not AUTH_RATE_LIMIT_ENABLED:
+        return
+    ip = client_ip(request)
+    try:
+        wait = await state.take_tokens(f"rate:{scope}:ip:{ip}", AUTH_IP_RATE_PER_MINUTE / 60, AUTH_IP_BURST)
+        rejected = "rejected_ip"
+        if not wait:
+            wait = await state.take_tokens(
+                f"rate:{scope}:email:{email.lower()}", AUTH_EMAIL_RATE_PER_MINUTE / 60, AUTH_EMAIL_BURST
+            )
+            rejected = "rejected_email"
+    except Exception:
+        auth_rate_stats["errors"] += 1
+        logger.exception("Auth rate limit check failed; allowing request")
+        return
+    if wait:
+        auth_rate_stats[rejected] += 1
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many attempts, please retry later",
+            headers={"Retry-After": str(math.ceil(wait))},
+        )
+    auth_rate_stats["allowed"] += 1
+
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(hours=JWT_EXPIRATION_HOURS)
     to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    return jwt.encode(to_encode, JWT_KEYS[JWT_ACTIVE_KID], algorithm=JWT_ALGORITHM, headers={"kid": JWT_ACTIVE_KID})
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def token_digest(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def decode_access_token(token: str) -> Dict[str, Any]:
+    kid = jwt.get_unverified_header(token).get("kid", "default")
+    key = JWT_KEYS.get(kid)
+    if key is None:
+        raise jwt.InvalidKeyError(f"Unknown key id {kid!r}")
+    # Tokens without exp would otherwise never expire (and could not be cached or revoked by expiry)
+    return jwt.decode(token, key, algorithms=[JWT_ALGORITHM], options={"require": ["exp", "sub"]})
+
+def verify_access_token(token: str) -> str:
+    # Returns the user id; a cache hit skips signature verification entirely
+    digest = token_digest(token)
+    if digest in revoked_tokens:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has been revoked")
+    user_id = token_cache.get(digest)
+    if user_id is not None:
+        return user_id
     try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
+        payload = decode_access_token(token)
     except jwt.PyJWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
+    user_id, expires_at = payload.get("sub"), payload.get("exp")
+    if not isinstance(user_id, str) or not isinstance(expires_at, (int, float)):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
+    # Never cache a token past its own expiry
+    token_cache.set(digest, user_id, min(TOKEN_CACHE_TTL_SECONDS, expires_at - time.time()))
+    return user_id
+
+async def revoke_access_token(token: str) -> None:
+    payload = decode_access_token(token)
+    digest = token_digest(token)
+    await db.revoked_tokens.update_one(
+        {"digest": digest},
+        {"$set": {"digest": digest, "expires_at": datetime.utcfromtimestamp(payload["exp"])}},
+        upsert=True,
+    )
+    # Other workers may hold the token in their verified-token cache
+    await state.publish(f"revoked:{digest}", payload["exp"])
+
+def forget_revoked_token(digest: str, exp: float) -> None:
+    revoked_tokens[digest] = exp
+    token_cache.invalidate(digest)
+    global revoked_tokens_prune_at
+    if len(revoked_tokens) >= revoked_tokens_prune_at:
+        now = time.time()
+        for expired in [d for d, exp in revoked_tokens.items() if exp <= now]:
+            del revoked_tokens[expired]
+        revoked_tokens_prune_at = max(1024, 2 * len(revoked_tokens))
+
+async def load_revoked_tokens(database) -> None:
+    async for doc in database.revoked_tokens.find({"expires_at": {"$gt": datetime.utcnow()}}, {"_id": 0}):
+        revoked_tokens[doc["digest"]] = doc["expires_at"].replace(tzinfo=timezone.utc).timestamp()
+
+async def load_principal(user_id: str) -> User:
+    cached = await state.get(principal_key(user_id))
+    if cached is not None:
+        user = User.model_validate(cached)
+    else:
+        user_doc = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
+        if user_doc is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
+        user = User(**user_doc)
+        await state.set(principal_key(user_id), user.dict(), PRINCIPAL_CACHE_TTL_SECONDS)
+    if not user.is_active:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Account is deactivated")
+    return user
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return await load_principal(verify_access_token(credentials.credentials))
 
-    user = await db.users.find_one({"id": user_id})
-    if user is None:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
-    return User(**user)
+async def get_admin_user(current_user: User = Depends(get_current_user)):
+    if not current_user.role.admin:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return current_user
 
 # Auth routes
+def user_response(user: User) -> UserResponse:
+    # User and UserResponse share their fields, so skip re-validating an already validated model
+    return UserResponse.model_construct(**dict(user))
+
 @api_router.post("/auth/register", response_model=Token)
-async def register_user(user_data: UserCreate):
-    existing_user = await db.users.find_one({"email": user_data.email})
-    if existing_user:
-        raise HTTPException(status_code=400, detail="Email already registered")
-    hashed = hash_password(user_data.password)
+async def register_user(user_data: UserCreate, request: Request):
+    await enforce_auth_rate_limit("register", request, user_data.email)
+    hashed = await hash_password_async(user_data.password)
     user = User(
         email=user_data.email,
         full_name=user_data.full_name,
         company=user_data.company,
-        phone=user_data.phone
+        phone=user_data.phone,
+        last_login=datetime.utcnow()
     )
-    user_dict = user.dict()
-    user_dict["password"] = hashed
-    await db.users.insert_one(user_dict)
+    try:
+        await db.users.insert_one({**user.dict(), "password": hashed})
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    await state.set(principal_key(user.id), user.dict(), PRINCIPAL_CACHE_TTL_SECONDS)
     access_token = create_access_token({"sub": user.id})
-    await db.users.update_one({"id": user.id}, {"$set": {"last_login": datetime.utcnow()}})
-    return Token(access_token=access_token, token_type="bearer", user=UserResponse(**user.dict()))
+    return json_response(Token.model_construct(access_token=access_token, token_type="bearer", user=user_response(user)))
 
 @api_router.post("/auth/login", response_model=Token)
-async def login_user(login_data: UserLogin):
-    user_doc = await db.users.find_one({"email": login_data.email})
-    if not user_doc or not verify_password(login_data.password, user_doc["password"]):
+async def login_user(login_data: UserLogin, request: Request):
+    await enforce_auth_rate_limit("login", request, login_data.email)
+    user_doc = await db.users.find_one({"email": login_data.email}, {"_id": 0})
+    if not user_doc or not await verify_password_async(login_data.password, user_doc.pop("password")):
         raise HTTPException(status_code=401, detail="Invalid email or password")
     if not user_doc.get("is_active", True):
         raise HTTPException(status_code=401, detail="Account is deactivated")
-    access_token = create_access_token({"sub": user_doc["id"]})
-    await db.users.update_one({"id": user_doc["id"]}, {"$set": {"last_login": datetime.utcnow()}})
-    return Token(access_token=access_token, token_type="bearer", user=UserResponse(**User(**user_doc).dict()))
+    user = User(**user_doc)
+    access_token = create_access_token({"sub": user.id})
+    await db.users.update_one({"id": user.id}, {"$set": {"last_login": datetime.utcnow()}})
+    await invalidate_principal(user.id)
+    return json_response(Token.model_construct(access_token=access_token, token_type="bearer", user=user_response(user)))
 
 @api_router.get("/auth/me", response_model=UserResponse)
 async def get_current_user_info(current_user: User = Depends(get_current_user)):
-    return UserResponse(**current_user.dict())
+    return json_response(user_response(current_user))
 
 @api_router.put("/auth/me", response_model=UserResponse)
 async def update_current_user(user_update: UserUpdate, current_user: User = Depends(get_current_user)):
     update_data = {k: v for k, v in user_update.dict().items() if v is not None}
     if update_data:
-        await db.users.update_one({"id": current_user.id}, {"$set": update_data})
-        updated_user = await db.users.find_one({"id": current_user.id})
-        return UserResponse(**User(**updated_user).dict())
-    return UserResponse(**current_user.dict())
+        updated_user = await db.users.find_one_and_update(
+            {"id": current_user.id},
+            {"$set": update_data},
+            projection={"_id": 0, "password": 0},
+            return_document=ReturnDocument.AFTER,
+        )
+        await invalidate_principal(current_user.id)
+        return json_response(user_response(User(**updated_user)))
+    return json_response(user_response(current_user))
 
 @api_router.post("/auth/logout")
-async def logout_user():
+async def logout_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    verify_access_token(credentials.credentials)
+    await revoke_access_token(credentials.credentials)
     return {"message": "Successfully logged out"}
 
+# Analytics counters
+# The dashboard reads one pre-aggregated document per user ("user:<id>") from analytics_counters, and
+# admins also the global totals, summed at read time over ANALYTICS_GLOBAL_SHARDS "global:<n>" documents
+# so no single document takes every write. Every write that changes a counted collection $incs the user
+# document and one random shard in one bulk_write; reconcile_analytics() re-derives the counts from the
+# source collections once per ANALYTICS_RECONCILE_INTERVAL_SECONDS through the job queue.
+COUNTER_FIELDS = ("workflows", "tasks", "tasks_completed", "documents", "document_bytes", "orders", "messages")
+ANALYTICS_GLOBAL_SHARDS = 16
+# "global" is the unsharded document written before the shards existed; reconciliation deletes it
+GLOBAL_COUNTER_IDS = ["global", *(f"global:{shard}" for shard in range(ANALYTICS_GLOBAL_SHARDS))]
+RECONCILE_BATCH_SIZE = 1000
+
+async def record_activity(user_id: str, counters: Dict[str, int], action: Optional[str] = None) -> None:
+    # An empty $inc is rejected by servers before 5.0, so action-only updates leave it out
+    increments = {"$inc": counters} if counters else {}
+    user_update: Dict[str, Any] = {**increments, "$set": {"updated_at": datetime.utcnow()}}
+    if action:
+        user_update["$push"] = {"recent_activity": {
+            "$each": [{"action": action, "timestamp": datetime.utcnow()}],
+            "$slice": -ANALYTICS_RECENT_ACTIVITY,
+        }}
+    await db.analytics_counters.bulk_write([
+        UpdateOne({"_id": f"user:{user_id}"}, user_update, upsert=True),
+        UpdateOne(
+            {"_id": f"global:{random.randrange(ANALYTICS_GLOBAL_SHARDS)}"},
+            {**increments, "$set": {"updated_at": datetime.utcnow()}},
+            upsert=True,
+        ),
+    ], ordered=False)
+
+async def global_counters() -> Dict[str, int]:
+    totals = {field: 0 for field in COUNTER_FIELDS}
+    async for shard in db.analytics_counters.find({"_id": {"$in": GLOBAL_COUNTER_IDS}}):
+        for field in COUNTER_FIELDS:
+            totals[field] += shard.get(field, 0)
+    return totals
+
+async def reconcile_analytics() -> None:
+    # Overwrites the counters with fresh aggregates, streamed per source in RECONCILE_BATCH_SIZE writes
+    # that stamp each field with this run's id; fields the run did not stamp belong to users with no
+    # rows left in that source and are zeroed afterwards. Increments that land between the aggregation
+    # and the write are lost until the next run, which is the accepted bound on drift.
+    sources = [
+        ("workflows", db.workflows, "$created_by", {}, {"$sum": 1}),
+        ("tasks", db.tasks, "$assignee_id", {}, {"$sum": 1}),
+        ("tasks_completed", db.tasks, "$assignee_id", {"status": "completed"}, {"$sum": 1}),
+        ("documents", db.documents, "$created_by", {}, {"$sum": 1}),
+        ("document_bytes", db.documents, "$created_by", {}, {"$sum": "$size"}),
+        ("orders", db.orders, "$created_by", {}, {"$sum": 1}),
+        ("messages", db.chat_messages, "$sender_id", {}, {"$sum": 1}),
+    ]
+    run_id = uuid.uuid4().hex
+    totals = {field: 0 for field in COUNTER_FIELDS}
+    for field, collection, group_key, match, accumulator in sources:
+        operations = []
+        async for row in collection.aggregate(
+            [{"$match": match}, {"$group": {"_id": group_key, "n": accumulator}}], allowDiskUse=True
+        ):
+            totals[field] += row["n"]
+            operations.append(UpdateOne(
+                {"_id": f"user:{row['_id']}"}, {"$set": {field: row["n"], f"reconciled.{field}": run_id}}, upsert=True
+            ))
+            if len(operations) >= RECONCILE_BATCH_SIZE:
+                await db.analytics_counters.bulk_write(operations, ordered=False)
+                operations = []
+        if operations:
+            await db.analytics_counters.bulk_write(operations, ordered=False)
+        await db.analytics_counters.update_many(
+            {"_id": {"$regex": "^user:"}, f"reconciled.{field}": {"$ne": run_id}},
+            {"$set": {field: 0, f"reconciled.{field}": run_id}},
+        )
+    await db.analytics_counters.bulk_write([
+        UpdateOne({"_id": "global:0"}, {"$set": {**totals, "reconciled_at": datetime.utcnow()}}, upsert=True),
+        UpdateMany(
+            {"_id": {"$in": [f"global:{shard}" for shard in range(1, ANALYTICS_GLOBAL_SHARDS)]}},
+            {"$set": {field: 0 for field in COUNTER_FIELDS}},
+        ),
+        DeleteOne({"_id": "global"}),
+    ], ordered=True)
+    logger.info(f"Reconciled analytics counters: {totals}")
+
+def dashboard_overview(counters: Dict[str, Any]) -> Dict[str, Any]:
+    overview = {field: counters.get(field, 0) for field in COUNTER_FIELDS}
+    tasks = overview["tasks"]
+    return {
+        "total_workflows": overview["workflows"],
+        "total_tasks": tasks,
+        "completed_tasks": overview["tasks_completed"],
+        "completion_rate": overview["tasks_completed"] / tasks * 100 if tasks else 0.0,
+        "total_documents": overview["documents"],
+        "document_bytes": overview["document_bytes"],
+        "total_orders": overview["orders"],
+        "total_messages": overview["messages"],
+    }
+
+# Metric ingestion
+# Points are appended to an in-process buffer and written with insert_many when METRICS_FLUSH_SIZE
+# points are waiting or every METRICS_FLUSH_INTERVAL_SECONDS. Raw points go to a time-series
+# collection ("metrics") or, where the server has none, to hourly bucket documents ("metric_buckets")
+# of at most METRIC_BUCKET_MAX_POINTS points each (a busy series fills several per hour, well below
+# the 16MB document limit). Each flush also folds the batch into 1m/1h/1d min/max/sum/count rollups
+# in metric_rollups; rollup writes that fail are kept in metric_pending_rollups and retried by the
+# next flush, since the raw points they summarise are already stored.
+ROLLUP_RESOLUTIONS = {"1m": 60, "1h": 3600, "1d": 86400}
+METRIC_BUCKET_MAX_POINTS = 1000
+metric_storage = "timeseries"
+metric_buffer: List[Dict[str, Any]] = []
+metric_pending_rollups: List[tuple] = []
+metric_flush_lock = asyncio.Lock()
+metric_stats = {"buffered": 0, "flushed": 0, "flushes": 0, "rollup_failures": 0, "rollups_dropped": 0}
+# Bumped per owner on every flush; widget results are memoized against it
+metric_versions: Dict[str, int] = {}
+
+async def ensure_metric_storage(database) -> None:
+    global metric_storage
+    if METRICS_STORAGE == "buckets":
+        metric_storage = "buckets"
+        return
+    try:
+        await database.create_collection(
+            "metrics", timeseries={"timeField": "timestamp", "metaField": "meta", "granularity": "seconds"}
+        )
+    except CollectionInvalid:
+        pass
+    except OperationFailure:
+        logger.info("Time-series collections unavailable, storing metrics in hourly buckets")
+        metric_storage = "buckets"
+        return
+    options = await database.command("listCollections", filter={"name": "metrics"})
+    batch = options["cursor"]["firstBatch"]
+    metric_storage = "timeseries" if batch and batch[0].get("type") == "timeseries" else "buckets"
+
+def naive_utc(value: datetime) -> datetime:
+    # Mongo hands back naive UTC datetimes, so aware inputs are normalised to match
+    return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value
+
+def metric_point(metric: MetricCreate, owner: str) -> Dict[str, Any]:
+    return {
+        "id": str(uuid.uuid4()),
+        "timestamp": naive_utc(metric.timestamp) if metric.timestamp else datetime.utcnow(),
+        "value": metric.value,
+        "meta": {"owner": owner, "name": metric.name, "unit": metric.unit, "category": metric.category},
+        "metadata": metric.metadata,
+    }
+
+def point_response(point: Dict[str, Any]) -> Dict[str, Any]:
+    meta = point["meta"]
+    return {"id": point["id"], "name": meta["name"], "value": point["value"], "unit": meta["unit"],
+            "category": meta["category"], "metadata": point.get("metadata", {}), "timestamp": point["timestamp"]}
+
+async def enqueue_metrics(points: List[Dict[str, Any]]) -> None:
+    if len(metric_buffer) + len(points) > METRICS_MAX_BUFFERED:
+        raise HTTPException(status_code=503, detail="Metric ingestion is backlogged, please retry",
+                            headers={"Retry-After": "1"})
+    metric_buffer.extend(points)
+    metric_stats["buffered"] += len(points)
+    if len(metric_buffer) >= METRICS_FLUSH_SIZE:
+        # The points are accepted either way: a failed flush keeps them buffered for the flusher to
+        # retry, so a 500 here would only make the client send them twice
+        try:
+            await flush_metrics()
+        except Exception:
+            logger.exception("Metric flush failed")
+
+def epoch_seconds(values: List[datetime]) -> np.ndarray:
+    return np.array([v.replace(tzinfo=timezone.utc).timestamp() for v in values], dtype=np.float64)
+
+def compute_rollups(points: List[Dict[str, Any]], resolution: int) -> List[Dict[str, Any]]:
+    # Groups points by (owner, name, bucket start) and returns min/max/sum/count per group
+    series_keys: Dict[tuple, int] = {}
+    series = np.array([series_keys.setdefault((p["meta"]["owner"], p["meta"]["name"]), len(series_keys))
+                       for p in points], dtype=np.int64)
+    buckets = (epoch_seconds([p["timestamp"] for p in points]) // resolution).astype(np.int64)
+    values = np.array([p["value"] for p in points], dtype=np.float64)
+    groups, inverse = np.unique(np.stack([series, buckets], axis=1), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    counts = np.bincount(inverse, minlength=len(groups))
+    sums = np.bincount(inverse, weights=values, minlength=len(groups))
+    mins = np.full(len(groups), np.inf)
+    np.minimum.at(mins, inverse, values)
+    maxs = np.full(len(groups), -np.inf)
+    np.maximum.at(maxs, inverse, values)
+    names = {index: key for key, index in series_keys.items()}
+    return [
+        {"owner": names[series_index][0], "name": names[series_index][1],
+         "start": datetime.utcfromtimestamp(int(bucket) * resolution),
+         "min": float(mins[i]), "max": float(maxs[i]), "sum": float(sums[i]), "count": int(counts[i])}
+        for i, (series_index, bucket) in enumerate(groups)
+    ]
+
+def rollup_operations(points: List[Dict[str, Any]]) -> List[tuple]:
+    # (owner, update) pairs, so a retried write knows whose widget results to invalidate
+    operations = []
+    for label, seconds in ROLLUP_RESOLUTIONS.items():
+        for rollup in compute_rollups(points, seconds):
+            key = {"owner": rollup["owner"], "name": rollup["name"], "resolution": label, "start": rollup["start"]}
+            operations.append((rollup["owner"], UpdateOne(key, {
+                "$min": {"min": rollup["min"]},
+                "$max": {"max": rollup["max"]},
+                "$inc": {"sum": rollup["sum"], "count": rollup["count"]},
+            }, upsert=True)))
+    return operations
+
+async def write_rollups(operations: List[tuple]) -> List[tuple]:
+    # Returns the operations that did not apply. A bulk write error names the failed ones; any other
+    # error leaves it unknown, and all of them are retried.
+    try:
+        await db.metric_rollups.bulk_write([update for _, update in operations], ordered=False)
+    except BulkWriteError as exc:
+        failed = {error["index"] for error in exc.details.get("writeErrors", [])}
+        return [operation for i, operation in enumerate(operations) if i in failed]
+    except Exception:
+        logger.exception("Metric rollup write failed")
+        return operations
+    return []
+
+async def write_raw_points(points: List[Dict[str, Any]]) -> None:
+    if metric_storage == "timeseries":
+        await db.metrics.insert_many(points, ordered=False)
+        return
+    buckets: Dict[tuple, List[Dict[str, Any]]] = {}
+    for point in points:
+        start = point["timestamp"].replace(minute=0, second=0, microsecond=0)
+        buckets.setdefault((point["meta"]["owner"], point["meta"]["name"], start), []).append(point)
+    # Each chunk joins a bucket of the hour with room for all of it; when none has room the upsert
+    # starts a new bucket (the count range is not copied into the inserted document)
+    operations = []
+    for (owner, name, start), bucket_points in buckets.items():
+        for i in range(0, len(bucket_points), METRIC_BUCKET_MAX_POINTS):
+            chunk = bucket_points[i:i + METRIC_BUCKET_MAX_POINTS]
+            operations.append(UpdateOne(
+                {"owner": owner, "name": name, "start": start, "count": {"$lte": METRIC_BUCKET_MAX_POINTS - len(chunk)}},
+                {"$push": {"points": {"$each": chunk}}, "$inc": {"count": len(chunk)}},
+                upsert=True,
+            ))
+    await db.metric_buckets.bulk_write(operations, ordered=False)
+
+async def flush_metrics() -> None:
+    global metric_buffer, metric_pending_rollups
+    async with metric_flush_lock:
+        if not metric_buffer and not metric_pending_rollups:
+            return
+        points, metric_buffer = metric_buffer, []
+        if points:
+            try:
+                await write_raw_points(points)
+            except Exception:
+                # Put the batch back so the next flush retries it
+                metric_buffer = points + metric_buffer
+                raise
+            metric_stats["flushed"] += len(points)
+            metric_stats["flushes"] += 1
+        operations = metric_pending_rollups + rollup_operations(points)
+        failed = await write_rollups(operations)
+        if failed:
+            metric_stats["rollup_failures"] += 1
+            logger.warning("%d metric rollup updates failed, retrying on the next flush", len(failed))
+        if len(failed) > METRICS_MAX_BUFFERED:
+            metric_stats["rollups_dropped"] += len(failed) - METRICS_MAX_BUFFERED
+            logger.error("Dropping %d metric rollup updates that keep failing", len(failed) - METRICS_MAX_BUFFERED)
+            failed = failed[-METRICS_MAX_BUFFERED:]
+        metric_pending_rollups = failed
+        for owner in {owner for owner, _ in operations}:
+            metric_versions[owner] = metric_versions.get(owner, 0) + 1
+
+async def run_metric_flusher() -> None:
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL_SECONDS)
+        try:
+            await flush_metrics()
+        except Exception:
+            logger.exception("Metric flush failed")
+
+async def recent_metrics(owner: str, limit: int) -> List[Dict[str, Any]]:
+    # Includes points still waiting in the buffer so a client sees its own writes immediately
+    pending = [p for p in metric_buffer if p["meta"]["owner"] == owner]
+    if metric_storage == "timeseries":
+        stored = await db.metrics.find({"meta.owner": owner}, {"_id": 0}).sort("timestamp", DESCENDING).limit(limit).to_list(limit)
+    else:
+        stored = []
+        async for bucket in db.metric_buckets.find({"owner": owner}, {"_id": 0, "points": 1}).sort("start", DESCENDING):
+            stored.extend(bucket["points"])
+            if len(stored) >= limit:
+                break
+    points = sorted(pending + stored, key=lambda p: p["timestamp"], reverse=True)[:limit]
+    return [point_response(p) for p in points]
+
+async def raw_series(owner: str, name: str, start: datetime, end: datetime) -> tuple:
+    if metric_storage == "timeseries":
+        points = await db.metrics.find(
+            {"meta.owner": owner, "meta.name": name, "timestamp": {"$gte": start, "$lt": end}},
+            {"_id": 0, "timestamp": 1, "value": 1},
+        ).sort("timestamp", DESCENDING).limit(METRICS_MAX_POINTS + 1).to_list(METRICS_MAX_POINTS + 1)
+    else:
+        first_bucket = start.replace(minute=0, second=0, microsecond=0)
+        points = []
+        async for bucket in db.metric_buckets.find(
+            {"owner": owner, "name": name, "start": {"$gte": first_bucket, "$lt": end}}, {"_id": 0, "points": 1}
+        ).sort("start", ASCENDING):
+            points.extend(p for p in bucket["points"] if start <= p["timestamp"] < end)
+        points = sorted(points, key=lambda p: p["timestamp"], reverse=True)[:METRICS_MAX_POINTS + 1]
+    # Newest first, so a range with more than METRICS_MAX_POINTS points loses its oldest ones
+    truncated = len(points) > METRICS_MAX_POINTS
+    points = [{"timestamp": p["timestamp"], "value": p["value"]} for p in points[:METRICS_MAX_POINTS]]
+    return points[::-1], truncated
+
+async def rollup_series(owner: str, name: str, resolution: str, start: datetime, end: datetime) -> tuple:
+    rows = await db.metric_rollups.find(
+        {"owner": owner, "name": name, "resolution": resolution, "start": {"$gte": start, "$lt": end}},
+        {"_id": 0, "start": 1, "min": 1, "max": 1, "sum": 1, "count": 1},
+    ).sort("start", DESCENDING).limit(METRICS_MAX_POINTS + 1).to_list(METRICS_MAX_POINTS + 1)
+    truncated = len(rows) > METRICS_MAX_POINTS
+    points = [{"timestamp": r["start"], "min": r["min"], "max": r["max"], "avg": r["sum"] / r["count"], "count": r["count"]}
+              for r in rows[:METRICS_MAX_POINTS]]
+    return points[::-1], truncated
+
+def pick_resolution(step_seconds: float, span_seconds: float = 0) -> Optional[str]:
+    # Coarsest rollup whose buckets are no wider than the requested step; None means raw points.
+    # A rollup that would need more than METRICS_MAX_POINTS buckets to cover the span is skipped
+    # for the next coarser one.
+    chosen = None
+    for label, seconds in ROLLUP_RESOLUTIONS.items():
+        if seconds <= step_seconds or (chosen is not None and span_seconds / ROLLUP_RESOLUTIONS[chosen] > METRICS_MAX_POINTS):
+            chosen = label
+    return chosen
+
+# Widget evaluation
+# Query widgets are evaluated together: their rollups are fetched with one $in query per rollup
+# resolution, then each widget is resampled from the shared frame with pandas. Results are memoized
+# per (owner, query, metric data version) for WIDGET_CACHE_TTL_SECONDS.
+widget_cache = TTLCache(WIDGET_CACHE_SIZE, WIDGET_CACHE_TTL_SECONDS)
+ROLLUP_COLUMNS = ["name", "start", "min", "max", "sum", "count"]
+
+def widget_cache_key(owner: str, query: WidgetQuery) -> str:
+    version = metric_versions.get(owner, 0)
+    return f"{owner}:{version}:{query.metric}:{query.aggregation}:{query.window}:{query.step}"
+
+def aggregate_widget(frame: pd.DataFrame, query: WidgetQuery, now: datetime) -> Dict[str, Any]:
+    rows = frame[(frame["name"] == query.metric) & (frame["start"] >= now - timedelta(seconds=query.window))]
+    if rows.empty:
+        return {"labels": [], "values": []}
+    buckets = rows.set_index("start").resample(f"{query.step}s").agg(
+        {"min": "min", "max": "max", "sum": "sum", "count": "sum"}
+    )
+    buckets = buckets[buckets["count"] > 0]
+    if query.aggregation == "avg":
+        values = buckets["sum"] / buckets["count"]
+    else:
+        values = buckets[query.aggregation]
+    return {
+        "labels": [label.isoformat() for label in buckets.index.to_pydatetime()],
+        "values": values.astype(float).round(6).tolist(),
+    }
+
+async def evaluate_widget_queries(owner: str, queries: List[WidgetQuery]) -> List[Dict[str, Any]]:
+    results: List[Optional[Dict[str, Any]]] = [widget_cache.get(widget_cache_key(owner, q)) for q in queries]
+    pending: Dict[str, List[int]] = {}
+    for index, query in enumerate(queries):
+        if results[index] is None:
+            pending.setdefault(pick_resolution(query.step, query.window), []).append(index)
+    now = datetime.utcnow()
+    for resolution, indexes in pending.items():
+        names = sorted({queries[i].metric for i in indexes})
+        start = now - timedelta(seconds=max(queries[i].window for i in indexes))
+        rows = await db.metric_rollups.find(
+            {"owner": owner, "name": {"$in": names}, "resolution": resolution, "start": {"$gte": start}},
+            {"_id": 0, **{column: 1 for column in ROLLUP_COLUMNS}},
+        ).to_list(None)
+        frame = pd.DataFrame(rows, columns=ROLLUP_COLUMNS)
+        frame["start"] = pd.to_datetime(frame["start"])
+        for i in indexes:
+            results[i] = aggregate_widget(frame, queries[i], now)
+            widget_cache.set(widget_cache_key(owner, queries[i]), results[i])
+    return results
+
+# Pagination
+# List endpoints page by keyset on (created_at, id) descending and return the next cursor in the
+# X-Next-Cursor header, so responses stay plain JSON arrays.
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+MAX_FOLDERS = 1000
+MAX_FOLDER_DEPTH = 32
+
+def encode_cursor(doc: Dict[str, Any]) -> str:
+    raw = json.dumps([doc["created_at"].isoformat(), doc["id"]]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        created_at, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), doc_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def fetch_page(collection, query: Dict[str, Any], projection: Dict[str, Any], limit: int,
+                     cursor: Optional[str], response: Response) -> List[Dict[str, Any]]:
+    if cursor:
+        created_at, doc_id = decode_cursor(cursor)
+        query = {**query, "$or": [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": doc_id}},
+        ]}
+    docs = await collection.find(query, projection).sort(
+        [("created_at", DESCENDING), ("id", DESCENDING)]
+    ).limit(limit + 1).to_list(limit + 1)
+    if len(docs) > limit:
+        docs = docs[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(docs[-1])
+    return docs
+
+# Workflow routes
+WORKFLOW_SUMMARY_PROJECTION = {
+    "_id": 0, "steps": 0, "updated_at": 0, "current_order": 0,
+    "wake_at": 0, "wake_seq": 0, "lease_owner": 0, "lease_expires_at": 0,
+}
+
+@api_router.post("/workflows", response_model=Workflow)
+async def create_workflow(workflow_data: WorkflowCreate, current_user: User = Depends(get_current_user)):
+    # Task ids are fixed up front so the scheduler can materialize a step's tasks idempotently
+    steps = [
+        WorkflowStep(**step.dict(), task_ids=[str(uuid.uuid4()) for _ in range(step.required_approvals)])
+        for step in sorted(workflow_data.steps, key=lambda step: step.order)
+    ]
+    workflow = Workflow(
+        name=workflow_data.name,
+        description=workflow_data.description,
+        steps=steps,
+        step_count=len(steps),
+        created_by=current_user.id
+    )
+    await db.workflows.insert_one({
+        **workflow.dict(), "wake_at": workflow.created_at, "wake_seq": 0,
+        "lease_owner": None, "lease_expires_at": LEASE_RELEASED,
+    })
+    await record_activity(current_user.id, {"workflows": 1}, f"Created workflow {workflow.name}")
+    await wake_workflow_scheduler()
+    return workflow
+
+@api_router.get("/workflows", response_model=List[WorkflowSummary])
+async def list_workflows(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+):
+    workflows = await fetch_page(db.workflows, {"created_by": current_user.id}, WORKFLOW_SUMMARY_PROJECTION,
+                                 limit, cursor, response)
+    return json_response(workflows, headers=response.headers)
+
+@api_router.get("/workflows/{workflow_id}", response_model=Workflow)
+async def get_workflow(workflow_id: str, current_user: User = Depends(get_current_user)):
+    workflow = await db.workflows.find_one({"id": workflow_id, "created_by": current_user.id}, {"_id": 0})
+    if workflow is None:
+        raise HTTPException(status_code=404, detail="Workflow not found")
+    return workflow
+
+# Task routes
+@api_router.post("/tasks", response_model=Task)
+async def create_task(task_data: TaskCreate, current_user: User = Depends(get_current_user)):
+    task = Task(**task_data.dict(exclude={"assignee_id"}),
+                assignee_id=task_data.assignee_id or current_user.id,
+                created_by=current_user.id)
+    await db.tasks.insert_one(task.dict())
+    await record_activity(task.assignee_id, {"tasks": 1}, f"Task assigned: {task.title}")
+    return task
+
+@api_router.get("/tasks", response_model=List[Task])
+async def list_tasks(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+):
+    tasks = await fetch_page(db.tasks, {"assignee_id": current_user.id}, {"_id": 0}, limit, cursor, response)
+    return json_response(tasks, headers=response.headers)
+
+@api_router.get("/tasks/{task_id}", response_model=Task)
+async def get_task(task_id: str, current_user: User = Depends(get_current_user)):
+    task = await db.tasks.find_one(
+        {"id": task_id, "$or": [{"assignee_id": current_user.id}, {"created_by": current_user.id}]},
+        {"_id": 0},
+    )
+    if task is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+    return task
+
+@api_router.put("/tasks/{task_id}", response_model=Task)
+async def update_task(task_id: str, task_update: TaskUpdate, current_user: User = Depends(get_current_user)):
+    update_data = {k: v for k, v in task_update.dict().items() if v is not None}
+    if update_data.get("status", "pending") not in TASK_STATUSES:
+        raise HTTPException(status_code=400, detail=f"Invalid status, expected one of {', '.join(TASK_STATUSES)}")
+    update_data["updated_at"] = datetime.utcnow()
+    # Read the previous state in the same atomic update so the completed counter moves exactly once
+    previous = await db.tasks.find_one_and_update(
+        {"id": task_id, "$or": [{"assignee_id": current_user.id}, {"created_by": current_user.id}]},
+        {"$set": update_data},
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE,
+    )
+    if previous is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+    task = {**previous, **update_data}
+    completed = (task["status"] == "completed") - (previous["status"] == "completed")
+    if completed:
+        action = f"Completed task {task['title']}" if completed > 0 else None
+        await record_activity(task["assignee_id"], {"tasks_completed": completed}, action)
+    rejected = (task["status"] == "rejected") - (previous["status"] == "rejected")
+    if (completed or rejected) and task.get("workflow_id") and task.get("step_id"):
+        await record_step_decision(task, completed, rejected)
+    return task
+
+# Workflow runtime
+# Workflows advance one order at a time: every step sharing the lowest unfinished order becomes active
+# together, each gets one task per required approval, and the next order starts once they have all
+# collected their approvals. Any rejected task rejects its step and the workflow. Handlers only record
+# decisions (atomic $inc on the step) and mark the workflow due; a scheduler pass that holds the
+# workflow's lease makes every state transition, so two workers never advance the same workflow.
+# Waiting workflows live only in Mongo, so a process can drive any number of them.
+LEASE_RELEASED = datetime(1970, 1, 1)
+# Created in start_services() so it belongs to the serving event loop
+workflow_wakeup: Optional[asyncio.Event] = None
+workflow_runs: set = set()
+workflow_stats = {"advanced": 0, "tasks_materialized": 0, "completed": 0, "rejected": 0, "lease_conflicts": 0, "errors": 0}
+
+async def wake_workflow_scheduler() -> None:
+    await state.publish("workflow:wake", None)
+
+async def record_step_decision(task: Dict[str, Any], approvals: int, rejections: int) -> None:
+    # Only counts tasks the scheduler materialized for the step, and only while the step is undecided
+    result = await db.workflows.update_one(
+        {"id": task["workflow_id"], "status": "active", "steps": {"$elemMatch": {
+            "id": task["step_id"], "task_ids": task["id"], "status": {"$in": ["waiting", "active"]},
+        }}},
+        {
+            "$inc": {"steps.$.approvals": approvals, "steps.$.rejections": rejections, "wake_seq": 1},
+            "$set": {"wake_at": datetime.utcnow()},
+        },
+    )
+    if result.modified_count:
+        await wake_workflow_scheduler()
+
+def plan_workflow(workflow: Dict[str, Any]) -> tuple:
+    # Returns ($set fields, tasks to materialize) for one scheduler pass
+    steps = workflow["steps"]
+    statuses = [step.get("status", "waiting") for step in steps]
+    for i, step in enumerate(steps):
+        if statuses[i] == "active":
+            if step.get("rejections", 0) > 0:
+                statuses[i] = "rejected"
+            elif step.get("approvals", 0) >= step["required_approvals"]:
+                statuses[i] = "completed"
+    updates: Dict[str, Any] = {}
+    tasks: List[Task] = []
+    if "rejected" in statuses:
+        updates["status"] = "rejected"
+    while "rejected" not in statuses and "active" not in statuses:
+        waiting = [i for i, status in enumerate(statuses) if status == "waiting"]
+        if not waiting:
+            updates["status"] = "completed"
+            break
+        order = min(steps[i]["order"] for i in waiting)
+        updates["current_order"] = order
+        for i in waiting:
+            step = steps[i]
+            if step["order"] != order:
+                continue
+            # Decisions may already have landed while the step's tasks were being materialized
+            statuses[i] = "completed" if step.get("approvals", 0) >= step["required_approvals"] else "active"
+            for n, task_id in enumerate(step["task_ids"], 1):
+                title = step["name"] if len(step["task_ids"]) == 1 else f"{step['name']} (approval {n}/{len(step['task_ids'])})"
+                tasks.append(Task(
+                    id=task_id, workflow_id=workflow["id"], step_id=step["id"], title=title,
+                    description=step.get("description"), assignee_id=step.get("assignee_id") or workflow["created_by"],
+                    created_by=workflow["created_by"],
+                ))
+    for i, step in enumerate(steps):
+        if statuses[i] != step.get("status", "waiting"):
+            updates[f"steps.{i}.status"] = statuses[i]
+    return updates, tasks
+
+async def claim_workflow() -> Optional[Dict[str, Any]]:
+    now = datetime.utcnow()
+    lease_owner = str(uuid.uuid4())
+    workflow = await db.workflows.find_one_and_update(
+        {"status": "active", "wake_at": {"$lte": now}, "lease_expires_at": {"$lte": now}},
+        {"$set": {"lease_owner": lease_owner, "lease_expires_at": now + timedelta(seconds=WORKFLOW_LEASE_SECONDS)}},
+        sort=[("wake_at", ASCENDING)],
+        projection={"_id": 0},
+    )
+    if workflow is not None:
+        workflow["lease_owner"] = lease_owner
+    return workflow
+
+async def advance_workflow(workflow: Dict[str, Any]) -> None:
+    updates, tasks = plan_workflow(workflow)
+    if tasks:
+        try:
+            await db.tasks.insert_many([task.dict() for task in tasks], ordered=False)
+        except BulkWriteError as exc:
+            # Tasks left behind by a pass whose lease expired before it finished
+            if any(error["code"] != 11000 for error in exc.details["writeErrors"]):
+                raise
+        assigned: Dict[str, int] = {}
+        for task in tasks:
+            assigned[task.assignee_id] = assigned.get(task.assignee_id, 0) + 1
+        for assignee_id, count in assigned.items():
+            await record_activity(assignee_id, {"tasks": count}, f"Workflow {workflow['name']} assigned {count} task(s)")
+        workflow_stats["tasks_materialized"] += len(tasks)
+    release = {**updates, "lease_owner": None, "lease_expires_at": LEASE_RELEASED, "updated_at": datetime.utcnow()}
+    leased = {"id": workflow["id"], "lease_owner": workflow["lease_owner"]}
+    result = await db.workflows.update_one({**leased, "wake_seq": workflow["wake_seq"]}, {"$set": {**release, "wake_at": None}})
+    if not result.matched_count:
+        # A decision arrived during this pass (or the lease was lost): release, but stay due
+        result = await db.workflows.update_one(leased, {"$set": release})
+        if not result.matched_count:
+            workflow_stats["lease_conflicts"] += 1
+            return
+    workflow_stats["advanced"] += 1
+    if updates.get("status") in ("completed", "rejected"):
+        workflow_stats[updates["status"]] += 1
+        await record_activity(workflow["created_by"], {}, f"Workflow {workflow['name']} {updates['status']}")
+
+async def run_workflow_pass(workflow: Dict[str, Any]) -> None:
+    try:
+        await advance_workflow(workflow)
+    except Exception:
+        # The lease expires and another pass retries the workflow
+        workflow_stats["errors"] += 1
+        logger.exception(f"Advancing workflow {workflow['id']} failed")
+
+async def run_workflow_scheduler() -> None:
+    slots = asyncio.Semaphore(WORKFLOW_CONCURRENCY)
+    while True:
+        try:
+            await asyncio.wait_for(workflow_wakeup.wait(), WORKFLOW_SCAN_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        workflow_wakeup.clear()
+        try:
+            while True:
+                await slots.acquire()
+                workflow = await claim_workflow()
+                if workflow is None:
+                    slots.release()
+                    break
+                run = asyncio.create_task(run_workflow_pass(workflow))
+                workflow_runs.add(run)
+                run.add_done_callback(workflow_runs.discard)
+                run.add_done_callback(lambda _: slots.release())
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            slots.release()
+            logger.exception("Workflow scheduler pass failed")
+
+# Job queue
+# Durable background work. Routes call enqueue_job(kind, payload) and return; consumers (in the web
+# workers, or worker.py) claim due jobs with one find_one_and_update that hides them for the visibility
+# timeout, and keep_job_leased() renews it while the handler runs, so a consumer that dies mid-job just
+# lets the job reappear. Handlers are async functions
+# registered with @job_handler(kind); CPU-heavy parts go through run_cpu_bound() to the process pool.
+# Successful jobs are deleted; a job keyed with ``key`` is enqueued at most once until it finishes.
+job_handlers: Dict[str, Callable[[Dict[str, Any]], Awaitable[None]]] = {}
+job_stats = {"enqueued": 0, "succeeded": 0, "retried": 0, "dead_lettered": 0}
+job_seconds = Histogram("job_duration_seconds", "Background job run time", ("kind", "outcome"))
+# Both created by whichever process runs consumers: start_services() or run_job_worker()
+job_wakeup: Optional[asyncio.Event] = None
+job_process_pool: Optional[ProcessPoolExecutor] = None
+
+def job_handler(kind: str):
+    def register(fn: Callable[[Dict[str, Any]], Awaitable[None]]):
+        job_handlers[kind] = fn
+        return fn
+    return register
+
+async def run_cpu_bound(fn, *args):
+    # fn and its arguments must be picklable: a module-level function and plain data
+    return await asyncio.get_running_loop().run_in_executor(job_process_pool, fn, *args)
+
+async def enqueue_job(
+    kind: str,
+    payload: Dict[str, Any],
+    delay_seconds: float = 0,
+    max_attempts: int = JOB_MAX_ATTEMPTS,
+    key: Optional[str] = None,
+) -> str:
+    now = datetime.utcnow()
+    job = {
+        "id": str(uuid.uuid4()), "kind": kind, "payload": payload, "key": key,
+        "attempts": 0, "max_attempts": max_attempts, "visible_at": now + timedelta(seconds=delay_seconds),
+        "lease_owner": None, "last_error": None, "created_at": now, "updated_at": now,
+    }
+    try:
+        await db.jobs.insert_one(job)
+    except DuplicateKeyError:
+        if key is None:
+            raise
+        existing = await db.jobs.find_one({"key": key}, {"_id": 0, "id": 1})
+        if existing is not None:
+            return existing["id"]
+        # The keyed job finished between the insert and the lookup
+        return await enqueue_job(kind, payload, delay_seconds, max_attempts, key)
+    job_stats["enqueued"] += 1
+    if delay_seconds <= 0:
+        await state.publish("jobs:wake", None)
+    return job["id"]
+
+def job_backoff(attempts: int) -> float:
+    # Full jitter keeps a burst of failures from retrying in lockstep
+    return random.uniform(0.5, 1.0) * min(JOB_BACKOFF_MAX_SECONDS, JOB_BACKOFF_BASE_SECONDS * 2 ** (attempts - 1))
+
+async def claim_job() -> Optional[Dict[str, Any]]:
+    now = datetime.utcnow()
+    lease_owner = str(uuid.uuid4())
+    job = await db.jobs.find_one_and_update(
+        {"visible_at": {"$lte": now}},
+        {
+            "$set": {
+                "visible_at": now + timedelta(seconds=JOB_VISIBILITY_TIMEOUT_SECONDS),
+                "lease_owner": lease_owner, "updated_at": now,
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("visible_at", ASCENDING)],
+        projection={"_id": 0},
+    )
+    if job is not None:
+        job["lease_owner"] = lease_owner
+        job["attempts"] += 1
+    return job
+
+async def fail_job(job: Dict[str, Any], error: str, permanent: bool) -> None:
+    now = datetime.utcnow()
+    leased = {"id": job["id"], "lease_owner": job["lease_owner"]}
+    if permanent or job["attempts"] >= job["max_attempts"]:
+        # Only the current lease holder may dead-letter; after a visibility timeout another consumer owns the job
+        if await db.jobs.find_one_and_delete(leased, projection={"_id": 1}) is None:
+            logger.warning(f"Job {job['id']} ({job['kind']}) lease expired before it could be dead-lettered")
+            return
+        await db.dead_jobs.insert_one({**job, "last_error": error, "lease_owner": None, "dead_at": now})
+        job_stats["dead_lettered"] += 1
+        logger.error(f"Job {job['id']} ({job['kind']}) moved to dead_jobs after {job['attempts']} attempt(s): {error}")
+        return
+    retry_at = now + timedelta(seconds=job_backoff(job["attempts"]))
+    await db.jobs.update_one(leased, {"$set": {"visible_at": retry_at, "lease_owner": None, "last_error": error, "updated_at": now}})
+    job_stats["retried"] += 1
+
+async def keep_job_leased(job: Dict[str, Any]) -> None:
+    # Pushes visible_at forward while the handler runs, so a job that outlives the visibility timeout
+    # (a reconcile over many users) is not claimed and run a second time by another consumer
+    while True:
+        await asyncio.sleep(JOB_VISIBILITY_TIMEOUT_SECONDS / 3)
+        now = datetime.utcnow()
+        try:
+            result = await db.jobs.update_one(
+                {"id": job["id"], "lease_owner": job["lease_owner"]},
+                {"$set": {"visible_at": now + timedelta(seconds=JOB_VISIBILITY_TIMEOUT_SECONDS), "updated_at": now}},
+            )
+        except Exception:
+            logger.exception(f"Could not extend the lease on job {job['id']} ({job['kind']})")
+            continue
+        if not result.matched_count:
+            logger.warning(f"Job {job['id']} ({job['kind']}) lost its lease while running")
+            return
+
+async def run_job(job: Dict[str, Any]) -> None:
+    handler = job_handlers.get(job["kind"])
+    start = time.perf_counter()
+    try:
+        if handler is None:
+            raise LookupError(f"No handler registered for job kind {job['kind']!r}")
+        heartbeat = asyncio.create_task(keep_job_leased(job))
+        try:
+            await handler(job["payload"])
+        finally:
+            heartbeat.cancel()
+    except asyncio.CancelledError:
+        raise
+    except Exception as exc:
+        job_seconds.observe((job["kind"], "error"), time.perf_counter() - start)
+        await fail_job(job, f"{type(exc).__name__}: {exc}"[:2000], permanent=handler is None)
+        return
+    job_seconds.observe((job["kind"], "ok"), time.perf_counter() - start)
+    await db.jobs.delete_one({"id": job["id"], "lease_owner": job["lease_owner"]})
+    job_stats["succeeded"] += 1
+
+async def run_job_consumer() -> None:
+    while True:
+        try:
+            job = await claim_job()
+            if job is not None:
+                await run_job(job)
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Job consumer iteration failed")
+        try:
+            await asyncio.wait_for(job_wakeup.wait(), JOB_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        job_wakeup.clear()
+
+# Scheduled jobs
+# Periodic maintenance runs once per interval across every worker: each run is a job keyed on its time
+# slot, so all workers scheduling the same slot at startup collapse into one job, and each run schedules
+# the next slot before doing its work so a failing run does not end the chain.
+async def schedule_periodic_job(kind: str, interval: float, slot: Optional[int] = None) -> None:
+    if slot is None:
+        slot = int(time.time() // interval) + 1
+    delay = max(0.0, slot * interval - time.time())
+    await enqueue_job(kind, {"slot": slot}, delay_seconds=delay, key=f"{kind}:{slot}")
+
+@job_handler("reconcile_analytics")
+async def reconcile_analytics_job(payload: Dict[str, Any]) -> None:
+    await schedule_periodic_job("reconcile_analytics", ANALYTICS_RECONCILE_INTERVAL_SECONDS, payload["slot"] + 1)
+    await reconcile_analytics()
+
+# Document storage
+# File bytes are stored once per distinct SHA-256 in a BlobStore. The blobs collection maps each digest
+# to the store and key holding it and counts the documents (or product images) referencing it; blobs
+# whose refcount drops to zero are deleted by collect_orphan_blobs() after a grace period. Readers
+# resolve bytes through the blobs record rather than the referencing document, so migrate_blobs.py
+# can move blobs between stores without touching documents or products.
+blob_stats = {"uploads": 0, "deduplicated": 0, "bytes_deduplicated": 0}
+
+def document_bucket() -> AsyncIOMotorGridFSBucket:
+    return AsyncIOMotorGridFSBucket(db, bucket_name="document_blobs")
+
+class BlobStore(ABC):
+    """Immutable blob bytes addressed by a key that write() picks.
+
+    Keys carry a random suffix, so two racing uploads of the same new content never share a key and
+    the loser can delete its copy without touching the winner's.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    async def write(self, sha256: str, chunks: AsyncIterator[bytes]) -> str:
+        ...
+
+    @abstractmethod
+    def read(self, key: str, start: int, length: int) -> AsyncIterator[bytes]:
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        ...
+
+    def download_url(self, key: str, filename: str, content_type: str) -> Optional[str]:
+        # A URL the client can fetch the bytes from directly, bypassing the app
+        return None
+
+    def accel_path(self, key: str) -> Optional[str]:
+        # An X-Accel-Redirect path for a fronting nginx to serve the bytes with sendfile()
+        return None
+
+    def blob_key(self, sha256: str) -> str:
+        return f"{sha256[:2]}/{sha256}.{uuid.uuid4().hex[:12]}"
+
+class GridFSBlobStore(BlobStore):
+    """Blobs as GridFS files in the application database; needs no extra infrastructure."""
+
+    name = "gridfs"
+
+    async def write(self, sha256: str, chunks: AsyncIterator[bytes]) -> str:
+        stream = document_bucket().open_upload_stream(sha256)
+        try:
+            async for chunk in chunks:
+                await stream.write(chunk)
+        except BaseException:
+            await stream.abort()
+            raise
+        await stream.close()
+        return str(stream._id)
+
+    async def read(self, key: str, start: int, length: int) -> AsyncIterator[bytes]:
+        grid_out = await document_bucket().open_download_stream(ObjectId(key))
+        grid_out.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = await grid_out.read(min(UPLOAD_READ_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    async def delete(self, key: str) -> None:
+        await document_bucket().delete(ObjectId(key))
+
+class LocalBlobStore(BlobStore):
+    """Blobs as files under a directory, written to a temporary name and renamed into place once synced.
+
+    Only for a single host (or a shared mount). Set BLOB_LOCAL_ACCEL_PREFIX when nginx fronts the app
+    so downloads are sent from the page cache with sendfile() instead of passing through a worker.
+    """
+
+    name = "local"
+
+    def __init__(self, root: str = BLOB_LOCAL_ROOT):
+        self.root = Path(root)
+
+    def path(self, key: str) -> Path:
+        return self.root / key
+
+    async def write(self, sha256: str, chunks: AsyncIterator[bytes]) -> str:
+        key = self.blob_key(sha256)
+        path = self.path(key)
+        partial = path.with_name(path.name + ".part")
+        await asyncio.to_thread(path.parent.mkdir, parents=True, exist_ok=True)
+        handle = await asyncio.to_thread(open, partial, "wb")
+        try:
+            async for chunk in chunks:
+                await asyncio.to_thread(handle.write, chunk)
+            await asyncio.to_thread(self.commit, handle, partial, path)
+        except BaseException:
+            handle.close()
+            partial.unlink(missing_ok=True)
+            raise
+        return key
+
+    @staticmethod
+    def commit(handle, partial: Path, path: Path) -> None:
+        handle.flush()
+        os.fsync(handle.fileno())
+        handle.close()
+        os.replace(partial, path)
+
+    async def read(self, key: str, start: int, length: int) -> AsyncIterator[bytes]:
+        handle = await asyncio.to_thread(open, self.path(key), "rb")
+        try:
+            position, end = start, start + length
+            while position < end:
+                chunk = await asyncio.to_thread(os.pread, handle.fileno(), min(UPLOAD_READ_SIZE, end - position), position)
+                if not chunk:
+                    break
+                position += len(chunk)
+                yield chunk
+        finally:
+            handle.close()
+
+    async def delete(self, key: str) -> None:
+        await asyncio.to_thread(self.path(key).unlink, missing_ok=True)
+
+    def accel_path(self, key: str) -> Optional[str]:
+        return f"{BLOB_LOCAL_ACCEL_PREFIX.rstrip('/')}/{key}" if BLOB_LOCAL_ACCEL_PREFIX else None
+
+class S3BlobStore(BlobStore):
+    """Blobs as objects in an S3-compatible bucket (AWS, MinIO, ...).
+
+    Large writes go up as multipart uploads of S3_MULTIPART_BYTES parts, so memory stays bounded by one
+    part. Document downloads redirect to a presigned URL unless S3_PRESIGN_SECONDS is 0. boto3 is
+    synchronous, so its calls run on the default thread pool. Pass ``client`` to use a different boto3
+    S3 client, e.g. one from moto in tests.
+    """
+
+    name = "s3"
+
+    def __init__(self, client=None, bucket: str = S3_BUCKET, prefix: str = S3_PREFIX):
+        if client is None:
+            # Optional dependency, only needed with BLOB_STORE=s3
+            import boto3
+            client = boto3.client("s3", endpoint_url=S3_ENDPOINT_URL, region_name=S3_REGION)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    async def write(self, sha256: str, chunks: AsyncIterator[bytes]) -> str:
+        key = self.prefix + self.blob_key(sha256)
+        buffer = bytearray()
+        upload_id: Optional[str] = None
+        parts: List[Dict[str, Any]] = []
+        try:
+            async for chunk in chunks:
+                buffer += chunk
+                if len(buffer) >= S3_MULTIPART_BYTES:
+                    if upload_id is None:
+                        upload = await asyncio.to_thread(self.client.create_multipart_upload, Bucket=self.bucket, Key=key)
+                        upload_id = upload["UploadId"]
+                    await self.upload_part(key, upload_id, parts, bytes(buffer))
+                    buffer.clear()
+            if upload_id is None:
+                await asyncio.to_thread(self.client.put_object, Bucket=self.bucket, Key=key, Body=bytes(buffer))
+                return key
+            if buffer:
+                await self.upload_part(key, upload_id, parts, bytes(buffer))
+            await asyncio.to_thread(
+                self.client.complete_multipart_upload,
+                Bucket=self.bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts},
+            )
+        except BaseException:
+            if upload_id is not None:
+                await asyncio.to_thread(self.client.abort_multipart_upload, Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+        return key
+
+    async def upload_part(self, key: str, upload_id: str, parts: List[Dict[str, Any]], body: bytes) -> None:
+        number = len(parts) + 1
+        part = await asyncio.to_thread(
+            self.client.upload_part, Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=body
+        )
+        parts.append({"PartNumber": number, "ETag": part["ETag"]})
+
+    async def read(self, key: str, start: int, length: int) -> AsyncIterator[bytes]:
+        if length <= 0:
+            return
+        response = await asyncio.to_thread(
+            self.client.get_object, Bucket=self.bucket, Key=key, Range=f"bytes={start}-{start + length - 1}"
+        )
+        body = response["Body"]
+        try:
+            while chunk := await asyncio.to_thread(body.read, UPLOAD_READ_SIZE):
+                yield chunk
+        finally:
+            body.close()
+
+    async def delete(self, key: str) -> None:
+        await asyncio.to_thread(self.client.delete_object, Bucket=self.bucket, Key=key)
+
+    def download_url(self, key: str, filename: str, content_type: str) -> Optional[str]:
+        if not S3_PRESIGN_SECONDS:
+            return None
+        return self.client.generate_presigned_url("get_object", ExpiresIn=S3_PRESIGN_SECONDS, Params={
+            "Bucket": self.bucket,
+            "Key": key,
+            "ResponseContentType": content_type,
+            "ResponseContentDisposition": 'attachment; filename="{}"'.format(filename.replace('"', "")),
+        })
+
+BLOB_STORES: Dict[str, Callable[[], BlobStore]] = {"gridfs": GridFSBlobStore, "local": LocalBlobStore, "s3": S3BlobStore}
+blob_stores: Dict[str, BlobStore] = {}
+
+def blob_store(name: Optional[str] = None) -> BlobStore:
+    # The store called name, or the one new blobs go to; blobs written before a BLOB_STORE change stay
+    # readable from their old store until migrate_blobs.py moves them
+    name = name or BLOB_STORE
+    if name not in blob_stores:
+        if name not in BLOB_STORES:
+            raise ValueError(f"Unknown blob store {name!r}, expected gridfs, local or s3")
+        blob_stores[name] = BLOB_STORES[name]()
+    return blob_stores[name]
+
+BLOB_PROJECTION = {"_id": 0, "store": 1, "key": 1, "gridfs_id": 1, "size": 1}
+
+def blob_location(blob: Dict[str, Any]) -> tuple:
+    # (store name, key); records from before stores were pluggable only have gridfs_id
+    if "store" in blob:
+        return blob["store"], blob["key"]
+    return "gridfs", str(blob["gridfs_id"])
+
+async def find_blob(sha256: str) -> Dict[str, Any]:
+    blob = await db.blobs.find_one({"sha256": sha256}, BLOB_PROJECTION)
+    if blob is None:
+        raise HTTPException(status_code=404, detail="File content not found")
+    return blob
+
+def read_blob(blob: Dict[str, Any], start: int, length: int) -> AsyncIterator[bytes]:
+    store_name, key = blob_location(blob)
+    return blob_store(store_name).read(key, start, length)
+
+async def hash_upload(upload: UploadFile) -> tuple:
+    # One pass over the spooled upload; returns (sha256 hex digest, size)
+    digest = hashlib.sha256()
+    size = 0
+    while chunk := await upload.read(UPLOAD_READ_SIZE):
+        size += len(chunk)
+        if size > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=f"File exceeds {MAX_UPLOAD_BYTES} bytes")
+        digest.update(chunk)
+    await upload.seek(0)
+    return digest.hexdigest(), size
+
+async def upload_chunks(upload: UploadFile) -> AsyncIterator[bytes]:
+    while chunk := await upload.read(UPLOAD_READ_SIZE):
+        yield chunk
+
+async def add_blob_reference(sha256: str, size: int, chunks: Callable[[], AsyncIterator[bytes]],
+                             store: Optional[BlobStore] = None) -> tuple:
+    # Adds a reference to content with this digest, writing chunks() to store (by default the
+    # configured one) only if the digest is new; returns (blob key, sha256, size)
+    blob_stats["uploads"] += 1
+    blob = await db.blobs.find_one_and_update(
+        {"sha256": sha256}, {"$inc": {"refcount": 1}}, projection=BLOB_PROJECTION
+    )
+    if blob is None:
+        store = store or blob_store()
+        key = await store.write(sha256, chunks())
+        try:
+            blob = await db.blobs.find_one_and_update(
+                {"sha256": sha256},
+                {"$inc": {"refcount": 1}, "$setOnInsert": {
+                    "store": store.name, "key": key, "size": size, "created_at": datetime.utcnow(),
+                }},
+                projection=BLOB_PROJECTION,
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # A concurrent upsert of the same digest won the insert; attach to its blob instead
+            blob = await db.blobs.find_one_and_update(
+                {"sha256": sha256}, {"$inc": {"refcount": 1}}, projection=BLOB_PROJECTION
+            )
+        if blob_location(blob) == (store.name, key):
+            return key, sha256, size
+        await store.delete(key)
+    blob_stats["deduplicated"] += 1
+    blob_stats["bytes_deduplicated"] += size
+    return blob_location(blob)[1], sha256, size
+
+async def store_blob(upload: UploadFile) -> tuple:
+    # Returns (blob key, sha256, size) like add_blob_reference()
+    sha256, size = await hash_upload(upload)
+    return await add_blob_reference(sha256, size, lambda: upload_chunks(upload))
+
+async def release_blob(sha256: str) -> None:
+    await db.blobs.update_one({"sha256": sha256}, {"$inc": {"refcount": -1}, "$set": {"released_at": datetime.utcnow()}})
+
+async def collect_orphan_blobs(grace_seconds: float = BLOB_GC_GRACE_SECONDS) -> int:
+    cutoff = datetime.utcnow() - timedelta(seconds=grace_seconds)
+    collected = 0
+    async for blob in db.blobs.find({"refcount": {"$lte": 0}, "released_at": {"$lt": cutoff}}, {"sha256": 1}):
+        # Re-check the refcount atomically so a concurrent upload that revived the blob keeps it
+        orphan = await db.blobs.find_one_and_delete({"sha256": blob["sha256"], "refcount": {"$lte": 0}})
+        if orphan is not None:
+            store_name, key = blob_location(orphan)
+            await blob_store(store_name).delete(key)
+            collected += 1
+    if collected:
+        logger.info(f"Collected {collected} orphan blobs")
+    return collected
+
+async def run_blob_gc() -> None:
+    while True:
+        await asyncio.sleep(BLOB_GC_INTERVAL_SECONDS)
+        try:
+            await collect_orphan_blobs()
+        except Exception:
+            logger.exception("Blob garbage collection failed")
+
+# Inline base64 payloads written by the old JSON upload format: (collection, payload field, fields set
+# from the stored blob's key, sha256 and size, content type field and its default)
+INLINE_BLOB_FIELDS = [
+    ("documents", "file_data", ("blob_id", "sha256", "size"), ("content_type", "application/octet-stream")),
+    ("products", "image_data", ("image_blob_id", "image_sha256", None), ("image_content_type", "image/jpeg")),
+]
+
+async def bytes_chunks(data: bytes) -> AsyncIterator[bytes]:
+    for offset in range(0, len(data), UPLOAD_READ_SIZE):
+        yield data[offset:offset + UPLOAD_READ_SIZE]
+
+async def migrate_inline_blob(collection_name: str, field: str, targets: tuple, content_type: tuple,
+                              item: Dict[str, Any], store: BlobStore) -> bool:
+    try:
+        data = base64.b64decode(item[field], validate=True)
+    except (TypeError, ValueError):
+        logger.warning(f"Skipping {collection_name} {item['id']}: {field} is not valid base64")
+        return False
+    sha256 = hashlib.sha256(data).hexdigest()
+    key, sha256, size = await add_blob_reference(sha256, len(data), lambda: bytes_chunks(data), store)
+    update: Dict[str, Any] = {name: value for name, value in zip(targets, (key, sha256, size)) if name}
+    type_field, default_type = content_type
+    if not item.get(type_field):
+        update[type_field] = default_type
+    result = await db[collection_name].update_one(
+        {"id": item["id"], field: {"$exists": True}}, {"$set": update, "$unset": {field: ""}}
+    )
+    if not result.modified_count:
+        # Migrated or deleted concurrently; drop the reference taken above
+        await release_blob(sha256)
+    return bool(result.modified_count)
+
+async def move_blob(blob: Dict[str, Any], target: str) -> bool:
+    # Copies the bytes, repoints the record only if it still names the source, then deletes the copy
+    # that lost. A download that resolved the record just before the switch can still fail mid-stream.
+    source_name, source_key = blob_location(blob)
+    destination = blob_store(target)
+    key = await destination.write(blob["sha256"], read_blob(blob, 0, blob["size"]))
+    current = {"store": source_name, "key": source_key} if "store" in blob else {"store": {"$exists": False}, "gridfs_id": blob["gridfs_id"]}
+    result = await db.blobs.update_one(
+        {"sha256": blob["sha256"], **current},
+        {"$set": {"store": target, "key": key}, "$unset": {"gridfs_id": ""}},
+    )
+    if result.modified_count:
+        await blob_store(source_name).delete(source_key)
+    else:
+        await destination.delete(key)
+    return bool(result.modified_count)
+
+async def migrate_blobs(target: str, batch_size: int) -> Dict[str, int]:
+    # Streams inline payloads and blobs held by other stores into target, batch_size at a time; safe to
+    # stop and rerun, since each step only applies while its source is unchanged
+    store = blob_store(target)
+    moved = {"inline": 0, "blobs": 0, "skipped": 0}
+    for collection_name, field, targets, content_type in INLINE_BLOB_FIELDS:
+        skipped: List[str] = []
+        while batch := await db[collection_name].find(
+            {field: {"$exists": True}, "id": {"$nin": skipped}}, {"_id": 0, "id": 1, field: 1, content_type[0]: 1}
+        ).to_list(batch_size):
+            results = await asyncio.gather(*[
+                migrate_inline_blob(collection_name, field, targets, content_type, item, store) for item in batch
+            ])
+            skipped.extend(item["id"] for item, ok in zip(batch, results) if not ok)
+            moved["inline"] += sum(results)
+        moved["skipped"] += len(skipped)
+    pending = {"store": {"$ne": target}} if target != "gridfs" else {"store": {"$exists": True, "$ne": "gridfs"}}
+    failed: List[str] = []
+    while batch := await db.blobs.find(
+        {**pending, "refcount": {"$gt": 0}, "sha256": {"$nin": failed}}, {"_id": 0, "sha256": 1, **BLOB_PROJECTION}
+    ).to_list(batch_size):
+        results = await asyncio.gather(*[move_blob(blob, target) for blob in batch], return_exceptions=True)
+        for blob, result in zip(batch, results):
+            if isinstance(result, Exception):
+                logger.error(f"Moving blob {blob['sha256']} to {target} failed: {result!r}")
+            if result is not True:
+                failed.append(blob["sha256"])
+        moved["blobs"] += sum(result is True for result in results)
+        logger.info(f"Migrated {moved['inline']} inline payloads and {moved['blobs']} blobs to {target}")
+    moved["skipped"] += len(failed)
+    return moved
+
+async def run_blob_migration(target: str, batch_size: int) -> Dict[str, int]:
+    # migrate_blobs.py entry point
+    global client, db
+    client = make_mongo_client()
+    db = client[MONGO_DB_NAME]
+    try:
+        return await migrate_blobs(target, batch_size)
+    finally:
+        client.close()
+
+async def storage_stats() -> Dict[str, Any]:
+    totals = await db.blobs.aggregate([
+        {"$match": {"refcount": {"$gt": 0}}},
+        {"$group": {
+            "_id": None,
+            "blobs": {"$sum": 1},
+            "physical_bytes": {"$sum": "$size"},
+            "logical_bytes": {"$sum": {"$multiply": ["$size", "$refcount"]}},
+        }},
+    ]).to_list(1)
+    totals = totals[0] if totals else {"blobs": 0, "physical_bytes": 0, "logical_bytes": 0}
+    totals.pop("_id", None)
+    totals["dedup_ratio"] = totals["logical_bytes"] / totals["physical_bytes"] if totals["physical_bytes"] else 1.0
+    # Blobs per store, to follow a migrate_blobs.py run
+    totals["stores"] = {
+        row["_id"]: row["blobs"]
+        async for row in db.blobs.aggregate([
+            {"$match": {"refcount": {"$gt": 0}}},
+            {"$group": {"_id": {"$ifNull": ["$store", "gridfs"]}, "blobs": {"$sum": 1}}},
+        ])
+    }
+    return {**totals, "store": BLOB_STORE, **blob_stats}
+
+# storage_stats() aggregates over every blob, so health polls share one result per STORAGE_STATS_TTL_SECONDS
+storage_stats_cache = TTLCache(1, STORAGE_STATS_TTL_SECONDS)
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[tuple]:
+    # Returns an inclusive (start, end) byte range, or None to serve the whole file
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start_text, _, end_text = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if start_text:
+            start = int(start_text)
+            end = min(int(end_text), size - 1) if end_text else size - 1
+        else:
+            start, end = max(size - int(end_text), 0), size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise HTTPException(status_code=416, detail="Requested range not satisfiable",
+                            headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+# Document text
+# Uploads of a supported format get an extract_document_text job; the worker pool turns the bytes into
+# whitespace-normalized text stored in the document's content field, which the owner_text index covers.
+TEXT_FORMAT_EXTENSIONS = {".txt": "text", ".md": "text", ".log": "text", ".csv": "csv", ".json": "json", ".pdf": "pdf"}
+TEXT_FORMAT_TYPES = {"text/csv": "csv", "application/json": "json", "application/pdf": "pdf"}
+
+def text_format(filename: str, content_type: str) -> Optional[str]:
+    text_type = TEXT_FORMAT_TYPES.get(content_type) or TEXT_FORMAT_EXTENSIONS.get(Path(filename).suffix.lower())
+    if text_type is None and content_type.startswith("text/"):
+        return "text"
+    return text_type
+
+def json_strings(value) -> List[str]:
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, dict):
+        return [text for key, item in value.items() for text in [key, *json_strings(item)]]
+    if isinstance(value, list):
+        return [text for item in value for text in json_strings(item)]
+    return []
+
+def extract_pdf_text(data: bytes) -> str:
+    # Optional dependency, only needed to index PDF uploads
+    from pypdf import PdfReader
+    from pypdf.errors import PyPdfError
+    pages, length = [], 0
+    try:
+        for page in PdfReader(io.BytesIO(data)).pages:
+            text = page.extract_text() or ""
+            pages.append(text)
+            length += len(text)
+            if length >= DOCUMENT_TEXT_MAX_CHARS:
+                break
+    except PyPdfError as exc:
+        raise ValueError(f"Unreadable PDF: {exc}") from exc
+    return "\n".join(pages)
+
+def extract_text(data: bytes, text_type: str) -> str:
+    # Runs in the job process pool; raises ValueError for content that cannot be parsed
+    if text_type == "pdf":
+        text = extract_pdf_text(data)
+    elif text_type == "json":
+        try:
+            text = " ".join(json_strings(orjson.loads(data)))
+        except orjson.JSONDecodeError as exc:
+            raise ValueError(f"Invalid JSON: {exc}") from exc
+    else:
+        text = data.decode("utf-8-sig", errors="replace")
+        if text_type == "csv":
+            try:
+                text = "\n".join(" ".join(row) for row in csv.reader(io.StringIO(text)))
+            except csv.Error as exc:
+                raise ValueError(f"Invalid CSV: {exc}") from exc
+    return re.sub(r"\s+", " ", text).strip()[:DOCUMENT_TEXT_MAX_CHARS]
+
+@job_handler("extract_document_text")
+async def extract_document_text(payload: Dict[str, Any]) -> None:
+    document = await db.documents.find_one(
+        {"id": payload["document_id"]}, {"_id": 0, "sha256": 1, "filename": 1, "content_type": 1, "size": 1}
+    )
+    if document is None:
+        return
+    # Identical content uploaded before is extracted only once
+    twin = await db.documents.find_one({"sha256": document["sha256"], "text_status": "indexed"}, {"_id": 0, "content": 1})
+    update: Dict[str, Any] = {"text_status": "indexed"}
+    if twin is not None:
+        update["content"] = twin["content"]
+    elif document["size"] > DOCUMENT_TEXT_MAX_BYTES:
+        update["text_status"] = "unsupported"
+    else:
+        blob = await find_blob(document["sha256"])
+        data = b"".join([chunk async for chunk in read_blob(blob, 0, blob["size"])])
+        try:
+            update["content"] = await run_cpu_bound(extract_text, data, text_format(document["filename"], document["content_type"]))
+        except ValueError as exc:
+            logger.warning(f"Text extraction failed for document {payload['document_id']}: {exc}")
+            update["text_status"] = "failed"
+    await db.documents.update_one({"id": payload["document_id"]}, {"$set": update})
+
+async def backfill_document_text() -> int:
+    # Queues extraction for documents uploaded before text indexing existed (worker.py --backfill-text)
+    queued = 0
+    async for document in db.documents.find(
+        {"text_status": {"$exists": False}}, {"_id": 0, "id": 1, "filename": 1, "content_type": 1}
+    ):
+        text_status = "pending" if text_format(document["filename"], document["content_type"]) else "unsupported"
+        await db.documents.update_one({"id": document["id"]}, {"$set": {"text_status": text_status}})
+        if text_status == "pending":
+            await enqueue_job("extract_document_text", {"document_id": document["id"]}, key=f"extract_document_text:{document['id']}")
+            queued += 1
+    return queued
+
+def search_terms(q: str) -> List[str]:
+    # Terms to highlight: the query's words, minus negated ones ($text treats -word as "not")
+    return sorted(set(tokenize(re.sub(r"(^|\s)-\S+", " ", q))), key=len, reverse=True)
+
+def snippet_pattern(terms: List[str]) -> Optional[str]:
+    # Matches the start of any word highlight_spans would mark: one beginning with a term's stem.
+    # Snowball turns a final y into i ("study" -> "studi"), so such stems drop the i to still match "study".
+    stems = {text_key(term) for term in terms}
+    prefixes = sorted({stem[:-1] if stem.endswith("i") and len(stem) > 2 else stem for stem in stems if stem})
+    return r"\b(?:%s)" % "|".join(map(re.escape, prefixes)) if prefixes else None
+
+def snippet_expression(terms: List[str]) -> Dict[str, Any]:
+    # Aggregation expression cutting SEARCH_SNIPPET_CHARS of content around the first word matching a
+    # query term by stem, or from the start when only the filename or tags matched
+    content = {"$ifNull": ["$content", ""]}
+    pattern = snippet_pattern(terms)
+    if pattern is None:
+        return {"$substrCP": [content, 0, SEARCH_SNIPPET_CHARS]}
+    return {"$let": {
+        "vars": {"hit": {"$regexFind": {"input": content, "regex": pattern, "options": "i"}}},
+        "in": {"$substrCP": [
+            content,
+            {"$max": [0, {"$subtract": [{"$ifNull": ["$$hit.idx", 0]}, SEARCH_SNIPPET_LEAD]}]},
+            SEARCH_SNIPPET_CHARS,
+        ]},
+    }}
+
+# The documents text index uses language "english": $text matches Snowball stems of whole words,
+# ignoring case and diacritics. Highlights compare words the same way, so "runs" marks "running"
+# but "cat" does not mark "concatenate".
+text_stemmer = snowballstemmer.stemmer("english")
+
+def text_key(word: str) -> str:
+    folded = unicodedata.normalize("NFKD", word.casefold())
+    return text_stemmer.stemWord("".join(char for char in folded if not unicodedata.combining(char)))
+
+def highlight_spans(snippet: str, terms: List[str]) -> List[List[int]]:
+    keys = {text_key(term) for term in terms}
+    if not keys:
+        return []
+    return [[match.start(), match.end()] for match in re.finditer(r"\w+", snippet) if text_key(match.group()) in keys]
+
+# Folder tree
+# Folders keep a materialized ancestors array (root first) next to parent_id. A subtree is one indexed
+# query on ancestors, breadcrumbs are one $lookup through it, and moving a subtree rewrites the
+# ancestors prefix of every descendant in a single update_many. Names are not denormalized, so a
+# rename touches only the folder itself.
+def folder_subtree_query(owner: str, folder_id: str) -> Dict[str, Any]:
+    return {"created_by": owner, "$or": [{"id": folder_id}, {"ancestors": folder_id}]}
+
+async def folder_ancestors(owner: str, parent_id: Optional[str]) -> List[str]:
+    # Ancestors for a folder placed under parent_id
+    if parent_id is None:
+        return []
+    parent = await db.document_folders.find_one({"id": parent_id, "created_by": owner}, {"ancestors": 1})
+    if parent is None:
+        raise HTTPException(status_code=404, detail="Parent folder not found")
+    ancestors = [*parent.get("ancestors", []), parent_id]
+    if len(ancestors) >= MAX_FOLDER_DEPTH:
+        raise HTTPException(status_code=400, detail=f"Folders nest at most {MAX_FOLDER_DEPTH} levels deep")
+    return ancestors
+
+async def subtree_height(owner: str, folder: Dict[str, Any]) -> int:
+    # Levels below the folder, 0 for a leaf
+    rows = await db.document_folders.aggregate([
+        {"$match": {"created_by": owner, "ancestors": folder["id"]}},
+        {"$group": {"_id": None, "depth": {"$max": {"$size": "$ancestors"}}}},
+    ]).to_list(1)
+    return rows[0]["depth"] - len(folder["ancestors"]) if rows else 0
+
+async def backfill_folder_ancestors() -> int:
+    # Fills ancestors for folders created before they were stored, one tree level per pass
+    filled = 0
+    while True:
+        pending = await db.document_folders.find(
+            {"ancestors": {"$exists": False}}, {"_id": 0, "id": 1, "parent_id": 1}
+        ).to_list(None)
+        if not pending:
+            return filled
+        parent_ids = [folder["parent_id"] for folder in pending if folder["parent_id"]]
+        parents = {
+            parent["id"]: parent["ancestors"]
+            async for parent in db.document_folders.find(
+                {"id": {"$in": parent_ids}, "ancestors": {"$exists": True}}, {"_id": 0, "id": 1, "ancestors": 1}
+            )
+        }
+        updates = [
+            UpdateOne({"id": folder["id"]}, {"$set": {
+                "ancestors": [*parents[folder["parent_id"]], folder["parent_id"]] if folder["parent_id"] else [],
+            }})
+            for folder in pending if not folder["parent_id"] or folder["parent_id"] in parents
+        ]
+        if not updates:
+            # Everything left hangs off a deleted parent or a cycle; reattach it at the root
+            updates = [UpdateOne({"id": folder["id"]}, {"$set": {"parent_id": None, "ancestors": []}}) for folder in pending]
+        await db.document_folders.bulk_write(updates, ordered=False)
+        filled += len(updates)
+
+@job_handler("purge_folder_documents")
+async def purge_folder_documents(payload: Dict[str, Any]) -> None:
+    # Documents of a deleted folder subtree. Each delete is checked before its blob is released, so a
+    # retried job never releases a blob twice; counter drift from a partial run is fixed by reconciliation.
+    owner, removed, removed_bytes = payload["owner"], 0, 0
+    query = {"created_by": owner, "folder_id": {"$in": payload["folder_ids"]}}
+    async for document in db.documents.find(query, {"_id": 0, "id": 1, "sha256": 1, "size": 1}):
+        result = await db.documents.delete_one({"id": document["id"]})
+        if result.deleted_count:
+            await release_blob(document["sha256"])
+            removed += 1
+            removed_bytes += document["size"]
+    if removed:
+        await record_activity(owner, {"documents": -removed, "document_bytes": -removed_bytes})
+
+# Document routes
+DOCUMENT_PROJECTION = {"_id": 0, "blob_id": 0, "sha256": 0, "updated_at": 0, "content": 0}
+
+@api_router.post("/documents/folders", response_model=Folder)
+async def create_folder(folder_data: FolderCreate, current_user: User = Depends(get_current_user)):
+    ancestors = await folder_ancestors(current_user.id, folder_data.parent_id)
+    folder = Folder(**folder_data.dict(), ancestors=ancestors, created_by=current_user.id)
+    await db.document_folders.insert_one(folder.dict())
+    return folder
+
+@api_router.get("/documents/folders", response_model=List[Folder])
+async def list_folders(under: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    # Every folder, or with under= only the descendants of that folder
+    query: Dict[str, Any] = {"created_by": current_user.id}
+    if under is not None:
+        query["ancestors"] = under
+    return json_array_response(db.document_folders.find(query, {"_id": 0}).limit(MAX_FOLDERS))
+
+@api_router.get("/documents/folders/children", response_model=List[FolderNode])
+async def list_folder_children(parent_id: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    # One level of the tree, with counts so the client can tell which folders expand
+    folders = await db.document_folders.find(
+        {"created_by": current_user.id, "parent_id": parent_id}, {"_id": 0}
+    ).sort("name", ASCENDING).to_list(MAX_FOLDERS)
+    ids = [folder["id"] for folder in folders]
+    child_counts = {
+        row["_id"]: row["count"]
+        async for row in db.document_folders.aggregate([
+            {"$match": {"created_by": current_user.id, "parent_id": {"$in": ids}}},
+            {"$group": {"_id": "$parent_id", "count": {"$sum": 1}}},
+        ])
+    }
+    document_counts = {
+        row["_id"]: row["count"]
+        async for row in db.documents.aggregate([
+            {"$match": {"created_by": current_user.id, "folder_id": {"$in": ids}}},
+            {"$group": {"_id": "$folder_id", "count": {"$sum": 1}}},
+        ])
+    }
+    for folder in folders:
+        folder["child_count"] = child_counts.get(folder["id"], 0)
+        folder["document_count"] = document_counts.get(folder["id"], 0)
+    return json_response(folders)
+
+@api_router.get("/documents/folders/{folder_id}", response_model=FolderDetail)
+async def get_folder(folder_id: str, current_user: User = Depends(get_current_user)):
+    # The folder and its ancestors in one round trip
+    folders = await db.document_folders.aggregate([
+        {"$match": {"id": folder_id, "created_by": current_user.id}},
+        {"$lookup": {"from": "document_folders", "localField": "ancestors", "foreignField": "id", "as": "path"}},
+        {"$project": {"_id": 0}},
+    ]).to_list(1)
+    if not folders:
+        raise HTTPException(status_code=404, detail="Folder not found")
+    folder = folders[0]
+    names = {ancestor["id"]: ancestor["name"] for ancestor in folder["path"]}
+    folder["path"] = [
+        {"id": ancestor_id, "name": names.get(ancestor_id, "")} for ancestor_id in folder["ancestors"]
+    ] + [{"id": folder["id"], "name": folder["name"]}]
+    return json_response(folder)
+
+@api_router.put("/documents/folders/{folder_id}", response_model=Folder)
+async def update_folder(folder_id: str, folder_update: FolderUpdate, current_user: User = Depends(get_current_user)):
+    folder = await db.document_folders.find_one({"id": folder_id, "created_by": current_user.id}, {"_id": 0})
+    if folder is None:
+        raise HTTPException(status_code=404, detail="Folder not found")
+    changes = folder_update.dict(exclude_unset=True)
+    update_data: Dict[str, Any] = {}
+    if changes.get("name"):
+        update_data["name"] = changes["name"]
+    if "parent_id" in changes and changes["parent_id"] != folder["parent_id"]:
+        ancestors = await folder_ancestors(current_user.id, changes["parent_id"])
+        if folder_id in ancestors or changes["parent_id"] == folder_id:
+            raise HTTPException(status_code=400, detail="A folder cannot move into its own subtree")
+        if len(ancestors) + await subtree_height(current_user.id, folder) >= MAX_FOLDER_DEPTH:
+            raise HTTPException(status_code=400, detail=f"Folders nest at most {MAX_FOLDER_DEPTH} levels deep")
+        update_data.update(parent_id=changes["parent_id"], ancestors=ancestors)
+    if not update_data:
+        return folder
+    await db.document_folders.update_one({"id": folder_id}, {"$set": update_data})
+    if "ancestors" in update_data:
+        # Every descendant swaps the old prefix (up to and including this folder) for the new one
+        await db.document_folders.update_many(
+            {"created_by": current_user.id, "ancestors": folder_id},
+            [{"$set": {"ancestors": {"$concatArrays": [
+                [*update_data["ancestors"], folder_id],
+                {"$slice": ["$ancestors", len(folder["ancestors"]) + 1, MAX_FOLDER_DEPTH]},
+            ]}}}],
+        )
+    return {**folder, **update_data}
+
+@api_router.delete("/documents/folders/{folder_id}")
+async def delete_folder(folder_id: str, current_user: User = Depends(get_current_user)):
+    subtree = folder_subtree_query(current_user.id, folder_id)
+    folder_ids = await db.document_folders.distinct("id", subtree)
+    if not folder_ids:
+        raise HTTPException(status_code=404, detail="Folder not found")
+    await db.document_folders.delete_many(subtree)
+    # Documents go in the background; each one releases a blob reference
+    await enqueue_job("purge_folder_documents", {"owner": current_user.id, "folder_ids": folder_ids})
+    return {"message": "Folder deleted", "folders": len(folder_ids)}
+
+@api_router.post("/documents", response_model=DocumentResponse)
+async def upload_document(
+    file: UploadFile = File(...),
+    folder_id: Optional[str] = Form(None),
+    tags: str = Form(""),
+    current_user: User = Depends(get_current_user),
+):
+    # Checked before the bytes are stored; a document filed under another user's folder would be out
+    # of reach of that folder's delete
+    if folder_id and not await db.document_folders.find_one({"id": folder_id, "created_by": current_user.id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Folder not found")
+    blob_id, sha256, size = await store_blob(file)
+    document = Document(
+        filename=file.filename or "upload",
+        content_type=file.content_type or "application/octet-stream",
+        size=size,
+        tags=[tag.strip() for tag in tags.split(",") if tag.strip()],
+        folder_id=folder_id or None,
+        blob_id=blob_id,
+        sha256=sha256,
+        created_by=current_user.id
+    )
+    document.text_status = "pending" if text_format(document.filename, document.content_type) else "unsupported"
+    await db.documents.insert_one(document.dict())
+    await record_activity(current_user.id, {"documents": 1, "document_bytes": size}, f"Uploaded {document.filename}")
+    if document.text_status == "pending":
+        await enqueue_job("extract_document_text", {"document_id": document.id}, key=f"extract_document_text:{document.id}")
+    return document
+
+@api_router.get("/documents", response_model=List[DocumentResponse])
+async def list_documents(
+    response: Response,
+    folder_id: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+):
+    query = {"created_by": current_user.id, "folder_id": folder_id}
+    documents = await fetch_page(db.documents, query, DOCUMENT_PROJECTION, limit, cursor, response)
+    return json_response(documents, headers=response.headers)
+
+@api_router.get("/documents/search", response_model=List[DocumentSearchResult])
+async def search_documents(
+    q: str = Query(..., min_length=1, max_length=200),
+    tags: Optional[List[str]] = Query(None),
+    folder_id: Optional[str] = None,
+    subfolders: bool = False,
+    limit: int = Query(20, ge=1, le=SEARCH_MAX_RESULTS),
+    offset: int = Query(0, ge=0, le=SEARCH_MAX_OFFSET),
+    current_user: User = Depends(get_current_user),
+):
+    # Ranked by text score (filename and tag matches weigh more than content); snippets are cut around
+    # the first query term server-side, so only a few hundred characters per hit leave Mongo
+    query: Dict[str, Any] = {"created_by": current_user.id, "$text": {"$search": q}}
+    if tags:
+        query["tags"] = {"$all": tags}
+    if folder_id is not None and subfolders:
+        query["folder_id"] = {"$in": await db.document_folders.distinct("id", folder_subtree_query(current_user.id, folder_id))}
+    elif folder_id is not None:
+        query["folder_id"] = folder_id
+    terms = search_terms(q)
+    results = await db.documents.aggregate([
+        {"$match": query},
+        {"$sort": {"score": {"$meta": "textScore"}, "created_at": DESCENDING}},
+        {"$skip": offset},
+        {"$limit": limit},
+        {"$project": {
+            **{field: 1 for field in DocumentResponse.model_fields},
+            "_id": 0,
+            "score": {"$meta": "textScore"},
+            "snippet": snippet_expression(terms),
+        }},
+    ]).to_list(limit)
+    for result in results:
+        result["highlights"] = highlight_spans(result["snippet"], terms)
+    return json_response(results)
+
+@api_router.get("/documents/{document_id}", response_model=DocumentResponse)
+async def get_document(document_id: str, current_user: User = Depends(get_current_user)):
+    document = await db.documents.find_one({"id": document_id, "created_by": current_user.id}, DOCUMENT_PROJECTION)
+    if document is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+    return document
+
+async def find_document_blob(document_id: str, owner: str) -> tuple:
+    # Returns (document, blob, store, key) for a document the owner can download
+    document = await db.documents.find_one(
+        {"id": document_id, "created_by": owner}, {"_id": 0, "sha256": 1, "filename": 1, "content_type": 1}
+    )
+    if document is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+    blob = await find_blob(document["sha256"])
+    store_name, key = blob_location(blob)
+    return document, blob, blob_store(store_name), key
+
+@api_router.get("/documents/{document_id}/download-url")
+async def get_document_download_url(document_id: str, current_user: User = Depends(get_current_user)):
+    # For XHR clients: following the /download redirect cross-origin needs bucket CORS, so the frontend
+    # navigates the browser to this URL instead. null means /download serves the bytes itself.
+    document, _, store, key = await find_document_blob(document_id, current_user.id)
+    return {"url": store.download_url(key, document["filename"], document["content_type"])}
+
+@api_router.get("/documents/{document_id}/download")
+async def download_document(document_id: str, request: Request, current_user: User = Depends(get_current_user)):
+    document, blob, store, key = await find_document_blob(document_id, current_user.id)
+    disposition = 'attachment; filename="{}"'.format(document["filename"].replace('"', ""))
+    # Stores that can serve the bytes themselves take the request off the worker; both honour Range
+    url = store.download_url(key, document["filename"], document["content_type"])
+    if url is not None:
+        return RedirectResponse(url, status_code=307)
+    accel_path = store.accel_path(key)
+    if accel_path is not None:
+        return Response(
+            media_type=document["content_type"],
+            headers={"X-Accel-Redirect": accel_path, "Content-Disposition": disposition},
+        )
+    size = blob["size"]
+    byte_range = parse_range(request.headers.get("range"), size)
+    start, end = byte_range or (0, size - 1)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(end - start + 1),
+        "Content-Disposition": disposition,
+    }
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return StreamingResponse(
+        read_blob(blob, start, end - start + 1),
+        status_code=206 if byte_range else 200,
+        media_type=document["content_type"],
+        headers=headers,
+    )
+
+@api_router.delete("/documents/{document_id}")
+async def delete_document(document_id: str, current_user: User = Depends(get_current_user)):
+    document = await db.documents.find_one_and_delete(
+        {"id": document_id, "created_by": current_user.id}, projection={"sha256": 1, "size": 1}
+    )
+    if document is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+    await release_blob(document["sha256"])
+    await record_activity(current_user.id, {"documents": -1, "document_bytes": -document["size"]})
+    return {"message": "Document deleted"}
+
+# Product catalog
+# Listing and search page by (created_at, id) like every other list, with an optional $text filter.
+# Images are stored as deduplicated blobs and served by reference from /products/{id}/image, so list
+# payloads carry a URL rather than the bytes. Type-ahead is answered from CatalogIndex, an in-process
+# inverted index of product name and category tokens kept current on every product write.
+PRODUCT_PROJECTION = {"_id": 0, "image_blob_id": 0, "image_content_type": 0, "updated_at": 0}
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+def product_response(product: Dict[str, Any]) -> Dict[str, Any]:
+    sha256 = product.pop("image_sha256", None)
+    # The digest in the query string makes the URL change with the image, so it can be cached forever
+    product["image_url"] = f"/api/products/{product['id']}/image?v={sha256[:16]}" if sha256 else None
+    return product
+
+class CatalogIndex:
+    """Token -> product id postings over a bounded set of recently written products."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.postings: Dict[str, set] = {}
+        self.terms: List[str] = []
+        self.products: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.tokens: Dict[str, set] = {}
+        self.synced_at: Optional[datetime] = None
+        self.queries = 0
+
+    def add(self, product: Dict[str, Any]) -> None:
+        self.remove(product["id"])
+        tokens = set(tokenize(f"{product['name']} {product.get('category', '')}"))
+        for token in tokens:
+            if token not in self.postings:
+                self.postings[token] = set()
+                bisect.insort(self.terms, token)
+            self.postings[token].add(product["id"])
+        self.tokens[product["id"]] = tokens
+        self.products[product["id"]] = product_response({
+            field: product.get(field) for field in ("id", "name", "category", "price", "image_sha256")
+        })
+        while len(self.products) > self.maxsize:
+            self.remove(next(iter(self.products)))
+
+    def remove(self, product_id: str) -> None:
+        if self.products.pop(product_id, None) is None:
+            return
+        for token in self.tokens.pop(product_id):
+            ids = self.postings[token]
+            ids.discard(product_id)
+            if not ids:
+                del self.postings[token]
+                del self.terms[bisect.bisect_left(self.terms, token)]
+
+    def search(self, text: str, limit: int) -> List[Dict[str, Any]]:
+        # Every term but the last must match a token exactly; the last one is a prefix
+        self.queries += 1
+        terms = tokenize(text)
+        if not terms:
+            return []
+        *whole, prefix = terms
+        matches: Optional[set] = None
+        for term in whole:
+            ids = self.postings.get(term, set())
+            matches = ids if matches is None else matches & ids
+        prefixed: set = set()
+        index = bisect.bisect_left(self.terms, prefix)
+        while index < len(self.terms) and self.terms[index].startswith(prefix):
+            prefixed |= self.postings[self.terms[index]]
+            index += 1
+        matches = prefixed if matches is None else matches & prefixed
+        lowered = text.strip().lower()
+        ranked = heapq.nsmallest(limit, matches, key=lambda product_id: (
+            not self.products[product_id]["name"].lower().startswith(lowered),
+            self.products[product_id]["name"].lower(),
+        ))
+        return [self.products[product_id] for product_id in ranked]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": CATALOG_INDEX_ENABLED,
+            "products": len(self.products),
+            "terms": len(self.terms),
+            "queries": self.queries,
+            "synced_at": self.synced_at,
+        }
+
+catalog_index = CatalogIndex(CATALOG_INDEX_SIZE)
+
+async def sync_catalog_index() -> None:
+    # Folds in products written since the last sync, including those written by other workers
+    projection = {"_id": 0, "id": 1, "name": 1, "category": 1, "price": 1, "image_sha256": 1, "updated_at": 1}
+    if catalog_index.synced_at is None:
+        # Cold start: load the newest products, added oldest first so they leave the index in write order
+        newest = await db.products.find({}, projection).sort("updated_at", DESCENDING).to_list(CATALOG_INDEX_SIZE)
+        for product in reversed(newest):
+            catalog_index.add(product)
+        catalog_index.synced_at = newest[0]["updated_at"] if newest else datetime.utcnow()
+        return
+    query = {"updated_at": {"$gte": catalog_index.synced_at}}
+    async for product in db.products.find(query, projection).sort("updated_at", ASCENDING).limit(CATALOG_INDEX_SIZE):
+        catalog_index.add(product)
+        catalog_index.synced_at = product["updated_at"]
+
+async def run_catalog_indexer() -> None:
+    while True:
+        await asyncio.sleep(CATALOG_INDEX_REFRESH_SECONDS)
+        try:
+            await sync_catalog_index()
+        except Exception:
+            logger.exception("Catalog index sync failed")
+
+def product_filters(category: Optional[str], min_price: Optional[float], max_price: Optional[float]) -> Dict[str, Any]:
+    filters: Dict[str, Any] = {}
+    if category:
+        filters["category"] = category
+    price: Dict[str, float] = {}
+    if min_price is not None:
+        price["$gte"] = min_price
+    if max_price is not None:
+        price["$lte"] = max_price
+    if price:
+        filters["price"] = price
+    return filters
+
+def text_filter(q: Optional[str]) -> Dict[str, Any]:
+    return {"$text": {"$search": q}} if q and q.strip() else {}
+
+# Product routes
+@api_router.post("/products", response_model=ProductResponse)
+async def create_product(
+    name: str = Form(...),
+    description: str = Form(""),
+    price: float = Form(..., ge=0),
+    category: str = Form(""),
+    stock_quantity: int = Form(0, ge=0),
+    image: Optional[UploadFile] = File(None),
+    current_user: User = Depends(get_current_user),
+):
+    product = Product(
+        name=name, description=description, price=price, category=category,
+        stock_quantity=stock_quantity, created_by=current_user.id,
+    )
+    if image is not None and image.filename:
+        if not (image.content_type or "").startswith("image/"):
+            raise HTTPException(status_code=400, detail="Product image must be an image")
+        product.image_blob_id, product.image_sha256, _ = await store_blob(image)
+        product.image_content_type = image.content_type
+    await db.products.insert_one(product.dict())
+    if CATALOG_INDEX_ENABLED:
+        catalog_index.add(product.dict())
+    return product_response(product.dict())
+
+@api_router.get("/products", response_model=List[ProductResponse])
+async def list_products(
+    response: Response,
+    q: Optional[str] = None,
+    category: Optional[str] = None,
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+):
+    query = {**text_filter(q), **product_filters(category, min_price, max_price)}
+    products = await fetch_page(db.products, query, PRODUCT_PROJECTION, limit, cursor, response)
+    return json_response([product_response(product) for product in products], headers=response.headers)
+
+@api_router.get("/products/facets")
+async def product_facets(
+    q: Optional[str] = None,
+    category: Optional[str] = None,
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+    current_user: User = Depends(get_current_user),
+):
+    # Each facet applies every filter except its own, so the counts show where the user can go next
+    by_price = product_filters(category, None, None)
+    by_category = product_filters(None, min_price, max_price)
+    result = await db.products.aggregate([
+        {"$match": text_filter(q)},
+        {"$facet": {
+            "categories": [
+                {"$match": by_category},
+                {"$group": {"_id": "$category", "count": {"$sum": 1}}},
+                {"$sort": {"count": -1, "_id": 1}},
+                {"$limit": CATALOG_FACET_CATEGORIES},
+            ],
+            "price": [
+                {"$match": by_price},
+                {"$bucket": {
+                    "groupBy": "$price",
+                    "boundaries": PRICE_FACET_BOUNDARIES,
+                    "default": PRICE_FACET_BOUNDARIES[-1],
+                    "output": {"count": {"$sum": 1}},
+                }},
+            ],
+        }},
+    ]).to_list(1)
+    facets = result[0] if result else {"categories": [], "price": []}
+    upper_bounds = dict(zip(PRICE_FACET_BOUNDARIES, PRICE_FACET_BOUNDARIES[1:]))
+    return {
+        "categories": [{"category": row["_id"], "count": row["count"]} for row in facets["categories"]],
+        "price": [
+            {"min": row["_id"], "max": upper_bounds.get(row["_id"]), "count": row["count"]}
+            for row in facets["price"]
+        ],
+    }
+
+@api_router.get("/products/suggest")
+async def suggest_products(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(CATALOG_SUGGEST_LIMIT, ge=1, le=50),
+    current_user: User = Depends(get_current_user),
+):
+    if CATALOG_INDEX_ENABLED:
+        return catalog_index.search(q, limit)
+    # Without the in-process index only whole words match, through the text index
+    projection = {"_id": 0, "id": 1, "name": 1, "category": 1, "price": 1, "image_sha256": 1}
+    products = await db.products.find(text_filter(q), projection).limit(limit).to_list(limit)
+    return [product_response(product) for product in products]
+
+@api_router.get("/products/{product_id}", response_model=ProductResponse)
+async def get_product(product_id: str, current_user: User = Depends(get_current_user)):
+    product = await db.products.find_one({"id": product_id}, PRODUCT_PROJECTION)
+    if product is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return product_response(product)
+
+@api_router.put("/products/{product_id}", response_model=ProductResponse)
+async def update_product(product_id: str, product_update: ProductUpdate, current_user: User = Depends(get_current_user)):
+    update_data = {k: v for k, v in product_update.dict().items() if v is not None}
+    update_data["updated_at"] = datetime.utcnow()
+    product = await db.products.find_one_and_update(
+        {"id": product_id, "created_by": current_user.id},
+        {"$set": update_data},
+        projection={"_id": 0, "image_blob_id": 0, "image_content_type": 0},
+        return_document=ReturnDocument.AFTER,
+    )
+    if product is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    if CATALOG_INDEX_ENABLED:
+        catalog_index.add(product)
+    product.pop("updated_at")
+    return product_response(product)
+
+@api_router.get("/products/{product_id}/image")
+async def get_product_image(product_id: str, request: Request):
+    # Unauthenticated so <img> tags can load it; the catalog is visible to every user anyway
+    product = await db.products.find_one(
+        {"id": product_id}, {"_id": 0, "image_sha256": 1, "image_content_type": 1}
+    )
+    if product is None or not product.get("image_sha256"):
+        raise HTTPException(status_code=404, detail="Image not found")
+    etag = f'"{product["image_sha256"]}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    blob = await find_blob(product["image_sha256"])
+    # Images are proxied even from S3: a presigned redirect would expire under the immutable caching
+    store_name, key = blob_location(blob)
+    accel_path = blob_store(store_name).accel_path(key)
+    media_type = product["image_content_type"] or "application/octet-stream"
+    if accel_path is not None:
+        return Response(media_type=media_type, headers={**headers, "X-Accel-Redirect": accel_path})
+    headers["Content-Length"] = str(blob["size"])
+    return StreamingResponse(
+        read_blob(blob, 0, blob["size"]),
+        media_type=media_type,
+        headers=headers,
+    )
+
+# Orders
+# Checkout reads every product in the cart with one $in query, then reserves stock with one ordered
+# bulk_write of conditional $incs and inserts the order inside a single transaction, so a cart reserves
+# all of its items or none of them. An Idempotency-Key header is stored on the order under a unique
+# index; a retried request gets the original order back instead of placing a second one.
+# Transactions need a replica set (or mongos). Against a standalone mongod, which start_services()
+# detects, each item is reserved with its own conditional $inc and put back if a later step fails.
+ORDER_PROJECTION = {"_id": 0, "idempotency_key": 0, "request_hash": 0}
+transactions_supported = False
+
+async def detect_transaction_support() -> bool:
+    hello = await client.admin.command("hello")
+    return bool(hello.get("setName")) or hello.get("msg") == "isdbgrid"
+
+def order_request_hash(order_data: OrderCreate) -> str:
+    return hashlib.sha256(json.dumps(jsonable_encoder(order_data), sort_keys=True).encode()).hexdigest()
+
+async def find_idempotent_order(user_id: str, idempotency_key: str, request_hash: str) -> Optional[Dict[str, Any]]:
+    order = await db.orders.find_one({"created_by": user_id, "idempotency_key": idempotency_key}, {"_id": 0})
+    if order is not None and order["request_hash"] != request_hash:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different order")
+    return order
+
+async def place_order(order_data: OrderCreate, user: User, idempotency_key: Optional[str]) -> tuple:
+    # Returns (order document, replayed)
+    request_hash = order_request_hash(order_data)
+    if idempotency_key:
+        existing = await find_idempotent_order(user.id, idempotency_key, request_hash)
+        if existing is not None:
+            return existing, True
+
+    quantities: Dict[str, int] = {}
+    for item in order_data.items:
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+    quoted = {item.product_id: item.price for item in order_data.items}
+    products = {
+        product["id"]: product
+        for product in await db.products.find(
+            {"id": {"$in": list(quantities)}}, {"_id": 0, "id": 1, "name": 1, "price": 1, "stock_quantity": 1}
+        ).limit(len(quantities)).to_list(len(quantities))
+    }
+    missing = [product_id for product_id in quantities if product_id not in products]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Products not found: {', '.join(missing)}")
+    repriced = [product_id for product_id, price in quoted.items() if products[product_id]["price"] != price]
+    if repriced:
+        raise HTTPException(status_code=409, detail=f"Prices changed for: {', '.join(products[p]['name'] for p in repriced)}")
+    short = [product_id for product_id, quantity in quantities.items() if products[product_id]["stock_quantity"] < quantity]
+    if short:
+        raise HTTPException(status_code=409, detail=f"Insufficient stock for: {', '.join(products[p]['name'] for p in short)}")
+
+    items = [
+        OrderItem(product_id=product_id, quantity=quantity, price=products[product_id]["price"],
+                  product_name=products[product_id]["name"])
+        for product_id, quantity in quantities.items()
+    ]
+    order = Order(
+        items=items,
+        total_amount=round(sum(item.price * item.quantity for item in items), 2),
+        shipping_address=order_data.shipping_address,
+        created_by=user.id,
+    )
+    document = {**order.dict(), "idempotency_key": idempotency_key, "request_hash": request_hash}
+    # The stock check above was only a fast path; the $gte filter is what prevents overselling
+    reservations = [
+        UpdateOne({"id": product_id, "stock_quantity": {"$gte": quantity}}, {"$inc": {"stock_quantity": -quantity}})
+        for product_id, quantity in quantities.items()
+    ]
+
+    async def reserve_and_insert(session):
+        result = await db.products.bulk_write(reservations, ordered=True, session=session)
+        if result.modified_count != len(reservations):
+            raise HTTPException(status_code=409, detail="Insufficient stock")
+        await db.orders.insert_one(document, session=session)
+
+    async def reserve_and_insert_without_transaction():
+        reserved = []
+        try:
+            for product_id, quantity in quantities.items():
+                result = await db.products.update_one(
+                    {"id": product_id, "stock_quantity": {"$gte": quantity}}, {"$inc": {"stock_quantity": -quantity}}
+                )
+                if not result.modified_count:
+                    raise HTTPException(status_code=409, detail="Insufficient stock")
+                reserved.append(UpdateOne({"id": product_id}, {"$inc": {"stock_quantity": quantity}}))
+            await db.orders.insert_one(document)
+        except BaseException:
+            # Compensate instead of rolling back: return the stock this request already took
+            if reserved:
+                await db.products.bulk_write(reserved, ordered=False)
+            raise
+
+    try:
+        if transactions_supported:
+            # with_transaction retries write conflicts between concurrent checkouts of the same product
+            async with await client.start_session() as session:
+                await session.with_transaction(reserve_and_insert, read_preference=ReadPreference.PRIMARY)
+        else:
+            await reserve_and_insert_without_transaction()
+    except DuplicateKeyError:
+        # A concurrent retry with the same Idempotency-Key committed first; this request's reservations were undone
+        return await find_idempotent_order(user.id, idempotency_key, request_hash), True
+    document.pop("_id", None)
+    await record_activity(user.id, {"orders": 1}, f"Placed order #{order.id[-8:]}")
+    return document, False
+
+# Order routes
+@api_router.post("/orders", response_model=Order)
+async def create_order(
+    order_data: OrderCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+    current_user: User = Depends(get_current_user),
+):
+    order, replayed = await place_order(order_data, current_user, idempotency_key)
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return order
+
+@api_router.get("/orders", response_model=List[Order])
+async def list_orders(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+):
+    orders = await fetch_page(db.orders, {"created_by": current_user.id}, ORDER_PROJECTION, limit, cursor, response)
+    return json_response(orders, headers=response.headers)
+
+@api_router.get("/orders/{order_id}", response_model=Order)
+async def get_order(order_id: str, current_user: User = Depends(get_current_user)):
+    order = await db.orders.find_one({"id": order_id, "created_by": current_user.id}, ORDER_PROJECTION)
+    if order is None:
+        raise HTTPException(status_code=404, detail="Order not found")
+    return order
+
+# Chat hub
+# Fan-out of new messages to this worker's WebSocket and long-poll subscribers of a room. Messages
+# reach every worker through the state backend's "chat:<room_id>" channel. A subscriber whose queue
+# fills up is dropped (it receives None) and is expected to resume with ?after=.
+class ChatHub:
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.rooms: Dict[str, set] = {}
+
+    def subscribe(self, room_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.rooms.setdefault(room_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, room_id: str, queue: asyncio.Queue) -> None:
+        subscribers = self.rooms.get(room_id)
+        if subscribers is not None:
+            subscribers.discard(queue)
+            if not subscribers:
+                del self.rooms[room_id]
+
+    def publish(self, room_id: str, message: Dict[str, Any]) -> None:
+        for queue in list(self.rooms.get(room_id, ())):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self.unsubscribe(room_id, queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"rooms": len(self.rooms), "subscribers": sum(len(s) for s in self.rooms.values())}
+
+chat_hub = ChatHub(CHAT_SUBSCRIBER_QUEUE_SIZE)
+
+# Chat message store
+# Each message gets a per-room seq from an $inc on its room, so windowed reads are range scans on
+# (room_id, seq). The newest CHAT_BUFFER_SIZE messages of recently active rooms stay in ring buffers
+# and the common "anything new?" read is answered from memory. Posts to a room are serialized per
+# process so buffers and subscribers always see seqs in order.
+class RoomBuffer:
+    def __init__(self, size: int, messages: List[Dict[str, Any]], last_seq: int):
+        self.messages: deque = deque(messages, maxlen=size)
+        self.last_seq = last_seq
+        # True while the buffer still holds the room's entire history
+        self.complete = len(messages) < size
+
+    @property
+    def first_seq(self) -> int:
+        return self.messages[0]["seq"] if self.messages else self.last_seq + 1
+
+    def append(self, message: Dict[str, Any]) -> None:
+        if len(self.messages) == self.messages.maxlen:
+            self.complete = False
+        self.messages.append(message)
+        self.last_seq = message["seq"]
+
+    def window(self, after_seq: Optional[int], before_seq: Optional[int], limit: int) -> Optional[List[Dict[str, Any]]]:
+        # None when the requested window reaches past what the buffer holds
+        if after_seq is not None:
+            if not self.complete and after_seq < self.first_seq - 1:
+                return None
+            return [m for m in self.messages if m["seq"] > after_seq][:limit]
+        end = self.last_seq if before_seq is None else min(before_seq - 1, self.last_seq)
+        window = [m for m in self.messages if m["seq"] <= end][-limit:]
+        if len(window) < limit and not self.complete:
+            return None
+        return window
+
+chat_buffers: "OrderedDict[str, RoomBuffer]" = OrderedDict()
+chat_room_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+room_member_cache = TTLCache(ROOM_MEMBER_CACHE_SIZE, ROOM_MEMBER_CACHE_TTL_SECONDS)
+
+def chat_room_lock(room_id: str) -> asyncio.Lock:
+    lock = chat_room_locks.get(room_id)
+    if lock is None:
+        lock = chat_room_locks[room_id] = asyncio.Lock()
+    return lock
+
+async def get_room_buffer(room_id: str) -> RoomBuffer:
+    buffer = chat_buffers.get(room_id)
+    if buffer is None:
+        async with chat_room_lock(room_id):
+            buffer = chat_buffers.get(room_id)
+            if buffer is None:
+                room = await db.chat_rooms.find_one({"id": room_id}, {"last_seq": 1})
+                latest = await db.chat_messages.find({"room_id": room_id}, MESSAGE_PROJECTION).sort(
+                    "seq", DESCENDING
+                ).limit(CHAT_BUFFER_SIZE).to_list(CHAT_BUFFER_SIZE)
+                buffer = RoomBuffer(CHAT_BUFFER_SIZE, latest[::-1], (room or {}).get("last_seq", 0))
+                chat_buffers[room_id] = buffer
+                while len(chat_buffers) > CHAT_BUFFER_ROOMS:
+                    chat_buffers.popitem(last=False)
+    chat_buffers.move_to_end(room_id)
+    return buffer
+
+# Chat routes
+MESSAGE_PROJECTION = {"_id": 0}
+
+def room_member_query(user: User) -> Dict[str, Any]:
+    return {"participants": {"$in": [user.id, user.email]}}
+
+async def check_room_member(room_id: str, user: User) -> None:
+    key = f"{room_id}:{user.id}"
+    if room_member_cache.get(key):
+        return
+    room = await db.chat_rooms.find_one({"id": room_id, **room_member_query(user)}, {"_id": 1})
+    if room is None:
+        raise HTTPException(status_code=404, detail="Chat room not found")
+    room_member_cache.set(key, True)
+
+async def message_seq(room_id: str, buffer: RoomBuffer, message_id: Optional[str]) -> Optional[int]:
+    if not message_id:
+        return None
+    for message in buffer.messages:
+        if message["id"] == message_id:
+            return message["seq"]
+    message = await db.chat_messages.find_one({"id": message_id, "room_id": room_id}, {"seq": 1})
+    if message is None:
+        raise HTTPException(status_code=400, detail="Unknown message id")
+    return message["seq"]
+
+async def read_messages(room_id: str, buffer: RoomBuffer, after_seq: Optional[int] = None,
+                        before_seq: Optional[int] = None, limit: int = CHAT_HISTORY_LIMIT) -> List[Dict[str, Any]]:
+    messages = buffer.window(after_seq, before_seq, limit)
+    if messages is not None:
+        return messages
+    if after_seq is not None:
+        return await db.chat_messages.find(
+            {"room_id": room_id, "seq": {"$gt": after_seq}}, MESSAGE_PROJECTION
+        ).sort("seq", ASCENDING).limit(limit).to_list(limit)
+    query: Dict[str, Any] = {"room_id": room_id}
+    if before_seq is not None:
+        query["seq"] = {"$lt": before_seq}
+    latest = await db.chat_messages.find(query, MESSAGE_PROJECTION).sort("seq", DESCENDING).limit(limit).to_list(limit)
+    return latest[::-1]
+
+def buffer_message(room_id: str, message: Dict[str, Any]) -> None:
+    buffer = chat_buffers.get(room_id)
+    if buffer is None:
+        return
+    if message["seq"] != buffer.last_seq + 1:
+        # Another process wrote to this room; reload from Mongo on the next read
+        del chat_buffers[room_id]
+        return
+    buffer.append(message)
+
+def deliver_chat_message(room_id: str, message: Dict[str, Any]) -> None:
+    # Runs for messages posted through any worker; ones posted here are already buffered
+    buffer = chat_buffers.get(room_id)
+    if buffer is not None and message["seq"] > buffer.last_seq:
+        buffer_message(room_id, message)
+    chat_hub.publish(room_id, message)
+
+async def post_message(message_data: ChatMessageCreate, user: User) -> ChatMessage:
+    room_id = message_data.room_id
+    async with chat_room_lock(room_id):
+        # Allocating the seq doubles as the membership check
+        room = await db.chat_rooms.find_one_and_update(
+            {"id": room_id, **room_member_query(user)},
+            {"$inc": {"last_seq": 1}},
+            projection={"last_seq": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+        if room is None:
+            raise HTTPException(status_code=404, detail="Chat room not found")
+        message = ChatMessage(
+            room_id=room_id,
+            seq=room["last_seq"],
+            sender_id=user.id,
+            sender_name=user.full_name,
+            content=message_data.content,
+            message_type=message_data.message_type
+        )
+        message_dict = message.dict()
+        try:
+            await db.chat_messages.insert_one(message_dict)
+        except BaseException:
+            # The seq is burned; drop the buffer so the gap is picked up from Mongo
+            chat_buffers.pop(room_id, None)
+            raise
+        message_dict.pop("_id", None)
+        buffer_message(room_id, message_dict)
+    await state.publish(f"chat:{room_id}", message_dict)
+    await record_activity(user.id, {"messages": 1})
+    return message
+
+@api_router.post("/chat/rooms", response_model=ChatRoom)
+async def create_chat_room(room_data: ChatRoomCreate, current_user: User = Depends(get_current_user)):
+    participants = list(dict.fromkeys([current_user.id, *room_data.participants]))
+    room = ChatRoom(
+        name=room_data.name,
+        description=room_data.description,
+        participants=participants,
+        created_by=current_user.id
+    )
+    await db.chat_rooms.insert_one(room.dict())
+    return room
+
+@api_router.get("/chat/rooms", response_model=List[ChatRoom])
+async def list_chat_rooms(current_user: User = Depends(get_current_user)):
+    return json_array_response(db.chat_rooms.find(room_member_query(current_user), {"_id": 0}).sort(
+        "created_at", DESCENDING
+    ).limit(MAX_PAGE_SIZE))
+
+@api_router.post("/chat/messages", response_model=ChatMessage)
+async def send_chat_message(message_data: ChatMessageCreate, current_user: User = Depends(get_current_user)):
+    return await post_message(message_data, current_user)
+
+@api_router.get("/chat/rooms/{room_id}/messages", response_model=List[ChatMessage])
+async def list_chat_messages(
+    room_id: str,
+    request: Request,
+    after_id: Optional[str] = None,
+    before_id: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(CHAT_HISTORY_LIMIT, ge=1, le=CHAT_HISTORY_LIMIT),
+    wait: float = Query(0, ge=0, le=CHAT_LONG_POLL_MAX_SECONDS),
+    current_user: User = Depends(get_current_user),
+):
+    # Without ids this returns the latest history. after_id (alias: after) returns only newer messages
+    # and before_id pages back through older ones. Adding ?wait= to an after_id read turns it into a
+    # long poll that holds the request until a message arrives or the wait expires.
+    await check_room_member(room_id, current_user)
+    buffer = await get_room_buffer(room_id)
+    after_seq = await message_seq(room_id, buffer, after_id or after)
+    before_seq = await message_seq(room_id, buffer, before_id)
+    if after_seq is None or not wait:
+        messages = await read_messages(room_id, buffer, after_seq, before_seq, limit)
+        # Versioned by the newest message actually read: buffer.last_seq is per process and can lag
+        # messages written through other workers
+        newest = max((message["seq"] for message in messages), default=after_seq)
+        etag = f'W/"{newest}-{after_seq}-{before_seq}-{limit}"'
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return json_response(messages, headers=headers)
+    # Long polls carry no ETag: a browser revalidating the same URL would get an instant 304 and turn
+    # the poll into a tight request loop
+    headers = {"Cache-Control": "no-store"}
+    queue = chat_hub.subscribe(room_id)
+    try:
+        messages = await read_messages(room_id, buffer, after_seq, None, limit)
+        if not messages:
+            try:
+                message = await asyncio.wait_for(queue.get(), timeout=wait)
+            except asyncio.TimeoutError:
+                message = None
+            messages = [message] if message is not None else []
+            while not queue.empty() and (message := queue.get_nowait()) is not None:
+                messages.append(message)
+            # Messages from other workers can arrive out of seq order
+            messages = sorted((m for m in messages if after_seq is None or m["seq"] > after_seq), key=lambda m: m["seq"])
+        return json_response(messages, headers=headers)
+    finally:
+        chat_hub.unsubscribe(room_id, queue)
+
+@api_router.websocket("/chat/rooms/{room_id}/ws")
+async def chat_room_socket(websocket: WebSocket, room_id: str, token: str, after: Optional[str] = None):
+    # Browsers cannot set headers on WebSocket requests, so the JWT comes in the ?token= query param
+    try:
+        user = await load_principal(verify_access_token(token))
+        await check_room_member(room_id, user)
+        buffer = await get_room_buffer(room_id)
+        after_seq = await message_seq(room_id, buffer, after)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    queue = chat_hub.subscribe(room_id)
+    try:
+        # Subscribe before reading the backlog so nothing published in between is missed
+        backlog = await read_messages(room_id, buffer, after_seq)
+        last_sent = backlog[-1]["seq"] if backlog else (after_seq or buffer.last_seq)
+        for message in backlog:
+            await websocket.send_text(json_text(message))
+
+        async def receive():
+            # A bad frame or a rejected post is reported on the socket, which stays open
+            while True:
+                text = await websocket.receive_text()
+                try:
+                    message_data = ChatMessageCreate(**{**json.loads(text), "room_id": room_id})
+                except (ValidationError, ValueError, TypeError):
+                    await websocket.send_json({"error": "Invalid message"})
+                    continue
+                try:
+                    await post_message(message_data, user)
+                except HTTPException as exc:
+                    await websocket.send_json({"error": exc.detail})
+
+        async def send():
+            nonlocal last_sent
+            while True:
+                message = await queue.get()
+                if message is None:
+                    await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+                    return
+                if message["seq"] <= last_sent:
+                    continue
+                batch = [message]
+                if message["seq"] > last_sent + 1:
+                    # Messages posted through other workers can arrive out of order; fill the gap from storage
+                    missing = await read_messages(room_id, await get_room_buffer(room_id), last_sent)
+                    batch = [m for m in missing if m["seq"] < message["seq"]] + batch
+                for item in batch:
+                    await websocket.send_text(json_text(item))
+                    last_sent = item["seq"]
+
+        tasks = [asyncio.create_task(receive()), asyncio.create_task(send())]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            if not isinstance(task.exception(), (WebSocketDisconnect, type(None))):
+                raise task.exception()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        chat_hub.unsubscribe(room_id, queue)
+
+# Analytics routes
+@api_router.get("/analytics/dashboard")
+async def get_analytics_dashboard(current_user: User = Depends(get_current_user)):
+    counters = await db.analytics_counters.find_one({"_id": f"user:{current_user.id}"}) or {}
+    dashboard = {
+        "overview": dashboard_overview(counters),
+        "recent_activity": counters.get("recent_activity", [])[::-1],
+        "updated_at": counters.get("updated_at"),
+    }
+    if current_user.role.admin:
+        dashboard["global"] = dashboard_overview(await global_counters())
+    return dashboard
+
+@api_router.post("/analytics/metrics", response_model=Metric)
+async def create_metric(metric_data: MetricCreate, current_user: User = Depends(get_current_user)):
+    point = metric_point(metric_data, current_user.id)
+    await enqueue_metrics([point])
+    return point_response(point)
+
+@api_router.post("/analytics/metrics/bulk")
+async def create_metrics_bulk(metrics: List[MetricCreate], current_user: User = Depends(get_current_user)):
+    if len(metrics) > METRICS_MAX_BULK:
+        raise HTTPException(status_code=413, detail=f"At most {METRICS_MAX_BULK} points per request")
+    await enqueue_metrics([metric_point(metric, current_user.id) for metric in metrics])
+    return {"accepted": len(metrics)}
+
+@api_router.get("/analytics/metrics", response_model=List[Metric])
+async def list_metrics(
+    limit: int = Query(METRICS_RECENT_LIMIT, ge=1, le=MAX_PAGE_SIZE),
+    current_user: User = Depends(get_current_user),
+):
+    return json_response(await recent_metrics(current_user.id, limit))
+
+@api_router.get("/analytics/metrics/series")
+async def get_metric_series(
+    name: str,
+    start: datetime,
+    end: Optional[datetime] = None,
+    step: Optional[float] = Query(None, gt=0, description="Requested resolution in seconds"),
+    max_points: int = Query(500, ge=1, le=METRICS_MAX_POINTS),
+    current_user: User = Depends(get_current_user),
+):
+    start, end = naive_utc(start), naive_utc(end) if end else datetime.utcnow()
+    if end <= start:
+        raise HTTPException(status_code=400, detail="end must be after start")
+    step = step or (end - start).total_seconds() / max_points
+    resolution = pick_resolution(step, (end - start).total_seconds())
+    if resolution is None:
+        points, truncated = await raw_series(current_user.id, name, start, end)
+    else:
+        points, truncated = await rollup_series(current_user.id, name, resolution, start, end)
+    return json_response({"name": name, "resolution": resolution or "raw", "points": points, "truncated": truncated})
+
+@api_router.post("/analytics/widgets", response_model=Widget)
+async def create_widget(widget_data: WidgetCreate, current_user: User = Depends(get_current_user)):
+    widget = Widget(**widget_data.dict(), created_by=current_user.id)
+    await db.analytics_widgets.insert_one(widget.dict(exclude={"data"}))
+    if widget.query:
+        widget.data = (await evaluate_widget_queries(current_user.id, [widget.query]))[0]
+    return widget
+
+@api_router.get("/analytics/widgets", response_model=List[Widget])
+async def list_widgets(current_user: User = Depends(get_current_user)):
+    widgets = await db.analytics_widgets.find({"created_by": current_user.id}, {"_id": 0}).sort(
+        "created_at", ASCENDING
+    ).limit(MAX_PAGE_SIZE).to_list(MAX_PAGE_SIZE)
+    for widget in widgets:
+        widget["data"] = None
+    query_widgets = [w for w in widgets if w.get("query")]
+    data = await evaluate_widget_queries(current_user.id, [WidgetQuery(**w["query"]) for w in query_widgets])
+    for widget, widget_data in zip(query_widgets, data):
+        widget["data"] = widget_data
+    return json_response(widgets)
+
 # Health check
 @api_router.get("/")
 async def root():
     return {"message": "API is up and running"}
 
+@api_router.get("/health/ready")
+async def readiness():
+    # 503 until startup (index builds, pool warm-up) has finished, or when Mongo does not answer a ping
+    pool = pool_monitor.stats()
+    if not services_ready:
+        return json_response({"status": "starting", "pool": pool}, status_code=503)
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(db.command("ping"), READY_PING_TIMEOUT_SECONDS)
+    except Exception as exc:
+        return json_response({"status": "unavailable", "error": str(exc)[:200], "pool": pool}, status_code=503)
+    return {"status": "ready", "ping_ms": round((time.perf_counter() - start) * 1000, 3), "pool": pool}
+
+@api_router.get("/health/storage")
+async def get_storage_stats(current_user: User = Depends(get_admin_user)):
+    stats = storage_stats_cache.get("storage")
+    if stats is None:
+        stats = await storage_stats()
+        storage_stats_cache.set("storage", stats)
+    return stats
+
+@api_router.get("/health/jobs")
+async def job_queue_stats(current_user: User = Depends(get_admin_user)):
+    now = datetime.utcnow()
+    return {
+        "queued": await db.jobs.estimated_document_count(),
+        "due": await db.jobs.count_documents({"visible_at": {"$lte": now}}),
+        "dead": await db.dead_jobs.estimated_document_count(),
+        **job_stats,
+    }
+
+@api_router.get("/health/cache")
+async def cache_stats(current_user: User = Depends(get_admin_user)):
+    return {
+        "state": state.stats(),
+        "tokens": {**token_cache.stats(), "revoked": len(revoked_tokens)},
+        "chat": {**chat_hub.stats(), "buffered_rooms": len(chat_buffers)},
+        "metrics": {**metric_stats, "pending": len(metric_buffer), "pending_rollups": len(metric_pending_rollups),
+                    "storage": metric_storage},
+        "widgets": widget_cache.stats(),
+        "catalog": catalog_index.stats(),
+        "workflows": {**workflow_stats, "running": len(workflow_runs)},
+        "auth_rate_limits": auth_rate_stats,
+        "password_jobs": {"pending": password_jobs_pending, "max_pending": BCRYPT_MAX_PENDING, "workers": BCRYPT_WORKERS},
+    }
+
+def render_metrics() -> str:
+    lines = []
+    for histogram in (http_request_seconds, mongo_command_seconds, password_seconds, job_seconds):
+        lines += histogram.render()
+    lines += ["# HELP http_responses_total HTTP responses by route template and status", "# TYPE http_responses_total counter"]
+    for labels, count in sorted(http_responses.items()):
+        lines.append(f"http_responses_total{prometheus_labels(('method', 'route', 'status'), labels)} {count}")
+    lines += ["# HELP auth_rate_limit_total Login and register rate limit decisions", "# TYPE auth_rate_limit_total counter"]
+    lines += [f'auth_rate_limit_total{{result="{result}"}} {count}' for result, count in auth_rate_stats.items()]
+    pool = pool_monitor.stats()
+    gauges = [
+        ("http_requests_in_flight", "HTTP requests being handled", {(): http_requests_in_flight}),
+        ("bcrypt_jobs_pending", "Password jobs queued or running", {(): password_jobs_pending}),
+        ("mongo_pool_checked_out", "Mongo connections in use", {(a,): n for a, n in pool["checked_out"].items()}),
+        ("mongo_pool_open", "Open Mongo connections", {(a,): n for a, n in pool["open"].items()}),
+    ]
+    for name, help_text, values in gauges:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        lines += [f"{name}{prometheus_labels(('server',), labels)} {value}" for labels, value in values.items()]
+    return "\n".join(lines) + "\n"
+
+async def get_metrics_scraper(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    if METRICS_TOKEN and hmac.compare_digest(credentials.credentials.encode(), METRICS_TOKEN.encode()):
+        return None
+    return await get_admin_user(await get_current_user(credentials))
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(scraper: Optional[User] = Depends(get_metrics_scraper)):
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # Router registration
 app.include_router(api_router)
 
@@ -181,6 +4297,84 @@ app.include_router(api_router)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
+# Lifespan
+def on_state_message(channel: str, message: Any) -> None:
+    kind, _, key = channel.partition(":")
+    if kind == "chat":
+        deliver_chat_message(key, message)
+    elif kind == "workflow" and workflow_wakeup is not None:
+        workflow_wakeup.set()
+    elif kind == "jobs" and job_wakeup is not None:
+        job_wakeup.set()
+    elif kind == "revoked":
+        forget_revoked_token(key, message)
+
+async def start_services() -> None:
+    global client, db, password_executor, services_ready, state, workflow_wakeup, job_wakeup, job_process_pool
+    global transactions_supported
+    state = make_state_backend()
+    await state.start(on_state_message)
+    client = make_mongo_client()
+    db = client[MONGO_DB_NAME]
+    password_executor = make_password_executor()
+    workflow_wakeup = asyncio.Event()
+    await warm_mongo_pool()
+    transactions_supported = await detect_transaction_support()
+    if not transactions_supported:
+        logger.warning("MongoDB is a standalone server: checkout reserves stock without transactions; "
+                       "run a replica set so a failed checkout cannot leave stock briefly reserved")
+    # The metrics time-series collection must exist before ensure_indexes() touches it
+    await ensure_metric_storage(db)
+    await ensure_indexes(db)
+    await backfill_folder_ancestors()
+    if INDEX_SELF_CHECK:
+        await check_hot_queries(db)
+    await load_revoked_tokens(db)
+    if CATALOG_INDEX_ENABLED:
+        await sync_catalog_index()
+        background_tasks.append(asyncio.create_task(run_catalog_indexer()))
+    for loop in (run_blob_gc, run_metric_flusher, run_workflow_scheduler):
+        background_tasks.append(asyncio.create_task(loop()))
+    await schedule_periodic_job("reconcile_analytics", ANALYTICS_RECONCILE_INTERVAL_SECONDS)
+    if JOB_APP_CONSUMERS:
+        job_wakeup = asyncio.Event()
+        job_process_pool = ProcessPoolExecutor(max_workers=JOB_PROCESSES)
+        background_tasks.extend(asyncio.create_task(run_job_consumer()) for _ in range(JOB_APP_CONSUMERS))
+    services_ready = True
+
+async def stop_services() -> None:
+    global services_ready
+    services_ready = False
+    # Workflow passes cut short here are retried by whichever worker claims them after the lease expires
+    for task in [*background_tasks, *workflow_runs]:
+        task.cancel()
+    background_tasks.clear()
+    try:
+        await flush_metrics()
+    except Exception:
+        logger.exception("Final metric flush failed")
     client.close()
+    password_executor.shutdown(wait=False)
+    if job_process_pool is not None:
+        job_process_pool.shutdown(wait=False, cancel_futures=True)
+    await state.close()
+
+async def run_job_worker(consumers: int, processes: int, backfill_text: bool = False) -> None:
+    # worker.py entry point: job consumers only, without the web app's background loops. Jobs
+    # interrupted by a shutdown reappear once their visibility timeout lapses.
+    global client, db, state, job_wakeup, job_process_pool
+    state = make_state_backend()
+    await state.start(on_state_message)
+    client = make_mongo_client()
+    db = client[MONGO_DB_NAME]
+    job_wakeup = asyncio.Event()
+    job_process_pool = ProcessPoolExecutor(max_workers=processes)
+    logger.info(f"Job worker started with {consumers} consumers and {processes} processes")
+    try:
+        if backfill_text:
+            logger.info(f"Queued text extraction for {await backfill_document_text()} existing documents")
+        await asyncio.gather(*[run_job_consumer() for _ in range(consumers)])
+    finally:
+        job_process_pool.shutdown(wait=False, cancel_futures=True)
+        client.close()
+        await state.close()
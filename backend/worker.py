@@ -0,0 +1,30 @@
+"""Runs the background job queue outside the web workers.
+
+    cd backend && python worker.py --consumers 8 --processes 4
+
+Consumers are asyncio tasks claiming jobs from MongoDB; handlers hand CPU-bound work to a pool of
+``--processes`` processes. Once a worker runs, set JOB_APP_CONSUMERS=0 on the web workers so request
+handling no longer shares their CPU with jobs. Run as many workers as needed: claims are atomic.
+"""
+import argparse
+import asyncio
+import os
+
+import server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--consumers", type=int, default=int(os.environ.get("JOB_CONSUMERS", 8)))
+    parser.add_argument("--processes", type=int, default=int(os.environ.get("JOB_PROCESSES", os.cpu_count() or 1)))
+    parser.add_argument("--backfill-text", action="store_true",
+                        help="first queue text extraction for documents uploaded before search indexing")
+    args = parser.parse_args()
+    try:
+        asyncio.run(server.run_job_worker(args.consumers, args.processes, args.backfill_text))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""Benchmarks for the neokatalyst backend.
+
+Load benchmarks run against a live server, e.g.:
+
+    cd backend && AUTH_RATE_LIMIT_ENABLED=false uvicorn server:app --port 8000
+    BACKEND_URL=http://localhost:8000 python backend_benchmark.py login_storm
+
+Microbenchmarks (auth_roundtrips, ...) import backend/server.py in-process and
+need MONGO_URL pointing at a local mongod:
+
+    MONGO_URL=mongodb://localhost:27017 DB_NAME=neokatalyst_bench python backend_benchmark.py auth_roundtrips
+"""
+import os
+import sys
+import asyncio
+import time
+import uuid
+import statistics
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import requests
+from pymongo import monitoring
+
+BACKEND_URL = os.environ.get("BACKEND_URL", "http://localhost:8000")
+API_BASE_URL = f"{BACKEND_URL}/api"
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(label, samples):
+    ms = [s * 1000 for s in samples]
+    print(
+        f"{label:<32} n={len(ms):<6} p50={percentile(ms, 50):8.3f}ms "
+        f"p99={percentile(ms, 99):8.3f}ms max={max(ms, default=0):8.3f}ms"
+    )
+
+
+def register_user(session, password="BenchPassword123!", base_url=None):
+    email = f"bench.{uuid.uuid4()}@example.com"
+    response = session.post(
+        f"{base_url if base_url is not None else API_BASE_URL}/auth/register",
+        json={"email": email, "password": password, "full_name": "Bench User"},
+    )
+    response.raise_for_status()
+    return email, password, response.json()["access_token"]
+
+
+def sample_latency(session, url, duration, headers=None):
+    samples = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        session.get(url, headers=headers)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+# ============ LOGIN STORM ============
+
+def bench_login_storm(duration=10.0, concurrency=32):
+    """p99 of GET /api/ while `concurrency` clients hammer POST /api/auth/login.
+
+    Start the server with AUTH_RATE_LIMIT_ENABLED=false to measure bcrypt load; with the limiter on, all
+    but the first few logins are 429s and this measures the limiter instead.
+    """
+    session = requests.Session()
+    email, password, _ = register_user(session)
+
+    baseline = sample_latency(session, f"{API_BASE_URL}/", duration / 2)
+    report("GET /api/ (idle)", baseline)
+
+    stop = threading.Event()
+    statuses = {}
+    lock = threading.Lock()
+
+    def storm():
+        s = requests.Session()
+        while not stop.is_set():
+            code = s.post(f"{API_BASE_URL}/auth/login", json={"email": email, "password": password}).status_code
+            with lock:
+                statuses[code] = statuses.get(code, 0) + 1
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(storm)
+        time.sleep(0.5)
+        during = sample_latency(session, f"{API_BASE_URL}/", duration)
+        stop.set()
+
+    report("GET /api/ (login storm)", during)
+    print(f"login responses by status: {statuses}")
+    if statuses.get(429, 0) > sum(statuses.values()) / 2:
+        print("mostly 429s: the auth rate limiter is on, so this measured the limiter rather than bcrypt")
+    print(f"p99 ratio storm/idle: {percentile(during, 99) / max(percentile(baseline, 99), 1e-9):.2f}x")
+
+
+# ============ IN-PROCESS MICROBENCHMARKS ============
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.counts = {}
+
+    def started(self, event):
+        self.counts[event.command_name] = self.counts.get(event.command_name, 0) + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def reset(self):
+        counts, self.counts = self.counts, {}
+        return counts
+
+
+def load_app():
+    """Import backend/server.py with a command listener registered on its Mongo client."""
+    counter = CommandCounter()
+    monitoring.register(counter)
+    # Microbenchmarks drive hundreds of registrations and logins from one client address
+    os.environ.setdefault("AUTH_RATE_LIMIT_ENABLED", "false")
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+    import server
+    from fastapi.testclient import TestClient
+    return server, TestClient(server.app), counter
+
+
+def time_requests(client, counter, label, requests_to_run):
+    wall, cpu = [], []
+    counter.reset()
+    for method, url, kwargs in requests_to_run:
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        response = client.request(method, url, **kwargs)
+        wall.append(time.perf_counter() - start_wall)
+        cpu.append(time.process_time() - start_cpu)
+        assert response.status_code < 400, response.text
+    commands = counter.reset()
+    report(label, wall)
+    per_request = {name: round(n / len(requests_to_run), 2) for name, n in sorted(commands.items())}
+    print(f"{'':<32} cpu mean={statistics.mean(cpu) * 1000:.2f}ms mongo commands/request={per_request}")
+
+
+def bench_auth_roundtrips(iterations=200):
+    """Mongo round-trips, wall time and CPU per register/login/me request."""
+    server, client, counter = load_app()
+    with client:
+        password = "BenchPassword123!"
+        emails = [f"bench.{uuid.uuid4()}@example.com" for _ in range(iterations)]
+        time_requests(client, counter, "POST /api/auth/register", [
+            ("POST", "/api/auth/register", {"json": {"email": e, "password": password, "full_name": "Bench"}})
+            for e in emails
+        ])
+        time_requests(client, counter, "POST /api/auth/login", [
+            ("POST", "/api/auth/login", {"json": {"email": e, "password": password}}) for e in emails
+        ])
+        token = client.post("/api/auth/login", json={"email": emails[0], "password": password}).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        time_requests(client, counter, "GET /api/auth/me", [
+            ("GET", "/api/auth/me", {"headers": headers}) for _ in range(iterations)
+        ])
+
+
+def bench_token_verification(iterations=20000):
+    """Per-call cost of a full HS256 decode vs. the verified-token cache hit path."""
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+    import server
+    token = server.create_access_token({"sub": str(uuid.uuid4())})
+    for label, fn in [
+        ("jwt.decode (uncached)", lambda: server.decode_access_token(token)),
+        ("verify_access_token (cached)", lambda: server.verify_access_token(token)),
+    ]:
+        fn()
+        samples = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - start)
+        report(label, samples)
+
+
+def bench_dedup_uploads(files=200, distinct=40, size=256 * 1024):
+    """Upload a corpus where only `distinct` of `files` payloads are unique; report storage and timings."""
+    server, client, counter = load_app()
+    with client:
+        _, _, token = register_user(client, base_url="/api")
+        headers = {"Authorization": f"Bearer {token}"}
+        payloads = [os.urandom(size) for _ in range(distinct)]
+        seen = set()
+        first, repeat = [], []
+        for i in range(files):
+            index = i % distinct
+            start = time.perf_counter()
+            response = client.post(
+                "/api/documents", headers=headers,
+                files={"file": (f"file-{i}.bin", payloads[index], "application/octet-stream")},
+            )
+            elapsed = time.perf_counter() - start
+            assert response.status_code == 200, response.text
+            (repeat if index in seen else first).append(elapsed)
+            seen.add(index)
+        report("upload (new content)", first)
+        report("upload (duplicate content)", repeat)
+        stats = client.portal.call(server.storage_stats)
+        print(f"logical={stats['logical_bytes']} physical={stats['physical_bytes']} dedup_ratio={stats['dedup_ratio']:.2f}")
+
+
+def bench_checkout_contention(checkouts=500, stock=100, retries=100):
+    """`checkouts` parallel single-item orders for one product with `stock` units, plus `retries`
+    concurrent replays of the same Idempotency-Keys. Needs a live server on a replica set."""
+    session = requests.Session()
+    _, _, token = register_user(session)
+    headers = {"Authorization": f"Bearer {token}"}
+    product = session.post(
+        f"{API_BASE_URL}/products", headers=headers,
+        data={"name": f"Contended {uuid.uuid4()}", "price": 9.99, "stock_quantity": stock},
+    ).json()
+    body = {"items": [{"product_id": product["id"], "quantity": 1, "price": product["price"]}]}
+    keys = [str(uuid.uuid4()) for _ in range(checkouts)]
+
+    async def checkout(client, key):
+        start = time.perf_counter()
+        response = await client.post(f"{API_BASE_URL}/orders", json=body, headers={**headers, "Idempotency-Key": key})
+        return key, response.status_code, response.json().get("id"), time.perf_counter() - start
+
+    async def storm():
+        limits = httpx.Limits(max_connections=checkouts + retries)
+        async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+            return await asyncio.gather(*[checkout(client, key) for key in keys + keys[:retries]])
+
+    results = asyncio.run(storm())
+    report("POST /api/orders (contended)", [elapsed for *_, elapsed in results])
+    statuses = {}
+    order_ids = {}
+    for key, code, order_id, _ in results:
+        statuses[code] = statuses.get(code, 0) + 1
+        if code == 200:
+            order_ids.setdefault(key, set()).add(order_id)
+    remaining = session.get(f"{API_BASE_URL}/products/{product['id']}", headers=headers).json()["stock_quantity"]
+    placed = len(order_ids)
+    print(f"responses by status: {statuses}")
+    print(f"orders placed={placed} stock remaining={remaining} (initial {stock})")
+    assert placed + remaining == stock and remaining >= 0, "inventory oversold or lost"
+    assert all(len(ids) == 1 for ids in order_ids.values()), "a retried Idempotency-Key placed a second order"
+
+
+def bench_document_search(documents=100000, queries=300, words_per_document=150):
+    """p50/p95 of GET /api/documents/search over `documents` text-indexed documents owned by one user
+    (the owner_text index is partitioned by owner, so one large owner is the slow case). $text is not
+    emulated by mongomock; this needs a real mongod. Target: p95 under 50ms."""
+    import itertools
+    import random
+    server, client, counter = load_app()
+    rng = random.Random(7)
+    vocabulary = [f"w{i:05d}" for i in range(20000)]
+    # Zipf-like word frequencies, so queries hit both very common and rare terms
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    tag_pool = [f"tag{i}" for i in range(50)]
+    with client:
+        _, _, token = register_user(client, base_url="/api")
+        headers = {"Authorization": f"Bearer {token}"}
+        owner = client.get("/api/auth/me", headers=headers).json()["id"]
+        seed_start = time.perf_counter()
+        for offset in range(0, documents, 5000):
+            batch = []
+            for i in range(offset, min(offset + 5000, documents)):
+                words = rng.choices(vocabulary, cum_weights=cum_weights, k=words_per_document)
+                document = server.Document(
+                    filename=f"{' '.join(words[:3])}.txt", content_type="text/plain", size=0,
+                    tags=rng.sample(tag_pool, 2), blob_id=str(uuid.uuid4()), sha256=uuid.uuid4().hex,
+                    text_status="indexed", created_by=owner,
+                )
+                batch.append({**document.dict(), "content": " ".join(words)})
+            client.portal.call(server.db.documents.insert_many, batch)
+        print(f"seeded {documents} documents in {time.perf_counter() - seed_start:.1f}s")
+        searches = []
+        for i in range(queries):
+            pool = vocabulary[:50] if i % 3 == 0 else vocabulary[1000:5000] if i % 3 == 1 else vocabulary[5000:]
+            params = {"q": " ".join(rng.sample(pool, rng.randint(1, 3)))}
+            if i % 4 == 0:
+                params["tags"] = rng.choice(tag_pool)
+            searches.append(("GET", "/api/documents/search", {"headers": headers, "params": params}))
+        time_requests(client, counter, "search warm-up", searches[:20])
+        samples = []
+        for method, url, kwargs in searches:
+            start = time.perf_counter()
+            response = client.request(method, url, **kwargs)
+            samples.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.text
+        report("GET /api/documents/search", samples)
+        p95 = percentile(samples, 95) * 1000
+        print(f"p95={p95:.1f}ms ({'within' if p95 < 50 else 'over'} the 50ms target)")
+        client.portal.call(server.db.documents.delete_many, {"created_by": owner})
+
+
+def bench_serialization(iterations=2000, items=1000):
+    """Requests/sec of GET /api/auth/me and a 1,000-item list, against the same handlers mounted under
+    /baseline with the previous response path (response_model re-validation + stdlib json)."""
+    from typing import List
+    from fastapi import APIRouter, Depends
+    from fastapi.responses import JSONResponse
+    server, client, counter = load_app()
+    baseline = APIRouter(prefix="/baseline", default_response_class=JSONResponse)
+
+    @baseline.get("/auth/me", response_model=server.UserResponse)
+    async def baseline_me(current_user=Depends(server.get_current_user)):
+        return server.user_response(current_user)
+
+    @baseline.get("/documents/folders", response_model=List[server.Folder])
+    async def baseline_folders(current_user=Depends(server.get_current_user)):
+        return await server.db.document_folders.find({"created_by": current_user.id}, {"_id": 0}).limit(
+            server.MAX_FOLDERS
+        ).to_list(server.MAX_FOLDERS)
+
+    server.app.include_router(baseline)
+    with client:
+        _, _, token = register_user(client, base_url="/api")
+        headers = {"Authorization": f"Bearer {token}"}
+        for i in range(items):
+            client.post("/api/documents/folders", headers=headers, json={"name": f"Folder {i}"})
+        for label, path, n in [
+            ("/auth/me", "/auth/me", iterations),
+            (f"/documents/folders ({items} items)", "/documents/folders", max(iterations // 10, 1)),
+        ]:
+            rates = {}
+            for variant, prefix in [("before", "/baseline"), ("after", "/api")]:
+                assert len(client.get(prefix + path, headers=headers).content) > 0
+                start = time.perf_counter()
+                for _ in range(n):
+                    client.get(prefix + path, headers=headers)
+                rates[variant] = n / (time.perf_counter() - start)
+            print(f"{label:<32} before={rates['before']:8.1f} req/s after={rates['after']:8.1f} req/s "
+                  f"speedup={rates['after'] / rates['before']:.2f}x")
+
+
+def bench_instrumentation_overhead(iterations=100000):
+    """Per-request cost of MetricsMiddleware, driving it directly around a minimal ASGI app that resolves
+    a real route, against that app alone. Going through the router or TestClient adds hundreds of
+    microseconds of noise, which would swamp the few microseconds being measured."""
+    server, _, _ = load_app()
+    scope = {"type": "http", "method": "GET", "path": "/api/"}
+    start_message = {"type": "http.response.start", "status": 200, "headers": []}
+    body_message = {"type": "http.response.body", "body": b"{}"}
+
+    async def endpoint_app(scope, receive, send):
+        scope["endpoint"] = server.root
+        await send(start_message)
+        await send(body_message)
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    async def run(asgi_app):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            await asgi_app(dict(scope), receive, send)
+        return (time.perf_counter() - start) / iterations
+
+    async def compare():
+        instrumented = server.MetricsMiddleware(endpoint_app)
+        await instrumented(dict(scope), receive, send)
+        # Interleave rounds so CPU frequency drift hits both sides equally
+        results = {"plain": [], "instrumented": []}
+        for _ in range(5):
+            results["plain"].append(await run(endpoint_app))
+            results["instrumented"].append(await run(instrumented))
+        return {label: min(samples) for label, samples in results.items()}
+
+    results = asyncio.run(compare())
+    overhead = results["instrumented"] - results["plain"]
+    print(f"app only={results['plain'] * 1e6:.2f}us with MetricsMiddleware={results['instrumented'] * 1e6:.2f}us "
+          f"overhead={overhead * 1e6:.2f}us/request")
+    assert overhead < 50e-6, "instrumentation overhead exceeds 50us per request"
+
+BENCHMARKS = {
+    "login_storm": bench_login_storm,
+    "auth_roundtrips": bench_auth_roundtrips,
+    "token_verification": bench_token_verification,
+    "dedup_uploads": bench_dedup_uploads,
+    "checkout_contention": bench_checkout_contention,
+    "document_search": bench_document_search,
+    "serialization": bench_serialization,
+    "instrumentation_overhead": bench_instrumentation_overhead,
+}
+
+
+if __name__ == "__main__":
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    for name in selected:
+        print(f"\n=== {name} ===")
+        BENCHMARKS[name]()
@@ -69,10 +69,9 @@ const AnalyticsDashboard = () => {
       const sampleWidget = {
         title: "Performance Chart",
         type: "line_chart",
-        config: {
-          data: [10, 20, 30, 40, 50],
-          labels: ["Jan", "Feb", "Mar", "Apr", "May"]
-        },
+        config: {},
+        // Series data is computed server-side from the metric rollups
+        query: { metric: "User Engagement", aggregation: "avg", window: 86400, step: 3600 },
         position: { x: 0, y: 0, width: 6, height: 4 }
       };
       await axios.post(`${API}/analytics/widgets`, sampleWidget);
@@ -250,7 +249,12 @@ const AnalyticsDashboard = () => {
                   <div className="h-32 bg-gradient-to-r from-gray-50 to-gray-100 rounded flex items-center justify-center">
                     <div className="text-center">
                       <div className="text-2xl mb-2">📊</div>
-                      <p className="text-sm text-gray-600">Widget Preview</p>
+                      <p className="text-sm text-gray-600">
+                        {widget.data
+                          ? `${widget.data.values.length} points` +
+                            (widget.data.values.length ? ` · latest ${widget.data.values[widget.data.values.length - 1]}` : '')
+                          : 'Widget Preview'}
+                      </p>
                     </div>
                   </div>
                 </div>
@@ -26,12 +26,66 @@ const ChatCollaboration = () => {
   }, []);
 
   useEffect(() => {
-    if (selectedRoom) {
-      fetchMessages();
-      // Set up polling for new messages every 3 seconds
-      const interval = setInterval(fetchMessages, 3000);
-      return () => clearInterval(interval);
-    }
+    if (!selectedRoom) return;
+
+    // Push new messages over a WebSocket; if the socket cannot be used, fall back to long polling
+    // with ?after= so each request only returns messages we have not seen yet.
+    let closed = false;
+    let socket = null;
+    let lastId = null;
+
+    const appendMessages = (incoming) => {
+      if (incoming.length === 0) return;
+      lastId = incoming[incoming.length - 1].id;
+      setMessages(prev => {
+        const seen = new Set(prev.map(m => m.id));
+        return [...prev, ...incoming.filter(m => !seen.has(m.id))];
+      });
+    };
+
+    const longPoll = async () => {
+      while (!closed) {
+        try {
+          const params = lastId ? `?after_id=${lastId}&wait=25` : '';
+          const response = await axios.get(`${API}/chat/rooms/${selectedRoom.id}/messages${params}`);
+          if (!closed) appendMessages(response.data);
+          // An empty room has no message to long-poll after yet
+          if (!lastId) await new Promise(resolve => setTimeout(resolve, 3000));
+        } catch (error) {
+          console.error('Error fetching messages:', error);
+          await new Promise(resolve => setTimeout(resolve, 3000));
+        }
+      }
+    };
+
+    const connect = () => {
+      const token = localStorage.getItem('neokatalyst_token');
+      const wsBase = BACKEND_URL.replace(/^http/, 'ws');
+      const after = lastId ? `&after=${lastId}` : '';
+      let opened = false;
+      socket = new WebSocket(`${wsBase}/api/chat/rooms/${selectedRoom.id}/ws?token=${token}${after}`);
+      socket.onopen = () => { opened = true; };
+      socket.onmessage = (event) => {
+        const message = JSON.parse(event.data);
+        if (!message.error) appendMessages([message]);
+      };
+      socket.onclose = () => {
+        if (closed) return;
+        // A socket that was open resumes where it left off; one that never opened falls back to polling
+        if (opened) {
+          setTimeout(() => { if (!closed) connect(); }, 1000);
+        } else {
+          longPoll();
+        }
+      };
+    };
+
+    setMessages([]);
+    connect();
+    return () => {
+      closed = true;
+      if (socket) socket.close();
+    };
   }, [selectedRoom]);
 
   useEffect(() => {
@@ -51,17 +105,6 @@ const ChatCollaboration = () => {
     }
   };
 
-  const fetchMessages = async () => {
-    if (!selectedRoom) return;
-    
-    try {
-      const response = await axios.get(`${API}/chat/rooms/${selectedRoom.id}/messages`);
-      setMessages(response.data);
-    } catch (error) {
-      console.error('Error fetching messages:', error);
-    }
-  };
-
   const handleCreateRoom = async (e) => {
     e.preventDefault();
     try {
@@ -87,7 +130,6 @@ const ChatCollaboration = () => {
       
       await axios.post(`${API}/chat/messages`, messageData);
       setNewMessage('');
-      fetchMessages(); // Refresh messages immediately
     } catch (error) {
       console.error('Error sending message:', error);
     }
@@ -11,6 +11,7 @@ const DocumentManager = () => {
   const [documents, setDocuments] = useState([]);
   const [folders, setFolders] = useState([]);
   const [currentFolder, setCurrentFolder] = useState(null);
+  const [folderPath, setFolderPath] = useState([]);
   const [showUploadForm, setShowUploadForm] = useState(false);
   const [showFolderForm, setShowFolderForm] = useState(false);
   const [uploadData, setUploadData] = useState({
@@ -23,10 +24,13 @@ const DocumentManager = () => {
     parent_id: null
   });
   const [selectedFile, setSelectedFile] = useState(null);
+  const [searchQuery, setSearchQuery] = useState('');
+  const [searchResults, setSearchResults] = useState(null);
 
   useEffect(() => {
     fetchDocuments();
     fetchFolders();
+    fetchFolderPath();
   }, [currentFolder]);
 
   const fetchDocuments = async () => {
@@ -39,15 +43,77 @@ const DocumentManager = () => {
     }
   };
 
+  // Only the current level of the tree is loaded; each folder carries its child and document counts
   const fetchFolders = async () => {
     try {
-      const response = await axios.get(`${API}/documents/folders`);
+      const params = currentFolder ? `?parent_id=${currentFolder}` : '';
+      const response = await axios.get(`${API}/documents/folders/children${params}`);
       setFolders(response.data);
     } catch (error) {
       console.error('Error fetching folders:', error);
     }
   };
 
+  const fetchFolderPath = async () => {
+    if (!currentFolder) {
+      setFolderPath([]);
+      return;
+    }
+    try {
+      const response = await axios.get(`${API}/documents/folders/${currentFolder}`);
+      setFolderPath(response.data.path);
+    } catch (error) {
+      console.error('Error fetching folder path:', error);
+    }
+  };
+
+  const deleteFolder = async (event, folder) => {
+    event.stopPropagation();
+    if (!window.confirm(`Delete "${folder.name}" with all of its subfolders and documents?`)) return;
+    try {
+      await axios.delete(`${API}/documents/folders/${folder.id}`);
+      fetchFolders();
+    } catch (error) {
+      console.error('Error deleting folder:', error);
+    }
+  };
+
+  const handleSearch = async (e) => {
+    e.preventDefault();
+    if (!searchQuery.trim()) {
+      setSearchResults(null);
+      return;
+    }
+    try {
+      const params = new URLSearchParams({ q: searchQuery.trim() });
+      if (currentFolder) {
+        params.append('folder_id', currentFolder);
+      }
+      const response = await axios.get(`${API}/documents/search?${params}`);
+      setSearchResults(response.data);
+    } catch (error) {
+      console.error('Error searching documents:', error);
+    }
+  };
+
+  const clearSearch = () => {
+    setSearchQuery('');
+    setSearchResults(null);
+  };
+
+  // Snippet highlights arrive as [start, end) offsets into the snippet text
+  const renderSnippet = (result) => {
+    const parts = [];
+    let position = 0;
+    result.highlights.forEach(([start, end]) => {
+      parts.push(result.snippet.slice(position, start));
+      parts.push(<mark key={start} className="bg-yellow-200">{result.snippet.slice(start, end)}</mark>);
+      position = end;
+    });
+    parts.push(result.snippet.slice(position));
+    return parts;
+  };
+
   const handleFileSelect = (event) => {
     const file = event.target.files[0];
     if (file) {
@@ -60,33 +126,20 @@ const DocumentManager = () => {
     }
   };
 
-  const convertFileToBase64 = (file) => {
-    return new Promise((resolve, reject) => {
-      const reader = new FileReader();
-      reader.readAsDataURL(file);
-      reader.onload = () => {
-        const base64 = reader.result.split(',')[1]; // Remove data:type;base64, prefix
-        resolve(base64);
-      };
-      reader.onerror = (error) => reject(error);
-    });
-  };
-
   const handleUpload = async (e) => {
     e.preventDefault();
     if (!selectedFile) return;
 
     try {
-      const fileData = await convertFileToBase64(selectedFile);
-      const uploadPayload = {
-        filename: uploadData.filename,
-        content_type: selectedFile.type,
-        file_data: fileData,
-        folder_id: currentFolder,
-        tags: uploadData.tags.split(',').map(tag => tag.trim()).filter(tag => tag)
-      };
-
-      await axios.post(`${API}/documents`, uploadPayload);
+      // Send the raw file as multipart so the backend can stream it straight into storage
+      const formData = new FormData();
+      formData.append('file', selectedFile, uploadData.filename || selectedFile.name);
+      if (currentFolder) {
+        formData.append('folder_id', currentFolder);
+      }
+      formData.append('tags', uploadData.tags.split(',').map(tag => tag.trim()).filter(tag => tag).join(','));
+
+      await axios.post(`${API}/documents`, formData);
       setShowUploadForm(false);
       setSelectedFile(null);
       setUploadData({ filename: '', tags: '', folder_id: null });
@@ -113,14 +166,15 @@ const DocumentManager = () => {
 
   const downloadDocument = async (doc) => {
     try {
-      // Create a download link for the base64 data
-      const byteCharacters = atob(doc.file_data);
-      const byteNumbers = new Array(byteCharacters.length);
-      for (let i = 0; i < byteCharacters.length; i++) {
-        byteNumbers[i] = byteCharacters.charCodeAt(i);
+      // Documents in S3 come from a presigned URL; navigating to it downloads the file
+      // (it is served as an attachment) without a cross-origin XHR
+      const { data } = await axios.get(`${API}/documents/${doc.id}/download-url`);
+      if (data.url) {
+        window.location.assign(data.url);
+        return;
       }
-      const byteArray = new Uint8Array(byteNumbers);
-      const blob = new Blob([byteArray], { type: doc.content_type });
+      const response = await axios.get(`${API}/documents/${doc.id}/download`, { responseType: 'blob' });
+      const blob = new Blob([response.data], { type: doc.content_type });
       
       const url = window.URL.createObjectURL(blob);
       const link = document.createElement('a');
@@ -154,20 +208,10 @@ const DocumentManager = () => {
 
   const getCurrentFolderName = () => {
     if (!currentFolder) return 'Root';
-    const folder = folders.find(f => f.id === currentFolder);
-    return folder ? folder.name : 'Unknown';
+    return folderPath.length > 0 ? folderPath[folderPath.length - 1].name : '…';
   };
 
-  const breadcrumbs = () => {
-    const crumbs = [{ id: null, name: 'Root' }];
-    if (currentFolder) {
-      const folder = folders.find(f => f.id === currentFolder);
-      if (folder) {
-        crumbs.push({ id: folder.id, name: folder.name });
-      }
-    }
-    return crumbs;
-  };
+  const breadcrumbs = () => [{ id: null, name: 'Root' }, ...folderPath];
 
   return (
     <div className="min-h-screen bg-gray-50">
@@ -220,6 +264,66 @@ const DocumentManager = () => {
           </button>
         </div>
 
+        {/* Search */}
+        <form onSubmit={handleSearch} className="mb-8 flex space-x-4">
+          <input
+            type="search"
+            value={searchQuery}
+            onChange={(e) => setSearchQuery(e.target.value)}
+            className="flex-1 px-3 py-2 border border-gray-300 rounded-md focus:outline-none focus:ring-blue-500 focus:border-blue-500"
+            placeholder="Search document names, tags and contents"
+          />
+          <button
+            type="submit"
+            className="bg-blue-600 text-white px-6 py-2 rounded-md hover:bg-blue-700"
+          >
+            Search
+          </button>
+          {searchResults && (
+            <button
+              type="button"
+              onClick={clearSearch}
+              className="bg-gray-300 text-gray-700 px-6 py-2 rounded-md hover:bg-gray-400"
+            >
+              Clear
+            </button>
+          )}
+        </form>
+
+        {searchResults && (
+          <div className="bg-white rounded-xl shadow-lg mb-8">
+            <div className="p-6 border-b">
+              <h2 className="text-xl font-bold">Search results for "{searchQuery}"</h2>
+            </div>
+            <div className="p-6 space-y-4">
+              {searchResults.map((result) => (
+                <div key={result.id} className="p-4 border border-gray-200 rounded-lg">
+                  <div className="flex items-center justify-between">
+                    <div className="flex items-center space-x-3">
+                      <span className="text-2xl">{getFileIcon(result.content_type)}</span>
+                      <p className="font-medium">{result.filename}</p>
+                    </div>
+                    <button
+                      onClick={() => downloadDocument(result)}
+                      className="bg-blue-600 text-white px-3 py-1 rounded text-sm hover:bg-blue-700"
+                    >
+                      Download
+                    </button>
+                  </div>
+                  {result.snippet && (
+                    <p className="mt-2 text-sm text-gray-600">…{renderSnippet(result)}…</p>
+                  )}
+                </div>
+              ))}
+              {searchResults.length === 0 && (
+                <div className="text-center text-gray-500 py-8">
+                  No documents match your search.
+                </div>
+              )}
+            </div>
+          </div>
+        )}
+
         {/* Upload Form */}
         {showUploadForm && (
           <div className="bg-white rounded-xl shadow-lg p-6 mb-8">
@@ -327,29 +431,36 @@ const DocumentManager = () => {
           
           <div className="p-6">
             {/* Folders */}
-            {folders.filter(folder => folder.parent_id === currentFolder).length > 0 && (
+            {folders.length > 0 && (
               <div className="mb-6">
                 <h3 className="text-lg font-semibold mb-3">Folders</h3>
                 <div className="grid grid-cols-1 md:grid-cols-2 lg:grid-cols-3 gap-4">
-                  {folders
-                    .filter(folder => folder.parent_id === currentFolder)
-                    .map((folder) => (
-                      <div
-                        key={folder.id}
-                        onClick={() => setCurrentFolder(folder.id)}
-                        className="p-4 border border-gray-200 rounded-lg hover:bg-gray-50 cursor-pointer transition-colors"
-                      >
-                        <div className="flex items-center space-x-3">
-                          <span className="text-2xl">📁</span>
-                          <div>
-                            <p className="font-medium">{folder.name}</p>
-                            <p className="text-sm text-gray-500">
-                              Created {new Date(folder.created_at).toLocaleDateString()}
-                            </p>
-                          </div>
+                  {folders.map((folder) => (
+                    <div
+                      key={folder.id}
+                      onClick={() => setCurrentFolder(folder.id)}
+                      className="p-4 border border-gray-200 rounded-lg hover:bg-gray-50 cursor-pointer transition-colors"
+                    >
+                      <div className="flex items-center space-x-3">
+                        <span className="text-2xl">📁</span>
+                        <div className="flex-1">
+                          <p className="font-medium">{folder.name}</p>
+                          <p className="text-sm text-gray-500">
+                            {folder.child_count} folders · {folder.document_count} documents
+                          </p>
+                          <p className="text-xs text-gray-400">
+                            Created {new Date(folder.created_at).toLocaleDateString()}
+                          </p>
                         </div>
+                        <button
+                          onClick={(event) => deleteFolder(event, folder)}
+                          className="text-red-600 hover:text-red-700 text-sm"
+                        >
+                          Delete
+                        </button>
                       </div>
-                    ))}
+                    </div>
+                  ))}
                 </div>
               </div>
             )}
@@ -18,20 +18,32 @@ const Marketplace = () => {
     description: '',
     price: '',
     category: '',
-    stock_quantity: '',
-    image_data: ''
+    stock_quantity: ''
   });
   const [selectedImage, setSelectedImage] = useState(null);
+  const [searchQuery, setSearchQuery] = useState('');
+  const [suggestions, setSuggestions] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+  // One key per cart contents: retrying the same checkout replays the original order
+  const [checkoutKey, setCheckoutKey] = useState(() => crypto.randomUUID());
 
   useEffect(() => {
     fetchProducts();
     fetchOrders();
   }, []);
 
-  const fetchProducts = async () => {
+  useEffect(() => {
+    setCheckoutKey(crypto.randomUUID());
+  }, [cart]);
+
+  const fetchProducts = async (query = searchQuery, cursor = null) => {
     try {
-      const response = await axios.get(`${API}/products`);
-      setProducts(response.data);
+      const params = {};
+      if (query) params.q = query;
+      if (cursor) params.cursor = cursor;
+      const response = await axios.get(`${API}/products`, { params });
+      setProducts(cursor ? [...products, ...response.data] : response.data);
+      setNextCursor(response.headers['x-next-cursor'] || null);
     } catch (error) {
       console.error('Error fetching products:', error);
     }
@@ -50,33 +62,50 @@ const Marketplace = () => {
     const file = event.target.files[0];
     if (file) {
       setSelectedImage(file);
-      // Convert to base64
-      const reader = new FileReader();
-      reader.onload = () => {
-        const base64 = reader.result.split(',')[1];
-        setProductData({ ...productData, image_data: base64 });
-      };
-      reader.readAsDataURL(file);
     }
   };
 
+  const handleSearchChange = async (value) => {
+    setSearchQuery(value);
+    if (!value.trim()) {
+      setSuggestions([]);
+      return;
+    }
+    try {
+      const response = await axios.get(`${API}/products/suggest`, { params: { q: value } });
+      setSuggestions(response.data);
+    } catch (error) {
+      setSuggestions([]);
+    }
+  };
+
+  const handleSearch = (e) => {
+    e.preventDefault();
+    setSuggestions([]);
+    fetchProducts(searchQuery);
+  };
+
   const handleCreateProduct = async (e) => {
     e.preventDefault();
     try {
-      const productPayload = {
-        ...productData,
-        price: parseFloat(productData.price),
-        stock_quantity: parseInt(productData.stock_quantity)
-      };
-      await axios.post(`${API}/products`, productPayload);
+      // Multipart, so the image is stored once as a blob and listed by URL instead of inline
+      const formData = new FormData();
+      formData.append('name', productData.name);
+      formData.append('description', productData.description);
+      formData.append('price', parseFloat(productData.price));
+      formData.append('category', productData.category);
+      formData.append('stock_quantity', parseInt(productData.stock_quantity));
+      if (selectedImage) {
+        formData.append('image', selectedImage, selectedImage.name);
+      }
+      await axios.post(`${API}/products`, formData);
       setShowProductForm(false);
       setProductData({
         name: '',
         description: '',
         price: '',
         category: '',
-        stock_quantity: '',
-        image_data: ''
+        stock_quantity: ''
       });
       setSelectedImage(null);
       fetchProducts();
@@ -142,14 +171,23 @@ const Marketplace = () => {
         }
       };
       
-      await axios.post(`${API}/orders`, orderData);
+      await axios.post(`${API}/orders`, orderData, {
+        headers: { 'Idempotency-Key': checkoutKey }
+      });
       setCart([]);
       setShowCart(false);
       fetchOrders();
+      fetchProducts();
       alert('Order placed successfully!');
     } catch (error) {
       console.error('Error placing order:', error);
-      alert('Error placing order. Please try again.');
+      if (error.response?.status === 409) {
+        // Stale price or stock: refresh the catalog so the cart can be corrected
+        fetchProducts();
+        alert(error.response.data.detail);
+      } else {
+        alert('Error placing order. Please try again.');
+      }
     }
   };
 
@@ -375,14 +413,41 @@ const Marketplace = () => {
           {/* Products List */}
           <div className="lg:col-span-2">
             <h2 className="text-xl font-bold mb-4">Products</h2>
+            <form onSubmit={handleSearch} className="relative mb-6">
+              <input
+                type="text"
+                value={searchQuery}
+                onChange={(e) => handleSearchChange(e.target.value)}
+                placeholder="Search products..."
+                className="w-full px-3 py-2 border border-gray-300 rounded-md focus:outline-none focus:ring-blue-500 focus:border-blue-500"
+              />
+              {suggestions.length > 0 && (
+                <ul className="absolute z-10 w-full bg-white border border-gray-200 rounded-md shadow-lg mt-1">
+                  {suggestions.map((suggestion) => (
+                    <li
+                      key={suggestion.id}
+                      onClick={() => {
+                        setSearchQuery(suggestion.name);
+                        setSuggestions([]);
+                        fetchProducts(suggestion.name);
+                      }}
+                      className="px-3 py-2 hover:bg-gray-100 cursor-pointer flex justify-between"
+                    >
+                      <span>{suggestion.name}</span>
+                      <span className="text-sm text-gray-500">{suggestion.category}</span>
+                    </li>
+                  ))}
+                </ul>
+              )}
+            </form>
             {products.length > 0 ? (
               <div className="grid grid-cols-1 md:grid-cols-2 gap-6">
                 {products.map((product) => (
                   <div key={product.id} className="bg-white rounded-xl shadow-lg overflow-hidden">
                     <div className="h-48 bg-gray-200 flex items-center justify-center">
-                      {product.image_data ? (
+                      {product.image_url ? (
                         <img
-                          src={`data:image/jpeg;base64,${product.image_data}`}
+                          src={`${BACKEND_URL}${product.image_url}`}
                           alt={product.name}
                           className="w-full h-full object-cover"
                         />
@@ -412,6 +477,14 @@ const Marketplace = () => {
                     </div>
                   </div>
                 ))}
+                {nextCursor && (
+                  <button
+                    onClick={() => fetchProducts(searchQuery, nextCursor)}
+                    className="md:col-span-2 bg-gray-200 text-gray-700 px-4 py-2 rounded hover:bg-gray-300"
+                  >
+                    Load more
+                  </button>
+                )}
               </div>
             ) : (
               <div className="text-center text-gray-500 py-8">
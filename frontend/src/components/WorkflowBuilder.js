@@ -218,7 +218,7 @@ const WorkflowBuilder = () => {
                   </div>
                   <p className="text-gray-600 text-sm mb-3">{workflow.description}</p>
                   <div className="text-xs text-gray-500">
-                    {workflow.steps?.length || 0} steps • Created {new Date(workflow.created_at).toLocaleDateString()}
+                    {workflow.step_count ?? workflow.steps?.length ?? 0} steps • Created {new Date(workflow.created_at).toLocaleDateString()}
                   </div>
                 </div>
               ))}
@@ -90,6 +90,12 @@ export const AuthProvider = ({ children }) => {
   };
 
   const logout = () => {
+    if (token) {
+      // Revoke the token server-side; local state is cleared regardless of the outcome
+      axios.post(`${API}/auth/logout`, null, {
+        headers: { Authorization: `Bearer ${token}` }
+      }).catch(() => {});
+    }
     setToken(null);
     setUser(null);
     localStorage.removeItem('neokatalyst_token');
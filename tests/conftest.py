@@ -0,0 +1,42 @@
+"""Fixtures for the backend unit tests.
+
+backend/server.py runs against mongomock-motor, an in-memory stand-in for MongoDB, so these tests need
+no database server. Async tests run on the anyio pytest plugin that ships with anyio (a FastAPI
+dependency). ``python -m pytest`` from the repository root collects this directory only (pytest.ini).
+"""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# Set before server.py loads backend/.env, which must never point the tests at a real cluster
+os.environ["MONGO_URL"] = "mongodb://localhost:27017"
+os.environ["DB_NAME"] = "neokatalyst_test"
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+from mongomock_motor import AsyncMongoMockClient  # noqa: E402
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def db(monkeypatch):
+    client = AsyncMongoMockClient()
+    database = client[os.environ["DB_NAME"]]
+    monkeypatch.setattr(server, "client", client)
+    monkeypatch.setattr(server, "db", database)
+    await server.ensure_indexes(database)
+    return database
+
+
+@pytest.fixture
+def local_blobs(monkeypatch, tmp_path):
+    store = server.LocalBlobStore(str(tmp_path))
+    monkeypatch.setattr(server, "BLOB_STORE", "local")
+    monkeypatch.setitem(server.blob_stores, "local", store)
+    return store
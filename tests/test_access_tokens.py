@@ -0,0 +1,80 @@
+"""Access token verification: key rotation by kid, required claims, the verified-token cache and logout."""
+import time
+
+import jwt
+import pytest
+from fastapi import HTTPException
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def keys(monkeypatch):
+    monkeypatch.setattr(server, "JWT_KEYS", {"default": "legacy-secret", "2025-06": "old-secret", "2025-09": "new-secret"})
+    monkeypatch.setattr(server, "JWT_ACTIVE_KID", "2025-09")
+    monkeypatch.setattr(server, "token_cache", server.TTLCache(100, 60))
+    monkeypatch.setattr(server, "revoked_tokens", {})
+    return server.JWT_KEYS
+
+
+def sign(payload, secret, kid=None):
+    return jwt.encode(payload, secret, algorithm=server.JWT_ALGORITHM, headers={"kid": kid} if kid else None)
+
+
+def claims(sub="user-1", ttl=3600):
+    return {"sub": sub, "exp": int(time.time()) + ttl}
+
+
+def rejected(token):
+    with pytest.raises(HTTPException) as error:
+        server.verify_access_token(token)
+    return error.value.status_code == 401
+
+
+def test_new_tokens_carry_the_active_kid(keys):
+    token = server.create_access_token({"sub": "user-1"})
+    assert jwt.get_unverified_header(token)["kid"] == "2025-09"
+    assert server.verify_access_token(token) == "user-1"
+
+
+def test_tokens_signed_with_a_retired_key_still_verify(keys):
+    assert server.verify_access_token(sign(claims(), "old-secret", "2025-06")) == "user-1"
+    # Tokens issued before kids existed fall back to JWT_SECRET as kid "default"
+    assert server.verify_access_token(sign(claims("user-2"), "legacy-secret")) == "user-2"
+
+
+def test_unknown_kids_wrong_keys_and_expired_tokens_are_rejected(keys):
+    assert rejected(sign(claims(), "new-secret", "2024-01"))
+    assert rejected(sign(claims(), "old-secret", "2025-09"))
+    assert rejected(sign(claims(ttl=-10), "new-secret", "2025-09"))
+
+
+def test_tokens_missing_exp_or_sub_are_rejected(keys):
+    assert rejected(sign({"sub": "user-1"}, "new-secret", "2025-09"))
+    assert rejected(sign({"exp": int(time.time()) + 60}, "new-secret", "2025-09"))
+    assert rejected(sign({"sub": 7, "exp": int(time.time()) + 60}, "new-secret", "2025-09"))
+
+
+def test_a_verified_token_is_served_from_the_cache(keys):
+    token = server.create_access_token({"sub": "user-1"})
+    server.verify_access_token(token)
+    server.verify_access_token(token)
+    assert (server.token_cache.hits, server.token_cache.misses) == (1, 1)
+
+
+async def test_a_logged_out_token_is_denied_here_and_after_a_restart(db, keys, monkeypatch):
+    backend = server.LocalStateBackend(100)
+    await backend.start(server.on_state_message)
+    monkeypatch.setattr(server, "state", backend)
+    token = server.create_access_token({"sub": "user-1"})
+    server.verify_access_token(token)
+    await server.revoke_access_token(token)
+    assert rejected(token)
+
+    monkeypatch.setattr(server, "revoked_tokens", {})
+    monkeypatch.setattr(server, "token_cache", server.TTLCache(100, 60))
+    await server.load_revoked_tokens(db)
+    assert rejected(token)
+    assert server.verify_access_token(server.create_access_token({"sub": "user-2"})) == "user-2"
@@ -0,0 +1,58 @@
+"""Login/register rate limiting: which address the per-IP bucket keys on, and when requests are refused."""
+import ipaddress
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def request(peer, forwarded=None):
+    headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+    return Request({"type": "http", "headers": headers, "client": (peer, 50000)})
+
+
+@pytest.fixture
+def proxies(monkeypatch):
+    def trust(hops=0, networks=()):
+        monkeypatch.setattr(server, "AUTH_TRUSTED_PROXY_HOPS", hops)
+        monkeypatch.setattr(server, "AUTH_TRUSTED_PROXIES", [ipaddress.ip_network(n) for n in networks])
+    return trust
+
+
+def test_without_trusted_proxies_the_peer_is_the_client(proxies):
+    proxies()
+    assert server.client_ip(request("203.0.113.7", "198.51.100.1")) == "203.0.113.7"
+
+
+def test_a_fixed_hop_count_takes_the_entry_the_proxy_appended(proxies):
+    proxies(hops=1)
+    # The client sent "1.2.3.4" itself; only the rightmost entry came from the load balancer
+    assert server.client_ip(request("10.0.0.2", "1.2.3.4, 198.51.100.9")) == "198.51.100.9"
+    assert server.client_ip(request("10.0.0.2")) == "10.0.0.2"
+
+
+def test_trusted_networks_are_walked_from_the_right(proxies):
+    proxies(networks=["10.0.0.0/8"])
+    assert server.client_ip(request("10.0.0.2", "1.2.3.4, 198.51.100.9, 10.0.0.5")) == "198.51.100.9"
+    # An untrusted peer's header is ignored entirely
+    assert server.client_ip(request("203.0.113.7", "1.2.3.4")) == "203.0.113.7"
+
+
+async def test_each_ip_and_email_has_its_own_bucket(proxies, monkeypatch):
+    proxies()
+    monkeypatch.setattr(server, "state", server.LocalStateBackend(100))
+    monkeypatch.setattr(server, "AUTH_RATE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(server, "AUTH_IP_BURST", 3)
+    monkeypatch.setattr(server, "AUTH_EMAIL_BURST", 2)
+    for _ in range(2):
+        await server.enforce_auth_rate_limit("login", request("203.0.113.7"), "ana@example.com")
+    with pytest.raises(HTTPException) as error:
+        await server.enforce_auth_rate_limit("login", request("203.0.113.8"), "ANA@example.com")
+    assert error.value.status_code == 429 and int(error.value.headers["Retry-After"]) >= 1
+    await server.enforce_auth_rate_limit("login", request("203.0.113.7"), "bo@example.com")
+    with pytest.raises(HTTPException):
+        await server.enforce_auth_rate_limit("login", request("203.0.113.7"), "cy@example.com")
@@ -0,0 +1,75 @@
+"""Content-addressed blobs on the local store: refcounted dedup and orphan collection."""
+import asyncio
+import hashlib
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def add(data: bytes):
+    sha256 = hashlib.sha256(data).hexdigest()
+    return await server.add_blob_reference(sha256, len(data), lambda: server.bytes_chunks(data))
+
+
+def stored_files(store):
+    return [path for path in store.root.rglob("*") if path.is_file()]
+
+
+async def test_duplicate_content_is_stored_once(db, local_blobs):
+    first = await add(b"quarterly report")
+    second = await add(b"quarterly report")
+    assert first == second
+    blob = await db.blobs.find_one({"sha256": first[1]})
+    assert blob["refcount"] == 2 and blob["store"] == "local"
+    assert [path.read_bytes() for path in stored_files(local_blobs)] == [b"quarterly report"]
+
+
+async def test_concurrent_first_uploads_keep_one_copy(db, local_blobs):
+    results = await asyncio.gather(*[add(b"same bytes") for _ in range(5)])
+    assert len(set(results)) == 1
+    assert (await db.blobs.find_one({"sha256": results[0][1]}))["refcount"] == 5
+    assert len(stored_files(local_blobs)) == 1
+
+
+async def test_released_blobs_are_collected_after_the_grace_period(db, local_blobs):
+    _, sha256, _ = await add(b"draft")
+    await add(b"draft")
+    await server.release_blob(sha256)
+    assert await server.collect_orphan_blobs(grace_seconds=-1) == 0
+    await server.release_blob(sha256)
+    assert await server.collect_orphan_blobs(grace_seconds=3600) == 0
+    assert await server.collect_orphan_blobs(grace_seconds=-1) == 1
+    assert await db.blobs.count_documents({}) == 0
+    assert stored_files(local_blobs) == []
+
+
+async def test_a_blob_revived_before_collection_is_kept(db, local_blobs):
+    _, sha256, _ = await add(b"logo")
+    await server.release_blob(sha256)
+    await add(b"logo")
+    assert await server.collect_orphan_blobs(grace_seconds=-1) == 0
+    assert (await db.blobs.find_one({"sha256": sha256}))["refcount"] == 1
+    assert len(stored_files(local_blobs)) == 1
+
+
+async def test_collection_leaves_referenced_blobs_alone(db, local_blobs):
+    _, orphan, _ = await add(b"old")
+    await add(b"current")
+    await server.release_blob(orphan)
+    assert await server.collect_orphan_blobs(grace_seconds=-1) == 1
+    assert [path.read_bytes() for path in stored_files(local_blobs)] == [b"current"]
+
+
+def test_a_store_missing_a_method_cannot_be_created():
+    class WriteOnly(server.BlobStore):
+        async def write(self, sha256, chunks):
+            return sha256
+
+        async def delete(self, key):
+            pass
+
+    with pytest.raises(TypeError, match="read"):
+        WriteOnly()
@@ -0,0 +1,64 @@
+"""The in-memory catalog type-ahead: prefix search, eviction and what a cold start loads."""
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def product(product_id, name, category="", updated_at=None):
+    return {"id": product_id, "name": name, "category": category, "price": 10.0, "image_sha256": None,
+            "updated_at": updated_at or datetime.utcnow()}
+
+
+def names(results):
+    return [result["name"] for result in results]
+
+
+def test_the_last_term_is_a_prefix_and_earlier_terms_are_whole_words():
+    index = server.CatalogIndex(10)
+    for i, name in enumerate(["Standing Desk", "Desk Lamp", "Deskmate Organizer", "Lamp Shade"]):
+        index.add(product(str(i), name))
+    assert names(index.search("desk", 10)) == ["Desk Lamp", "Deskmate Organizer", "Standing Desk"]
+    assert names(index.search("desk la", 10)) == ["Desk Lamp"]
+    assert names(index.search("des lamp", 10)) == []
+    assert index.search("  ", 10) == []
+
+
+def test_categories_are_searchable_too():
+    index = server.CatalogIndex(10)
+    index.add(product("1", "Aeron", "Chairs"))
+    assert names(index.search("chai", 10)) == ["Aeron"]
+
+
+def test_the_oldest_products_are_evicted_first():
+    index = server.CatalogIndex(2)
+    for i, name in enumerate(["Alpha", "Beta", "Gamma"]):
+        index.add(product(str(i), name))
+    assert index.search("alpha", 10) == [] and names(index.search("gamma", 10)) == ["Gamma"]
+    assert "alpha" not in index.terms
+
+
+def test_readding_a_product_replaces_its_tokens():
+    index = server.CatalogIndex(10)
+    index.add(product("1", "Old Name"))
+    index.add(product("1", "New Name"))
+    assert index.search("old", 10) == [] and names(index.search("new", 10)) == ["New Name"]
+    index.remove("1")
+    assert index.terms == [] and index.postings == {}
+
+
+async def test_a_cold_start_loads_the_newest_products(db, monkeypatch):
+    monkeypatch.setattr(server, "CATALOG_INDEX_SIZE", 2)
+    monkeypatch.setattr(server, "catalog_index", server.CatalogIndex(2))
+    start = datetime(2025, 1, 1)
+    await db.products.insert_many([product(str(i), f"Item {i}", updated_at=start + timedelta(days=i)) for i in range(5)])
+    await server.sync_catalog_index()
+    assert names(server.catalog_index.search("item", 10)) == ["Item 3", "Item 4"]
+    assert server.catalog_index.synced_at == start + timedelta(days=4)
+
+    await db.products.insert_one(product("5", "Item 5", updated_at=start + timedelta(days=5)))
+    await server.sync_catalog_index()
+    assert names(server.catalog_index.search("item", 10)) == ["Item 4", "Item 5"]
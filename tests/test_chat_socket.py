@@ -0,0 +1,47 @@
+"""The chat WebSocket reports bad frames and rejected posts without dropping the connection."""
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+USER = server.User(email="ana@example.com", full_name="Ana")
+
+
+@pytest.fixture
+async def room(db, monkeypatch):
+    backend = server.LocalStateBackend(100)
+    await backend.start(server.on_state_message)
+    monkeypatch.setattr(server, "state", backend)
+    await db.users.insert_one(USER.dict())
+    chat_room = server.ChatRoom(name="General", participants=[USER.id], created_by=USER.id)
+    await db.chat_rooms.insert_one(chat_room.dict())
+    return chat_room.id
+
+
+def connect(room_id):
+    # Not entered as a context manager, so the lifespan (Mongo client, background tasks) does not run
+    token = server.create_access_token({"sub": USER.id})
+    return TestClient(server.app).websocket_connect(f"/api/chat/rooms/{room_id}/ws?token={token}")
+
+
+async def test_bad_frames_get_an_error_and_the_socket_stays_open(room):
+    with connect(room) as socket:
+        socket.send_text("not json")
+        assert socket.receive_json() == {"error": "Invalid message"}
+        socket.send_json({"content": ["not", "text"]})
+        assert socket.receive_json() == {"error": "Invalid message"}
+        socket.send_json({"content": "hello"})
+        assert socket.receive_json()["content"] == "hello"
+
+
+async def test_a_rejected_post_gets_its_error_and_the_socket_stays_open(db, room):
+    with connect(room) as socket:
+        # Removed from the room after connecting
+        await db.chat_rooms.update_one({"id": room}, {"$set": {"participants": []}})
+        socket.send_json({"content": "still here?"})
+        assert socket.receive_json() == {"error": "Chat room not found"}
+        await db.chat_rooms.update_one({"id": room}, {"$set": {"participants": [USER.id]}})
+        socket.send_json({"content": "back again"})
+        assert socket.receive_json()["content"] == "back again"
@@ -0,0 +1,44 @@
+"""Search highlighting: query terms, stem-based highlights and where the snippet is cut."""
+import re
+
+import server
+
+
+def marked(snippet, terms):
+    return [snippet[start:end] for start, end in server.highlight_spans(snippet, terms)]
+
+
+def first_hit(text, terms):
+    match = re.search(server.snippet_pattern(terms), text, re.IGNORECASE)
+    return match.start() if match else None
+
+
+def test_search_terms_drop_negated_words_and_repeats():
+    assert server.search_terms("Quarterly report -draft report") == ["quarterly", "report"]
+
+
+def test_highlights_match_whole_words_by_stem():
+    snippet = "Running late: the runner runs; concatenate the cat's catalog."
+    assert marked(snippet, ["runs"]) == ["Running", "runs"]
+    assert marked(snippet, ["cat"]) == ["cat"]
+
+
+def test_highlights_ignore_case_and_accents():
+    assert marked("Le CAFÉ et les cafés", ["cafe"]) == ["CAFÉ", "cafés"]
+    assert marked("anything", []) == []
+
+
+def test_the_snippet_starts_at_a_highlighted_word():
+    text = "Intro text. Later the team was running drills."
+    assert first_hit(text, ["runs"]) == text.index("running")
+    assert marked(text[first_hit(text, ["runs"]):], ["runs"])[0] == "running"
+
+
+def test_stems_ending_in_i_still_find_the_y_form():
+    text = "A case study of two studies."
+    assert first_hit(text, ["studies"]) == text.index("study")
+
+
+def test_terms_inside_other_words_are_not_snippet_hits():
+    assert first_hit("concatenate the strings", ["cat"]) is None
+    assert server.snippet_pattern([]) is None
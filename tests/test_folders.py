@@ -0,0 +1,65 @@
+"""Materialized-path folders: moves rewrite descendants' ancestors, and uploads stay in the owner's tree."""
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+OWNER = server.User(email="owner@example.com", full_name="Owner")
+OTHER = server.User(email="other@example.com", full_name="Other")
+
+
+async def folder(name, parent=None, user=OWNER):
+    created = await server.create_folder(server.FolderCreate(name=name, parent_id=parent), user)
+    return created.id
+
+
+async def ancestors(db, folder_id):
+    return (await db.document_folders.find_one({"id": folder_id}))["ancestors"]
+
+
+async def test_moving_a_folder_rewrites_its_subtree(db):
+    projects, archive = await folder("Projects"), await folder("Archive")
+    alpha = await folder("Alpha", projects)
+    specs = await folder("Specs", alpha)
+    await server.update_folder(alpha, server.FolderUpdate(parent_id=archive), OWNER)
+    assert await ancestors(db, alpha) == [archive]
+    assert await ancestors(db, specs) == [archive, alpha]
+    await server.update_folder(alpha, server.FolderUpdate(parent_id=None), OWNER)
+    assert await ancestors(db, specs) == [alpha]
+
+
+async def test_a_folder_cannot_move_into_its_own_subtree(db):
+    parent = await folder("Parent")
+    child = await folder("Child", parent)
+    with pytest.raises(HTTPException) as error:
+        await server.update_folder(parent, server.FolderUpdate(parent_id=child), OWNER)
+    assert error.value.status_code == 400
+
+
+async def test_folders_of_other_users_are_not_parents(db):
+    theirs = await folder("Theirs", user=OTHER)
+    with pytest.raises(HTTPException) as error:
+        await folder("Mine", theirs)
+    assert error.value.status_code == 404
+
+
+@pytest.fixture
+def upload(db, local_blobs):
+    server.app.dependency_overrides[server.get_current_user] = lambda: OWNER
+    # Not entered as a context manager, so the lifespan (Mongo client, background tasks) does not run
+    client = TestClient(server.app)
+    yield lambda folder_id: client.post("/api/documents", files={"file": ("notes.bin", b"notes")},
+                                        data={"folder_id": folder_id})
+    server.app.dependency_overrides.clear()
+
+
+async def test_uploads_only_go_into_the_users_own_folders(db, upload):
+    mine, theirs = await folder("Mine"), await folder("Theirs", user=OTHER)
+    assert upload(mine).json()["folder_id"] == mine
+    assert upload(theirs).status_code == 404
+    assert upload("no-such-folder").status_code == 404
+    assert await db.documents.count_documents({}) == 1
+    assert await db.blobs.count_documents({}) == 1
@@ -0,0 +1,46 @@
+"""Startup index reconciliation: which indexes ensure_indexes() manages and when it rebuilds one."""
+import pytest
+from pymongo import ASCENDING, IndexModel
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def spec(**options):
+    return server._index_spec(IndexModel([("key", ASCENDING)], name="key", **options).document)
+
+
+async def test_declared_indexes_are_created(db):
+    names = set(await db.users.index_information())
+    assert names == {"_id_", "email_unique", "id_unique"}
+
+
+async def test_indexes_it_does_not_manage_are_left_alone(db):
+    await db.users.create_index([("company", ASCENDING)], name="ops_company")
+    await server.ensure_indexes(db)
+    assert "ops_company" in await db.users.index_information()
+
+
+async def test_retired_and_changed_indexes_are_dropped(db, monkeypatch):
+    await db.users.create_index([("legacy", ASCENDING)], name="legacy")
+    await db.users.drop_index("email_unique")
+    await db.users.create_index([("email", ASCENDING)], name="email_unique")
+    monkeypatch.setitem(server.RETIRED_INDEXES, "users", ["legacy"])
+    await server.ensure_indexes(db)
+    indexes = await db.users.index_information()
+    assert "legacy" not in indexes and indexes["email_unique"].get("unique") is True
+
+
+def test_partial_filters_and_collations_are_part_of_the_spec():
+    assert spec(partialFilterExpression={"key": {"$type": "string"}}) != spec()
+    assert spec(partialFilterExpression={"key": {"$type": "string"}}) != spec(partialFilterExpression={"key": {"$exists": True}})
+    assert spec(collation={"locale": "en", "strength": 2}) != spec(collation={"locale": "en"})
+    assert spec(collation={"locale": "simple"}) == spec()
+
+
+def test_a_declared_collation_matches_the_one_the_server_reports():
+    reported = {"locale": "en", "caseLevel": False, "caseFirst": "off", "strength": 2, "numericOrdering": False,
+                "alternate": "non-ignorable", "maxVariable": "punct", "normalization": False,
+                "backwards": False, "version": "57.1"}
+    assert server._index_spec({"key": {"key": 1}, "collation": reported}) == spec(collation={"locale": "en", "strength": 2})
@@ -0,0 +1,91 @@
+"""The durable job queue: claiming, retries, dead-lettering, keyed dedup and lease renewal."""
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def jobs(db, monkeypatch):
+    monkeypatch.setattr(server, "job_handlers", {})
+    monkeypatch.setattr(server, "job_stats", dict.fromkeys(server.job_stats, 0))
+    return db
+
+
+async def test_a_claimed_job_is_hidden_from_other_consumers(jobs):
+    job_id = await server.enqueue_job("report", {"n": 1})
+    claimed = await server.claim_job()
+    assert claimed["id"] == job_id and claimed["attempts"] == 1
+    assert await server.claim_job() is None
+    stored = await jobs.jobs.find_one({"id": job_id})
+    assert stored["lease_owner"] == claimed["lease_owner"] and stored["visible_at"] > datetime.utcnow()
+
+
+async def test_delayed_jobs_wait_until_due(jobs):
+    await server.enqueue_job("report", {}, delay_seconds=60)
+    assert await server.claim_job() is None
+
+
+async def test_a_keyed_job_is_enqueued_once(jobs):
+    first = await server.enqueue_job("reindex", {}, key="reindex:docs")
+    assert await server.enqueue_job("reindex", {}, key="reindex:docs") == first
+    assert await jobs.jobs.count_documents({}) == 1
+
+
+async def test_success_deletes_the_job(jobs):
+    ran = []
+
+    @server.job_handler("report")
+    async def report(payload):
+        ran.append(payload)
+
+    await server.enqueue_job("report", {"n": 1})
+    await server.run_job(await server.claim_job())
+    assert ran == [{"n": 1}] and await jobs.jobs.count_documents({}) == 0
+    assert server.job_stats["succeeded"] == 1
+
+
+async def test_failures_back_off_then_dead_letter(jobs):
+    @server.job_handler("flaky")
+    async def flaky(payload):
+        raise RuntimeError("upstream timeout")
+
+    job_id = await server.enqueue_job("flaky", {}, max_attempts=2)
+    await server.run_job(await server.claim_job())
+    stored = await jobs.jobs.find_one({"id": job_id})
+    assert stored["lease_owner"] is None and stored["visible_at"] > datetime.utcnow()
+    assert stored["last_error"] == "RuntimeError: upstream timeout"
+    assert await server.claim_job() is None
+
+    await jobs.jobs.update_one({"id": job_id}, {"$set": {"visible_at": datetime.utcnow()}})
+    await server.run_job(await server.claim_job())
+    assert await jobs.jobs.count_documents({}) == 0
+    dead = await jobs.dead_jobs.find_one({"id": job_id})
+    assert dead["attempts"] == 2 and dead["last_error"] == "RuntimeError: upstream timeout"
+    assert (server.job_stats["retried"], server.job_stats["dead_lettered"]) == (1, 1)
+
+
+async def test_unknown_kinds_are_dead_lettered_at_once(jobs):
+    await server.enqueue_job("no_such_kind", {})
+    await server.run_job(await server.claim_job())
+    assert await jobs.dead_jobs.count_documents({"kind": "no_such_kind", "attempts": 1}) == 1
+
+
+async def test_a_running_job_keeps_its_lease_past_the_visibility_timeout(jobs, monkeypatch):
+    monkeypatch.setattr(server, "JOB_VISIBILITY_TIMEOUT_SECONDS", 0.15)
+
+    @server.job_handler("reconcile")
+    async def slow(payload):
+        await asyncio.sleep(0.5)
+
+    await server.enqueue_job("reconcile", {})
+    run = asyncio.create_task(server.run_job(await server.claim_job()))
+    for _ in range(4):
+        await asyncio.sleep(0.1)
+        assert await server.claim_job() is None
+    await run
+    assert server.job_stats["succeeded"] == 1
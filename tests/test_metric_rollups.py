@@ -0,0 +1,91 @@
+"""Metric ingestion: rollup arithmetic, resolution choice, bucket sizing and flush failures."""
+from datetime import datetime, timedelta
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+HOUR = datetime(2025, 3, 1, 12)
+
+
+def point(value, seconds, name="cpu", owner="owner-1"):
+    metric = server.MetricCreate(name=name, value=value, timestamp=HOUR + timedelta(seconds=seconds))
+    return server.metric_point(metric, owner)
+
+
+@pytest.fixture
+def metrics(db, monkeypatch):
+    monkeypatch.setattr(server, "metric_storage", "buckets")
+    monkeypatch.setattr(server, "metric_buffer", [])
+    monkeypatch.setattr(server, "metric_pending_rollups", [])
+    monkeypatch.setattr(server, "metric_stats", dict.fromkeys(server.metric_stats, 0))
+    return db
+
+
+def test_rollups_group_by_series_and_bucket():
+    points = [point(1, 0), point(5, 30), point(3, 61), point(7, 10, name="mem")]
+    rollups = {(r["name"], r["start"]): r for r in server.compute_rollups(points, 60)}
+    assert set(rollups) == {("cpu", HOUR), ("cpu", HOUR + timedelta(minutes=1)), ("mem", HOUR)}
+    first = rollups[("cpu", HOUR)]
+    assert (first["min"], first["max"], first["sum"], first["count"]) == (1, 5, 6, 2)
+    assert rollups[("mem", HOUR)]["count"] == 1
+
+
+def test_pick_resolution_takes_the_coarsest_rollup_within_the_step():
+    assert server.pick_resolution(30) is None
+    assert server.pick_resolution(60) == "1m"
+    assert server.pick_resolution(7200) == "1h"
+    assert server.pick_resolution(86400 * 7) == "1d"
+
+
+def test_pick_resolution_escalates_when_the_span_needs_too_many_buckets():
+    span = 60 * (server.METRICS_MAX_POINTS + 1)
+    assert server.pick_resolution(60, span) == "1h"
+    assert server.pick_resolution(60, 60 * server.METRICS_MAX_POINTS) == "1m"
+
+
+async def test_a_full_bucket_starts_a_new_one(metrics, monkeypatch):
+    monkeypatch.setattr(server, "METRIC_BUCKET_MAX_POINTS", 4)
+    await server.write_raw_points([point(i, i) for i in range(3)])
+    await server.write_raw_points([point(i, i) for i in range(3, 10)])
+    buckets = await metrics.metric_buckets.find({}).to_list(None)
+    assert sum(bucket["count"] for bucket in buckets) == 10
+    assert all(len(bucket["points"]) == bucket["count"] <= 4 for bucket in buckets)
+
+
+async def test_failed_rollups_are_retried_without_failing_ingestion(metrics, monkeypatch):
+    monkeypatch.setattr(server, "METRICS_FLUSH_SIZE", 2)
+    real_bulk_write = type(metrics.metric_rollups).bulk_write
+    failing = {"rollups": True}
+
+    async def flaky_bulk_write(collection, operations, *args, **kwargs):
+        if collection.name == "metric_rollups" and failing["rollups"]:
+            raise BulkWriteError({"writeErrors": [{"index": i, "code": 11000} for i in range(len(operations))]})
+        return await real_bulk_write(collection, operations, *args, **kwargs)
+
+    monkeypatch.setattr(type(metrics.metric_rollups), "bulk_write", flaky_bulk_write)
+    await server.enqueue_metrics([point(2, 0), point(4, 1)])
+    assert server.metric_buffer == [] and await metrics.metric_buckets.count_documents({}) == 1
+    assert len(server.metric_pending_rollups) == 3 and server.metric_stats["rollup_failures"] == 1
+    assert await metrics.metric_rollups.count_documents({}) == 0
+
+    failing["rollups"] = False
+    await server.flush_metrics()
+    assert server.metric_pending_rollups == []
+    minute = await metrics.metric_rollups.find_one({"resolution": "1m"})
+    assert (minute["sum"], minute["count"]) == (6, 2)
+
+
+async def test_failed_raw_writes_stay_buffered(metrics, monkeypatch):
+    monkeypatch.setattr(server, "METRICS_FLUSH_SIZE", 1)
+
+    async def unavailable(*args, **kwargs):
+        raise ConnectionError("primary stepped down")
+
+    monkeypatch.setattr(server, "write_raw_points", unavailable)
+    await server.enqueue_metrics([point(1, 0)])
+    assert len(server.metric_buffer) == 1
+    assert await metrics.metric_rollups.count_documents({}) == 0
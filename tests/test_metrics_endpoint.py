@@ -0,0 +1,51 @@
+"""Who may scrape /metrics, and what the pool gauges reveal about the database."""
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+
+
+@pytest.fixture
+def scrape(monkeypatch):
+    monkeypatch.setattr(server, "METRICS_TOKEN", "scrape-secret")
+    # Not entered as a context manager, so the lifespan (Mongo client, background tasks) does not run
+    client = TestClient(server.app)
+    return lambda token=None: client.get("/metrics", headers={"Authorization": f"Bearer {token}"} if token else {})
+
+
+async def insert_user(db, admin):
+    user = server.User(email="ops@example.com", full_name="Ops", role=server.UserRole(admin=admin))
+    await db.users.insert_one(user.dict())
+    return server.create_access_token({"sub": user.id})
+
+
+def test_the_metrics_token_is_accepted(scrape):
+    response = scrape("scrape-secret")
+    assert response.status_code == 200
+    assert "http_request_duration_seconds" in response.text
+
+
+def test_anonymous_and_wrong_tokens_are_rejected(scrape):
+    assert scrape().status_code == 403
+    assert scrape("guess").status_code == 401
+
+
+@pytest.mark.anyio
+async def test_only_admin_access_tokens_are_accepted(db, scrape):
+    assert scrape(await insert_user(db, admin=False)).status_code == 403
+    await db.users.delete_many({})
+    assert scrape(await insert_user(db, admin=True)).status_code == 200
+
+
+def test_pool_gauges_label_servers_by_index():
+    monitor = server.PoolMonitor()
+    primary, secondary = (SimpleNamespace(address=("db-0.internal", 27017)),
+                          SimpleNamespace(address=("db-1.internal", 27017)))
+    for event in (primary, primary, secondary):
+        monitor.connection_created(event)
+    monitor.connection_checked_out(secondary)
+    stats = monitor.stats()
+    assert stats["open"] == {"0": 2, "1": 1} and stats["checked_out"] == {"1": 1}
+    assert "internal" not in str(stats)
@@ -0,0 +1,95 @@
+"""Checkout idempotency and stock reservation (the standalone-mongod path, which mongomock exercises)."""
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+BUYER = server.User(email="buyer@example.com", full_name="Buyer")
+
+
+async def insert_product(db, name="Desk", price=120.0, stock=5):
+    product = server.Product(name=name, price=price, stock_quantity=stock, created_by="seller")
+    await db.products.insert_one(product.dict())
+    return product.id
+
+
+def order(*items):
+    return server.OrderCreate(items=[{"product_id": product_id, "quantity": quantity, "price": price}
+                                     for product_id, quantity, price in items])
+
+
+async def stock(db, product_id):
+    return (await db.products.find_one({"id": product_id}))["stock_quantity"]
+
+
+async def test_a_retried_key_returns_the_original_order(db):
+    desk = await insert_product(db)
+    placed, replayed = await server.place_order(order((desk, 2, 120.0)), BUYER, "key-1")
+    assert not replayed and placed["total_amount"] == 240.0
+    again, replayed = await server.place_order(order((desk, 2, 120.0)), BUYER, "key-1")
+    assert replayed and again["id"] == placed["id"]
+    assert await db.orders.count_documents({}) == 1
+    assert await stock(db, desk) == 3
+
+
+async def test_a_key_reused_for_another_cart_is_rejected(db):
+    desk = await insert_product(db)
+    await server.place_order(order((desk, 1, 120.0)), BUYER, "key-1")
+    with pytest.raises(HTTPException) as error:
+        await server.place_order(order((desk, 3, 120.0)), BUYER, "key-1")
+    assert error.value.status_code == 422
+    assert await stock(db, desk) == 4
+
+
+async def test_keys_are_scoped_to_the_buyer(db):
+    desk = await insert_product(db)
+    other = server.User(email="other@example.com", full_name="Other")
+    first, _ = await server.place_order(order((desk, 1, 120.0)), BUYER, "key-1")
+    second, replayed = await server.place_order(order((desk, 1, 120.0)), other, "key-1")
+    assert not replayed and second["id"] != first["id"]
+    assert await stock(db, desk) == 3
+
+
+async def test_concurrent_retries_place_one_order(db, monkeypatch):
+    desk = await insert_product(db)
+    lookup = server.find_idempotent_order
+    lookups = []
+
+    async def lookup_then_yield(*args):
+        # mongomock-motor never yields to the event loop; without this the retries would run one
+        # after another instead of all missing the lookup and racing on the insert
+        existing = await lookup(*args)
+        lookups.append(existing)
+        await asyncio.sleep(0)
+        return existing
+
+    monkeypatch.setattr(server, "find_idempotent_order", lookup_then_yield)
+    results = await asyncio.gather(*[server.place_order(order((desk, 2, 120.0)), BUYER, "key-1") for _ in range(5)])
+    assert len({placed["id"] for placed, _ in results}) == 1
+    assert [replayed for _, replayed in results].count(False) == 1
+    assert lookups[:5] == [None] * 5
+    assert await db.orders.count_documents({}) == 1
+    # Retries that lost the insert put back the stock they had reserved
+    assert await stock(db, desk) == 3
+
+
+async def test_a_failed_cart_returns_the_stock_it_reserved(db, monkeypatch):
+    desk, chair = await insert_product(db), await insert_product(db, "Chair", 40.0, 1)
+    # Chair sells out between the fast-path stock check and its reservation
+    real_update_one = type(db.products).update_one
+
+    async def sell_out_chair_first(collection, query, update, *args, **kwargs):
+        if query.get("id") == chair and "stock_quantity" in query:
+            await real_update_one(collection, {"id": chair}, {"$set": {"stock_quantity": 0}})
+        return await real_update_one(collection, query, update, *args, **kwargs)
+
+    monkeypatch.setattr(type(db.products), "update_one", sell_out_chair_first)
+    with pytest.raises(HTTPException) as error:
+        await server.place_order(order((desk, 2, 120.0), (chair, 1, 40.0)), BUYER, "key-1")
+    assert error.value.status_code == 409
+    assert await stock(db, desk) == 5
+    assert await db.orders.count_documents({}) == 0
@@ -0,0 +1,45 @@
+"""The principal cache behind get_current_user stays in step with the writes that change a user."""
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+CREDENTIALS = {"email": "ana@example.com", "password": "correct horse"}
+
+
+@pytest.fixture
+def api(db, monkeypatch):
+    monkeypatch.setattr(server, "AUTH_RATE_LIMIT_ENABLED", False)
+    monkeypatch.setattr(server, "state", server.LocalStateBackend(100))
+    # Not entered as a context manager, so the lifespan (Mongo client, background tasks) does not run
+    return TestClient(server.app)
+
+
+def me(api, token):
+    response = api.get("/api/auth/me", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    return response.json()
+
+
+async def test_registration_primes_the_cache(api):
+    token = api.post("/api/auth/register", json={**CREDENTIALS, "full_name": "Ana"}).json()["access_token"]
+    me(api, token)
+    me(api, token)
+    assert (server.state.stats()["hits"], server.state.stats()["misses"]) == (2, 0)
+
+
+async def test_login_refreshes_the_cached_last_login(api):
+    api.post("/api/auth/register", json={**CREDENTIALS, "full_name": "Ana"})
+    first = api.post("/api/auth/login", json=CREDENTIALS).json()["access_token"]
+    before = me(api, first)["last_login"]
+    second = api.post("/api/auth/login", json=CREDENTIALS).json()["access_token"]
+    assert me(api, second)["last_login"] > before
+
+
+async def test_profile_updates_are_visible_at_once(api):
+    token = api.post("/api/auth/register", json={**CREDENTIALS, "full_name": "Ana"}).json()["access_token"]
+    me(api, token)
+    api.put("/api/auth/me", json={"full_name": "Ana B"}, headers={"Authorization": f"Bearer {token}"})
+    assert me(api, token)["full_name"] == "Ana B"
@@ -0,0 +1,189 @@
+"""The StateBackend contract: every backend, and peers sharing one shm segment or one Redis."""
+import asyncio
+import uuid
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import fakeredis
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@contextmanager
+def backend_factory(kind):
+    """Yields a factory of backends of one kind; for shm and redis every backend it makes shares state."""
+    if kind == "local":
+        yield lambda: server.LocalStateBackend(100)
+    elif kind == "shm":
+        name = f"nk-test-{uuid.uuid4().hex[:8]}"
+        try:
+            yield lambda: server.SharedMemoryStateBackend(name, 64, 256, 8, 256)
+        finally:
+            shared_memory.SharedMemory(name).unlink()
+    else:
+        fake = fakeredis.FakeServer()
+        yield lambda: server.RedisStateBackend(fakeredis.FakeAsyncRedis(server=fake))
+
+
+@pytest.fixture(params=["local", "shm", "redis"])
+def backends(request):
+    with backend_factory(request.param) as factory:
+        yield factory
+
+
+@pytest.fixture(params=["shm", "redis"])
+def shared_backends(request):
+    # Local state is private to one worker, so only these have peers
+    with backend_factory(request.param) as factory:
+        yield factory
+
+
+async def started(factory, received):
+    backend = factory()
+    await backend.start(lambda channel, message: received.append((channel, message)))
+    # Let the Redis listener subscribe; a peer's publish before that would be lost, as on a real server
+    await asyncio.sleep(0.05)
+    return backend
+
+
+async def wait_until(condition, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("condition not met in time")
+        await asyncio.sleep(0.01)
+
+
+async def test_values_round_trip_and_expire(backends):
+    backend = await started(backends, [])
+    try:
+        await backend.set("principal:1", {"id": "1", "role": {"admin": False}}, 5)
+        assert await backend.get("principal:1") == {"id": "1", "role": {"admin": False}}
+        await backend.delete("principal:1")
+        assert await backend.get("principal:1") is None
+        await backend.set("short", 1, 0.05)
+        await asyncio.sleep(0.1)
+        assert await backend.get("short") is None
+        assert await backend.get("never-set") is None
+    finally:
+        await backend.close()
+
+
+async def test_token_bucket_drains_then_refills(backends):
+    backend = await started(backends, [])
+    try:
+        waits = [await backend.take_tokens("bucket", rate=10, capacity=3) for _ in range(5)]
+        assert waits[:3] == [0, 0, 0]
+        assert all(0 < wait <= 0.1 for wait in waits[3:])
+        await asyncio.sleep(0.15)
+        assert await backend.take_tokens("bucket", rate=10, capacity=3) == 0
+    finally:
+        await backend.close()
+
+
+async def test_publish_reaches_own_handler_immediately(backends):
+    received = []
+    backend = await started(backends, received)
+    try:
+        await backend.publish("chat:room", {"seq": 1})
+        assert received == [("chat:room", {"seq": 1})]
+        assert backend.published == 1
+    finally:
+        await backend.close()
+
+
+async def test_every_backend_counts_hits_and_misses(backends):
+    backend = await started(backends, [])
+    try:
+        await backend.set("principal:1", {"id": "1"}, 5)
+        await backend.get("principal:1")
+        await backend.get("principal:2")
+        await backend.take_tokens("bucket", rate=10, capacity=3)
+        stats = backend.stats()
+        assert (stats["hits"], stats["misses"]) == (1, 1)
+    finally:
+        await backend.close()
+
+
+async def test_peers_share_values_and_buckets(shared_backends):
+    a, b = await started(shared_backends, []), await started(shared_backends, [])
+    try:
+        await a.set("k", {"x": 1}, 5)
+        assert await b.get("k") == {"x": 1}
+        await b.delete("k")
+        assert await a.get("k") is None
+        waits = [await (a if i % 2 else b).take_tokens("login:ip", rate=1, capacity=3) for i in range(4)]
+        assert waits[:3] == [0, 0, 0] and waits[3] > 0
+    finally:
+        await a.close()
+        await b.close()
+
+
+async def test_peers_receive_each_message_once(shared_backends):
+    got_a, got_b = [], []
+    a, b = await started(shared_backends, got_a), await started(shared_backends, got_b)
+    try:
+        await a.publish("revoked:digest", 123.0)
+        await wait_until(lambda: got_b)
+        await asyncio.sleep(0.05)
+        # The publisher skips its own message when it comes back through the backend
+        assert got_a == got_b == [("revoked:digest", 123.0)]
+        assert (a.received, b.received) == (0, 1)
+    finally:
+        await a.close()
+        await b.close()
+
+
+async def test_shm_rejects_a_segment_with_another_layout():
+    name = f"nk-test-{uuid.uuid4().hex[:8]}"
+    backend = server.SharedMemoryStateBackend(name, 64, 256, 8, 256)
+    try:
+        with pytest.raises(RuntimeError):
+            server.SharedMemoryStateBackend(name, 32, 256, 8, 256)
+    finally:
+        await backend.close()
+        shared_memory.SharedMemory(name).unlink()
+
+
+async def test_shm_skips_values_larger_than_a_slot():
+    name = f"nk-test-{uuid.uuid4().hex[:8]}"
+    backend = server.SharedMemoryStateBackend(name, 64, 64, 8, 256)
+    try:
+        await backend.set("big", "x" * 100, 5)
+        assert await backend.get("big") is None
+        assert backend.stats()["oversized"] == 1
+    finally:
+        await backend.close()
+        shared_memory.SharedMemory(name).unlink()
+
+
+async def test_shm_counts_live_entries_it_evicts():
+    name = f"nk-test-{uuid.uuid4().hex[:8]}"
+    # Two slots, so the third key overwrites a live one
+    backend = server.SharedMemoryStateBackend(name, 2, 64, 8, 256)
+    try:
+        for key in ("a", "b", "c"):
+            await backend.set(key, 1, 5)
+        await backend.set("c", 2, 5)
+        assert backend.stats()["evictions"] == 1
+    finally:
+        await backend.close()
+        shared_memory.SharedMemory(name).unlink()
+
+
+def test_a_backend_missing_a_method_cannot_be_created():
+    class NoBuckets(server.StateBackend):
+        async def load(self, key):
+            return None
+
+        async def set(self, key, value, ttl):
+            pass
+
+        async def delete(self, key):
+            pass
+
+    with pytest.raises(TypeError, match="take_tokens"):
+        NoBuckets()
@@ -0,0 +1,80 @@
+"""Workflow scheduler leases: one claimant per due workflow, and only the lease holder advances it."""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def insert_workflow(db, **fields):
+    steps = [server.WorkflowStep(name="Review", order=1, required_approvals=1, task_ids=["task-1"])]
+    workflow = server.Workflow(name="Purchase", steps=steps, step_count=1, created_by="owner")
+    document = {
+        **workflow.dict(), "wake_at": datetime.utcnow(), "wake_seq": 0,
+        "lease_owner": None, "lease_expires_at": server.LEASE_RELEASED, **fields,
+    }
+    await db.workflows.insert_one(document)
+    return workflow.id
+
+
+async def test_a_due_workflow_has_one_claimant(db):
+    workflow_id = await insert_workflow(db)
+    claims = await asyncio.gather(*[server.claim_workflow() for _ in range(5)])
+    claimed = [claim for claim in claims if claim is not None]
+    assert [claim["id"] for claim in claimed] == [workflow_id]
+    stored = await db.workflows.find_one({"id": workflow_id})
+    assert stored["lease_owner"] == claimed[0]["lease_owner"]
+    assert stored["lease_expires_at"] > datetime.utcnow()
+
+
+async def test_only_due_workflows_with_free_leases_are_claimed(db):
+    now = datetime.utcnow()
+    await insert_workflow(db, wake_at=None)
+    await insert_workflow(db, wake_at=now + timedelta(minutes=5))
+    await insert_workflow(db, status="completed")
+    await insert_workflow(db, lease_owner="other", lease_expires_at=now + timedelta(minutes=5))
+    assert await server.claim_workflow() is None
+
+
+async def test_an_expired_lease_is_reclaimed(db):
+    workflow_id = await insert_workflow(
+        db, lease_owner="crashed-worker", lease_expires_at=datetime.utcnow() - timedelta(seconds=1)
+    )
+    claim = await server.claim_workflow()
+    assert claim["id"] == workflow_id and claim["lease_owner"] != "crashed-worker"
+
+
+async def test_the_lease_holder_advances_and_releases(db, monkeypatch):
+    monkeypatch.setattr(server, "workflow_stats", dict.fromkeys(server.workflow_stats, 0))
+    workflow_id = await insert_workflow(db)
+    await server.advance_workflow(await server.claim_workflow())
+    stored = await db.workflows.find_one({"id": workflow_id})
+    assert stored["steps"][0]["status"] == "active" and stored["current_order"] == 1
+    assert stored["lease_owner"] is None and stored["wake_at"] is None
+    assert await db.tasks.count_documents({"workflow_id": workflow_id}) == 1
+    assert server.workflow_stats["advanced"] == 1
+
+
+async def test_a_lost_lease_changes_nothing(db, monkeypatch):
+    monkeypatch.setattr(server, "workflow_stats", dict.fromkeys(server.workflow_stats, 0))
+    workflow_id = await insert_workflow(db)
+    claim = await server.claim_workflow()
+    # The lease expired mid-pass and another worker took the workflow over
+    await db.workflows.update_one({"id": workflow_id}, {"$set": {"lease_owner": "other"}})
+    await server.advance_workflow(claim)
+    stored = await db.workflows.find_one({"id": workflow_id})
+    assert stored["lease_owner"] == "other" and stored["steps"][0]["status"] == "waiting"
+    assert server.workflow_stats["lease_conflicts"] == 1 and server.workflow_stats["advanced"] == 0
+
+
+async def test_a_decision_during_the_pass_keeps_the_workflow_due(db, monkeypatch):
+    workflow_id = await insert_workflow(db)
+    claim = await server.claim_workflow()
+    await db.workflows.update_one({"id": workflow_id}, {"$inc": {"wake_seq": 1}})
+    await server.advance_workflow(claim)
+    stored = await db.workflows.find_one({"id": workflow_id})
+    assert stored["lease_owner"] is None and stored["wake_at"] is not None
+    assert (await server.claim_workflow())["id"] == workflow_id